@@ -18,15 +18,18 @@ require File.expand_path('../resources/finished', __FILE__)
 opts = Trollop.options do
   opt :url, 'URL to bind to', :default => 'http://localhost:4567'
   opt :redis, 'URL of Redis server', :default => ENV['REDIS_URL'] || 'redis://localhost:6379/0'
+  opt :log_redis, 'URL of Redis server for job logs (default: --redis)', :type => String, :default => ENV['LOG_REDIS_URL']
 end
 
 bind_uri = URI.parse(opts[:url])
 
 R = Redis.new(:url => opts[:redis], :driver => :hiredis)
+LR = opts[:log_redis] ? Redis.new(:url => opts[:log_redis], :driver => :hiredis) : R
 
 Pipeline.redis = R
 Ignores.redis = R
 Recent.redis = R
+Recent.log_redis = LR
 Pending.redis = R
 Feed.redis = R
 Status.redis = R
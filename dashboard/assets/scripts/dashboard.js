@@ -466,6 +466,35 @@ class JobsRenderer {
 		return 1;
 	}
 
+	_renderIgnoreQuarantineLine(data, logSegment) {
+		logSegment.appendChild(
+			h("div", Reusable.obj_className_line_ignore, [
+				h("span", null, " QUARANTINED "),
+				data.pattern,
+				h("span", Reusable.obj_className_bold, " as too slow: "),
+				data.reason,
+			]),
+		);
+		return 1;
+	}
+
+	_renderIgnoreStatsLine(data, logSegment) {
+		const parts = [`IGSTATS ${data.patterns} ignores, ${numberWithCommas(data.checks)} checks, ${data.dead} never matched`];
+		// Timings are sampled; scale them up to estimate the total cost.
+		if (data.costliest.length) {
+			const costs = data.costliest.map(
+				(p) => `${p.pattern} (${toStringTenths(p.seconds * data.sample_interval * 1000)} ms, ${numberWithCommas(p.hits)} hits)`,
+			);
+			parts.push(`costliest: ${costs.join(", ")}`);
+		}
+		if (data.most_hits.length) {
+			const hits = data.most_hits.map((p) => `${p.pattern} (${numberWithCommas(p.hits)})`);
+			parts.push(`most hits: ${hits.join(", ")}`);
+		}
+		logSegment.appendChild(h("div", Reusable.obj_className_line_stdout, parts.join("; ")));
+		return 1;
+	}
+
 	_renderStdoutLine(data, logSegment, info, ident) {
 		const cleanedMessage = data.message.replace(/[\r\n]+$/, "");
 		let renderedLines = 0;
@@ -538,6 +567,10 @@ class JobsRenderer {
 			linesRendered = this._renderStdoutLine(data, info.logSegment, info, ident);
 		} else if (type === "ignore") {
 			linesRendered = this._renderIgnoreLine(data, info.logSegment);
+		} else if (type === "ignore_quarantine") {
+			linesRendered = this._renderIgnoreQuarantineLine(data, info.logSegment);
+		} else if (type === "ignore_stats") {
+			linesRendered = this._renderIgnoreStatsLine(data, info.logSegment);
 		} else {
 			assert(false, `Unexpected message type ${type}`);
 		}
@@ -2,19 +2,21 @@ require 'json'
 require 'webmachine'
 
 require File.expand_path('../../../lib/job', __FILE__)
+require File.expand_path('../../../lib/log_packet', __FILE__)
 require File.expand_path('../../messages', __FILE__)
 
 class Recent < Webmachine::Resource
   class << self
     attr_accessor :redis
+    attr_accessor :log_redis
   end
 
   def run_query(count=10)
-    jobs = Job.working(self.class.redis)
+    jobs = Job.working(self.class.redis, self.class.log_redis)
 
     jobs.each_with_object([]) do |j, a|
       if j #TODO: Why is this necessary?
-        a << j.most_recent_log_entries(count).map { |le| LogMessage.new(j, JSON.parse(le)) }
+        a << j.most_recent_log_entries(count).map { |le| LogMessage.new(j, LogPacket.parse(le)) }
       end
     end.flatten
   end
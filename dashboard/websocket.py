@@ -2,6 +2,7 @@ import asyncio
 import collections
 import datetime
 import io
+import json
 import os
 import sys
 import websockets
@@ -12,6 +13,11 @@ import websockets.framing
 DEBUG = 'WSDEBUG' in os.environ and os.environ['WSDEBUG'] == '1'
 
 
+# Short codes of the compact log packet encoding; must match log_packets in lib/shared_config.yml.
+PACKET_KEYS = {'y': 'type', 't': 'ts', 'u': 'url', 'r': 'response_code', 'w': 'wget_code', 'e': 'is_error', 'a': 'is_warning', 'p': 'pattern', 's': 'source', 'm': 'message'}
+PACKET_TYPES = {'d': 'download', 'i': 'ignore', 'o': 'stdout'}
+
+
 # Taken from qwarc.utils
 PAGESIZE = os.sysconf('SC_PAGE_SIZE')
 def get_rss():
@@ -19,6 +25,18 @@ def get_rss():
 		return int(fp.readline().split()[1]) * PAGESIZE
 
 
+def expand_packet(line):
+	# Dashboard clients only understand full keys, so compact packets from the firehose are expanded once here rather than in every client.
+	if '"y":' not in line:
+		return line
+	packet = json.loads(line)
+	if 'y' not in packet or 'type' in packet:
+		return line
+	packet = {PACKET_KEYS.get(k, k): v for k, v in packet.items()}
+	packet['type'] = PACKET_TYPES.get(packet['type'], packet['type'])
+	return json.dumps(packet, separators = (',', ':'))
+
+
 async def stdin(loop):
 	reader = asyncio.StreamReader(limit = 2 ** 20) # 1 MiB buffer limit
 	reader_protocol = asyncio.StreamReaderProtocol(reader)
@@ -31,7 +49,7 @@ async def stdin_to_amplifier(amplifier, loop, stats):
 	while True:
 		d = await reader.readline()
 		stats['stdin read'] += len(d)
-		amplifier.send(d.decode('utf-8').strip())
+		amplifier.send(expand_packet(d.decode('utf-8').strip()))
 
 
 def websocket_extensions_to_key(extensions):
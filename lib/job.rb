@@ -3,6 +3,7 @@ require 'uuidtools'
 require 'json'
 
 require File.expand_path('../job_analysis', __FILE__)
+require File.expand_path('../job_log', __FILE__)
 require File.expand_path('../shared_config', __FILE__)
 
 ##
@@ -175,21 +176,33 @@ class Job < Struct.new(:uri, :redis)
     attr_reader attr_name
   end
 
-  def self.from_ident(ident, redis)
+  def self.from_ident(ident, redis, log_redis = nil)
     url = redis.hget(ident, 'url')
     return unless url
 
-    new(Addressable::URI.parse(url).normalize, redis).tap(&:amplify)
+    new(Addressable::URI.parse(url).normalize, redis).tap do |j|
+      j.log_redis = log_redis
+      j.amplify
+    end
   end
 
   def self.working_job_idents(redis)
     redis.lrange('working', 0, -1)
   end
 
-  def self.working(redis)
+  def self.working(redis, log_redis = nil)
     idents = working_job_idents(redis)
 
-    idents.map { |ident| from_ident(ident, redis) }
+    idents.map { |ident| from_ident(ident, redis, log_redis) }
+  end
+
+  attr_writer :log_redis
+
+  ##
+  # The Redis that pipelines ship this job's log to.  Unless a separate log
+  # Redis is set, this is the job's Redis.
+  def log_redis
+    @log_redis || redis
   end
 
   def aborted?
@@ -221,15 +234,25 @@ class Job < Struct.new(:uri, :redis)
   end
 
   def add_ignore_pattern(pattern)
-    redis.sadd(ignore_patterns_set_key, pattern)
-    job_parameters_changed
+    _, version = redis.multi do
+      redis.sadd(ignore_patterns_set_key, pattern)
+      ignore_patterns_changed
+    end
+    job_parameters_changed('ignore_patterns' => {
+      'version' => version, 'added' => Array(pattern)
+    })
   end
 
   alias_method :add_ignore_patterns, :add_ignore_pattern
 
   def remove_ignore_pattern(pattern)
-    redis.srem(ignore_patterns_set_key, pattern)
-    job_parameters_changed
+    _, version = redis.multi do
+      redis.srem(ignore_patterns_set_key, pattern)
+      ignore_patterns_changed
+    end
+    job_parameters_changed('ignore_patterns' => {
+      'version' => version, 'removed' => Array(pattern)
+    })
   end
 
   # More convenient access for modules.
@@ -282,7 +305,7 @@ class Job < Struct.new(:uri, :redis)
 
   def abort
     redis.hset(ident, 'abort_requested', true)
-    job_parameters_changed
+    job_parameters_changed('fields' => { 'abort_requested' => 'true' })
   end
 
   def fail
@@ -309,6 +332,10 @@ class Job < Struct.new(:uri, :redis)
     redis.multi do
       redis.lpush(queue, ident)
       redis.hset(ident, 'queued_at', Time.now.to_i)
+
+      # Pipelines find named queues through this registry.
+      redis.sadd('pending_queues', queue) if destination
+      redis.publish(SharedConfig.queue_channel, queue)
     end
   end
 
@@ -350,12 +377,12 @@ class Job < Struct.new(:uri, :redis)
 
   def set_delay(min, max)
     redis.hmset(ident, 'delay_min', min, 'delay_max', max)
-    job_parameters_changed
+    job_parameters_changed('fields' => { 'delay_min' => min, 'delay_max' => max })
   end
 
   def set_concurrency(level)
     redis.hset(ident, 'concurrency', level)
-    job_parameters_changed
+    job_parameters_changed('fields' => { 'concurrency' => level })
   end
 
   def toggle_ignores(enabled)
@@ -365,7 +392,9 @@ class Job < Struct.new(:uri, :redis)
       redis.hset(ident, 'suppress_ignore_reports', true)
     end
 
-    job_parameters_changed
+    job_parameters_changed('fields' => {
+      'suppress_ignore_reports' => (enabled ? nil : 'true')
+    })
   end
 
   def add_note(note)
@@ -495,13 +524,16 @@ class Job < Struct.new(:uri, :redis)
   #
   # Set threshold to zero to trim all stale entries.
   def trim_logs!(threshold = 1000)
+    # Log streams are trimmed by the pipeline as it writes them.
+    return [] if JobLog.stream?(log_redis, log_key)
+
     m = [last_analyzed_log_entry, last_broadcasted_log_entry].min
     l = last_trimmed_log_entry
     entries = []
 
     if m - last_trimmed_log_entry >= threshold
-      entries = redis.zrangebyscore(log_key, l, m, :with_scores => true)
-      redis.zremrangebyscore(log_key, l, m)
+      entries = log_redis.zrangebyscore(log_key, l, m, :with_scores => true)
+      log_redis.zremrangebyscore(log_key, l, m)
       redis.hset(ident, 'last_trimmed_log_entry', m)
     end
 
@@ -511,16 +543,34 @@ class Job < Struct.new(:uri, :redis)
   ##
   # Returns the +count+ most recent log entries for this job.
   def most_recent_log_entries(count)
-    redis.zrange(log_key, -count, -1)
+    JobLog.most_recent(log_redis, log_key, count)
   end
 
   private
 
-  def job_parameters_changed
+  # Pipelines only re-read the ignore set when this version moves, so it
+  # must be bumped together with every change to the set.
+  def ignore_patterns_changed
+    redis.hincrby(ident, 'ignore_patterns_version', 1)
+  end
+
+  # Bumps the settings age and announces it on the job channel.  With
+  # detailed job messages, the announcement also carries changes: a 'fields'
+  # hash of changed job hash fields and/or an 'ignore_patterns' hash of the
+  # new ignore set version and the 'added' and 'removed' patterns.
+  # Pipelines apply those only if the message directly follows the settings
+  # they have, so changes made silently just make them fetch everything.
+  def job_parameters_changed(changes = {})
     age = redis.hincrby(ident, 'settings_age', 1)
 
     unless @no_change_message
-      redis.publish(SharedConfig.job_channel(ident), age)
+      message = if SharedConfig.detailed_job_messages?
+                  JSON.dump({ 'age' => age, 'fields' => {} }.merge(changes))
+                else
+                  age
+                end
+
+      redis.publish(SharedConfig.job_channel(ident), message)
     end
   end
 
@@ -1,3 +1,6 @@
+require File.expand_path('../job_log', __FILE__)
+require File.expand_path('../log_packet', __FILE__)
+
 # Analysis tools for job logs.
 module JobAnalysis
   def log_key
@@ -21,21 +24,21 @@ module JobAnalysis
   end
 
   def new_entries(start)
-    redis.zrangebyscore(log_key, "(#{start}", '+inf', :with_scores => true)
+    JobLog.entries_after(log_redis, log_key, start)
   end
 
   def read_new_entries
-    start = redis.hget(ident, broadcast_checkpoint_key).to_f
+    start = redis.hget(ident, broadcast_checkpoint_key)
     entries = new_entries(start)
 
     return [] if entries.empty?
 
     redis.hset(ident, broadcast_checkpoint_key, entries.last.last)
-    entries.map { |entry, _| JSON.parse(entry) }
+    entries.map { |entry, _| LogPacket.parse(entry) }
   end
 
   def analyze
-    start = redis.hget(ident, checkpoint_key).to_f
+    start = redis.hget(ident, checkpoint_key)
     resps = new_entries(start)
 
     return if resps.empty?
@@ -44,7 +47,7 @@ module JobAnalysis
 
     redis.pipelined do
       resps.each do |p, _|
-        entry = JSON.parse(p)
+        entry = LogPacket.parse(p)
 
         next unless entry['type'] == 'download'
 
@@ -0,0 +1,59 @@
+##
+# Reads job logs.  Depending on the log_backend pipelines are configured
+# with (see shared_config.yml), a job's log key is either a sorted set with
+# one member per log packet, scored by sequence number, or a stream with one
+# entry per shipped batch whose field values are the batch's log packets.
+#
+# Log entries are returned as [packet, checkpoint] pairs, where packet is the
+# packet's JSON and checkpoint is what to pass back to entries_after to read
+# only newer entries: a sorted set score or a stream entry ID.
+module JobLog
+  module_function
+
+  def stream?(redis, log_key)
+    redis.type(log_key) == 'stream'
+  end
+
+  ##
+  # Returns the entries after checkpoint, or all entries if checkpoint is nil.
+  def entries_after(redis, log_key, checkpoint)
+    if stream?(redis, log_key)
+      start = stream_id?(checkpoint) ? next_stream_id(checkpoint) : '-'
+
+      stream_packets(redis.xrange(log_key, start, '+'))
+    else
+      redis.zrangebyscore(log_key, "(#{checkpoint.to_f}", '+inf', :with_scores => true)
+    end
+  end
+
+  ##
+  # Returns the packets of the +count+ most recent entries, oldest first.
+  def most_recent(redis, log_key, count)
+    if stream?(redis, log_key)
+      # Each stream entry holds at least one packet.
+      entries = redis.xrevrange(log_key, '+', '-', 'COUNT', count).reverse
+
+      stream_packets(entries).map(&:first).last(count)
+    else
+      redis.zrange(log_key, -count, -1)
+    end
+  end
+
+  def stream_packets(entries)
+    entries.flat_map do |id, fields|
+      fields.each_slice(2).map { |_, packet| [packet, id] }
+    end
+  end
+
+  def stream_id?(checkpoint)
+    checkpoint.to_s.include?('-')
+  end
+
+  ##
+  # XRANGE's start is inclusive; this is the smallest ID after +id+.
+  def next_stream_id(id)
+    ms, seq = id.split('-')
+
+    "#{ms}-#{seq.to_i + 1}"
+  end
+end
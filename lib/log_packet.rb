@@ -0,0 +1,32 @@
+require 'json'
+
+require File.expand_path('../shared_config', __FILE__)
+
+##
+# Reads log packets written by pipelines.  Packets are either plain JSON
+# objects or use the compact encoding described under log_packets in
+# shared_config.yml; both are returned with their full keys.
+module LogPacket
+  module_function
+
+  def parse(json)
+    expand(JSON.parse(json))
+  end
+
+  ##
+  # Expands a compact packet.  Packets that are already expanded are returned
+  # as-is.
+  def expand(packet)
+    return packet if packet.has_key?('type')
+
+    keys = SharedConfig.log_packet_keys
+    return packet unless packet.has_key?(keys['type'])
+
+    full_keys = keys.invert
+    full_types = SharedConfig.log_packet_types.invert
+
+    expanded = Hash[packet.map { |k, v| [full_keys.fetch(k, k), v] }]
+    expanded['type'] = full_types.fetch(expanded['type'], expanded['type'])
+    expanded
+  end
+end
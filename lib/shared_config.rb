@@ -20,4 +20,20 @@ module SharedConfig
   def job_channel_prefix
     config['channels']['job_prefix']
   end
+
+  def queue_channel
+    config['channels']['queue']
+  end
+
+  def detailed_job_messages?
+    !!config['detailed_job_messages']
+  end
+
+  def log_packet_keys
+    config['log_packets']['keys']
+  end
+
+  def log_packet_types
+    config['log_packets']['types']
+  end
 end
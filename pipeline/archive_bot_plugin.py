@@ -8,6 +8,7 @@ and aborts.
 # The ArchiveBot plugin will be split across multiple modules, but
 # sys.path for plugins does not include the plugin file's directory.
 # We add that here.
+import asyncio
 import os
 import sys
 import random
@@ -26,7 +27,8 @@ from wpull.stats import Statistics
 from wpull.url import URLInfo
 
 from archivebot import shared_config
-from archivebot.control import Control
+from archivebot.control import Control, DownloadPacket
+from archivebot.wpull import guard
 from archivebot.wpull import settings as mod_settings
 
 # dupespotter plugin:
@@ -83,8 +85,17 @@ def is_warning(statcode):
 class ArchiveBotPlugin(WpullPlugin):
     last_age = 0
 
+    # How often (in seconds) to ship per-pattern ignore statistics.
+    ignore_stats_interval = 300
+    last_ignore_stats = 0
+
+    # How many of the costliest and most matched patterns to report.
+    ignore_stats_top = 5
+    last_ignore_summary = None
+
     ident = None
     redis_url = None
+    log_redis_url = None
     log_key = None
     log_channel = None
     pipeline_channel = None
@@ -92,6 +103,7 @@ class ArchiveBotPlugin(WpullPlugin):
 
     settings = None
     settings_listener = None
+    loop = None
 
     logger = None
 
@@ -112,15 +124,48 @@ class ArchiveBotPlugin(WpullPlugin):
 
         self.logger.info('Ignore %s using pattern %s', url, pattern)
 
-    def log_result(self, url, statcode, error):
+    def log_quarantine(self, pattern, assessment):
+        # Always reported: unlike an ignored URL, a quarantined pattern is
+        # something the operator who added it needs to hear about.
         packet = dict(
+            ts=time.time(),
+            pattern=pattern,
+            type='ignore_quarantine',
+            reason=guard.describe(assessment)
+        )
+
+        self.control.log(packet, self.ident, self.log_key)
+        self.logger.warning('Quarantined pattern %s: %s', pattern,
+                            packet['reason'])
+
+    def log_ignore_stats(self):
+        summary = self.settings.ignoracle.pattern_summary(self.ignore_stats_top)
+
+        # Nothing new to report if no URL was checked since the last summary.
+        if summary == self.last_ignore_summary:
+            return
+
+        self.last_ignore_summary = summary
+
+        packet = dict(summary, ts=time.time(), type='ignore_stats')
+
+        self.control.log(packet, self.ident, self.log_key)
+
+    def maybe_log_ignore_stats(self):
+        now = time.monotonic()
+
+        if now - self.last_ignore_stats >= self.ignore_stats_interval:
+            self.last_ignore_stats = now
+            self.log_ignore_stats()
+
+    def log_result(self, url, statcode, error):
+        packet = DownloadPacket(
             ts=time.time(),
             url=url,
             response_code=statcode,
             wget_code=error,
             is_error=is_error(statcode, error),
-            is_warning=is_warning(statcode),
-            type='download'
+            is_warning=is_warning(statcode)
         )
 
         self.control.log(packet, self.ident, self.log_key)
@@ -149,15 +194,13 @@ class ArchiveBotPlugin(WpullPlugin):
 
         self.log_result(item_session.url_record.url, statcode, error)
 
-        settings_age = self.settings.age()
-        if self.last_age < settings_age:
-            self.last_age = settings_age
-            self.print_log("Settings updated: ", self.settings.inspect())
-            self.app_session.factory['PipelineSeries'].concurrency = self.settings.concurrency()
+        self.apply_settings()
 
         # See that the settings listener is online
         self.settings_listener.check()
 
+        self.maybe_log_ignore_stats()
+
         if self.settings.abort_requested():
             self.print_log("Wpull terminating on bot command")
 
@@ -176,21 +219,45 @@ class ArchiveBotPlugin(WpullPlugin):
 
         return Actions.NORMAL
 
+    def apply_settings(self):
+        '''
+        Applies settings that wpull doesn't read for itself, if they changed.
+        '''
+
+        settings_age = self.settings.age()
+        if self.last_age < settings_age:
+            self.last_age = settings_age
+            self.print_log("Settings updated: ", self.settings.inspect())
+            self.app_session.factory['PipelineSeries'].concurrency = self.settings.concurrency()
+
+    def settings_updated(self):
+        # Called from the settings listener thread.
+        self.loop.call_soon_threadsafe(self.apply_settings)
+
     def activate(self):
+        self.logger = logging.getLogger('archivebot.pipeline.wpull_plugin')
         self.ident = os.environ['ITEM_IDENT']
         self.redis_url = os.environ['REDIS_URL']
+        self.log_redis_url = os.environ.get('LOG_REDIS_URL')
         self.log_key = os.environ['LOG_KEY']
         self.log_channel = shared_config.log_channel()
         self.pipeline_channel = shared_config.pipeline_channel()
-        self.control = Control(self.redis_url, self.log_channel, self.pipeline_channel)
+        self.control = Control(self.redis_url, self.log_channel, self.pipeline_channel,
+                               packet_codes=shared_config.log_packet_codes(),
+                               log_stream_maxlen=shared_config.log_stream_maxlen(),
+                               log_redis_url=self.log_redis_url)
 
         self.settings = mod_settings.Settings()
+        self.configure_ignore_cache(self.settings.ignoracle)
+        self.settings.ignoracle.on_quarantine = self.log_quarantine
+        self.loop = asyncio.get_event_loop()
         self.settings_listener = mod_settings.Listener(self.redis_url, self.settings,
-                                                       self.control, self.ident)
+                                                       self.control, self.ident,
+                                                       self.settings_updated)
         self.settings_listener.start()
 
         self.last_age = 0
-        self.logger = logging.getLogger('archivebot.pipeline.wpull_plugin')
+        self.last_ignore_stats = time.monotonic()
 
         self.logger.info('wpull plugin initialization complete for job ID '
                          '{}'.format(self.ident))
@@ -203,6 +270,21 @@ class ArchiveBotPlugin(WpullPlugin):
         super().activate()
         self.logger.info('wpull plugin activated')
 
+    def configure_ignore_cache(self, ignoracle):
+        '''
+        Sizes the ignore verdict cache from the environment.  Verdicts are
+        kept for IGNORE_VERDICT_CACHE_ENTRIES URLs or about
+        IGNORE_VERDICT_CACHE_BYTES bytes, whichever limit is hit first.
+        '''
+
+        entries = os.environ.get('IGNORE_VERDICT_CACHE_ENTRIES')
+        size = os.environ.get('IGNORE_VERDICT_CACHE_BYTES')
+
+        if entries:
+            ignoracle.verdict_cache_size = int(entries)
+        if size:
+            ignoracle.verdict_cache_bytes = int(size)
+
     def deactivate(self):
         super().deactivate()
 
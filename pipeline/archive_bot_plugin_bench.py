@@ -0,0 +1,96 @@
+'''
+Microbenchmark for ArchiveBotPlugin.handle_result, the plugin's per-response
+hot path.  Needs wpull installed.  Run from the pipeline directory:
+
+    python3 archive_bot_plugin_bench.py
+
+Prints the time per handle_result call with log packets encoded on the log
+shipper thread (as the pipeline does) and, for comparison, encoded inline
+by Control.log.  Also prints the shipper-side encoding cost per entry.
+'''
+
+import time
+
+from collections import namedtuple
+from queue import Queue
+from types import SimpleNamespace
+
+from archive_bot_plugin import ArchiveBotPlugin
+from archivebot.bench import Record, per_call
+from archivebot.control import Control, LogEntry, encode_packet
+from archivebot.wpull import settings as mod_settings
+
+ItemSession = namedtuple('ItemSession', ['url_record', 'response'])
+
+PATTERNS = [
+    '[\\?&]replytocom=',
+    '/(.*)/(\\1/){3,}',
+    '{primary_netloc}/notes/[0-9]+/',
+    '[?&]oldid=\\d+(&|$)'
+]
+
+NUMBER = 50000
+
+def item_sessions():
+    response = SimpleNamespace(status_code=200,
+                               body=SimpleNamespace(size=lambda: 4096))
+
+    return [ItemSession(Record('http://www.example.com/%d/page/%d' % (i % 16, i),
+                               1, 'http://www.example.com/%d/' % (i % 16)),
+                        response)
+            for i in range(4096)]
+
+def control():
+    # Nothing is shipped; entries pile up in an unbounded queue instead.
+    # The Redis URL is never connected to.
+    c = Control('redis://localhost:6379/0', 'updates', 'pipeline',
+                start_shipper=False)
+    c.log_queue = Queue()
+
+    return c
+
+def plugin():
+    p = ArchiveBotPlugin.__new__(ArchiveBotPlugin)
+    p.ident = 'ident'
+    p.log_key = 'ident_log'
+    p.control = control()
+    p.settings = mod_settings.Settings()
+    p.settings.ignoracle.set_patterns(PATTERNS)
+    p.settings_listener = mod_settings.Listener(None, p.settings, p.control,
+                                                p.ident)
+    p.last_ignore_stats = time.monotonic()
+
+    return p
+
+def inline_log(c):
+    # Control.log as it was: the packet is encoded by the caller.
+    def log(packet, ident, log_key):
+        c.log_queue.put_nowait(LogEntry(time.monotonic(), ident,
+            c.log_channel, log_key, None, encode_packet(packet)))
+
+    return log
+
+def main():
+    sessions = item_sessions() * (NUMBER * 3 // 4096 + 1)
+
+    p = plugin()
+    it = iter(sessions)
+    deferred = per_call(lambda: p.handle_result(next(it)), NUMBER)
+
+    entries = list(p.control.log_queue.queue)
+    it = iter(entries)
+    encode = per_call(lambda: next(it).encode(), NUMBER)
+
+    p = plugin()
+    p.control.log = inline_log(p.control)
+    it = iter(sessions)
+    inline = per_call(lambda: p.handle_result(next(it)), NUMBER)
+
+    print('%-44s %8.3f us' % ('handle_result (encoded on shipper thread)', deferred))
+    print('%-44s %8.3f us' % ('handle_result (encoded inline)', inline))
+    print('%-44s %8.3f us' % ('LogEntry.encode on shipper thread', encode))
+
+if __name__ == '__main__':
+    main()
+
+# vim: ts=4:sw=4:et:tw=78
@@ -0,0 +1,20 @@
+'''
+Helpers shared by the pipeline's microbenchmarks.
+'''
+
+import timeit
+
+from collections import namedtuple
+
+# The parts of a wpull URL record that ignore checks look at.
+Record = namedtuple('Record', ['url', 'level', 'parent_url'])
+
+def per_call(stmt, number):
+    '''
+    Returns the best time per call of stmt, run number times per repeat, in
+    microseconds.
+    '''
+
+    return min(timeit.repeat(stmt, number=number, repeat=3)) / number * 1e6
+
+# vim: ts=4:sw=4:et:tw=78
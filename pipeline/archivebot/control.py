@@ -2,25 +2,394 @@ import json
 import time
 import os
 import logging
+import random
 import threading
+from collections import OrderedDict, namedtuple
 from queue import Queue, Empty, Full
 from contextlib import contextmanager
 
 import redis
-from redis.exceptions import ConnectionError as RedisConnectionError, RedisError
+from redis.exceptions import (ConnectionError as RedisConnectionError,
+                              RedisError, ResponseError)
+
+from .spool import LogSpool
 
 logger = logging.getLogger('archivebot.control')
 
+FlushPolicy = namedtuple('FlushPolicy', [
+    'max_entries',  # most log entries shipped in one round trip
+    'max_latency',  # longest time, in seconds, an entry waits for company
+    'max_bytes'     # most bytes of log messages shipped in one round trip
+])
+
+DEFAULT_FLUSH_POLICY = FlushPolicy(
+    max_entries=64,
+    max_latency=0.25,
+    max_bytes=256 * 1024
+)
+
+# How often, in seconds, the log shipper logs its statistics.
+SHIPPER_STATS_INTERVAL = 60
+
+# Largest size of the on-disk log spool, in bytes; see LogSpool.
+LOG_SPOOL_MAX_BYTES = 64 * 1024 * 1024
+
+# Times Redis may reject a batch of spooled log entries before the batch is
+# dropped, so that one bad batch can't hold up the spool for good.
+SPOOL_BATCH_ATTEMPTS = 5
+
+# Seconds the log shipper gets to ship what is left once wpull is exiting.
+# Whatever is still queued or spooled after that is counted as dropped.
+LOG_DRAIN_TIMEOUT = 10
+
+# Reconnect backoff, in seconds; see Backoff.
+RECONNECT_BACKOFF_BASE = 0.5
+RECONNECT_BACKOFF_CAP = 60
+
+def flush_policy_from_env(environ=os.environ):
+    '''
+    Returns the default FlushPolicy, overridden by LOG_FLUSH_MAX_ENTRIES,
+    LOG_FLUSH_MAX_LATENCY and LOG_FLUSH_MAX_BYTES if set.
+    '''
+
+    policy = DEFAULT_FLUSH_POLICY
+
+    if environ.get('LOG_FLUSH_MAX_ENTRIES'):
+        policy = policy._replace(max_entries=int(environ['LOG_FLUSH_MAX_ENTRIES']))
+    if environ.get('LOG_FLUSH_MAX_LATENCY'):
+        policy = policy._replace(max_latency=float(environ['LOG_FLUSH_MAX_LATENCY']))
+    if environ.get('LOG_FLUSH_MAX_BYTES'):
+        policy = policy._replace(max_bytes=int(environ['LOG_FLUSH_MAX_BYTES']))
+
+    return policy
+
+# The fields of a download log packet.  The wpull plugin logs one of these
+# per response, so it skips building a dict.
+DownloadPacket = namedtuple('DownloadPacket', [
+    'ts',
+    'url',
+    'response_code',
+    'wget_code',
+    'is_error',
+    'is_warning'
+])
+
+def encode_packet(packet, codes=None):
+    '''
+    Encodes a log packet, a dict or a DownloadPacket, for Redis.  If codes
+    (see shared_config.log_packet_codes) is given, the packet is written in
+    the compact encoding.
+    '''
+
+    if isinstance(packet, DownloadPacket):
+        packet = dict(zip(DownloadPacket._fields, packet), type='download')
+
+    if codes is None:
+        return json.dumps(packet)
+
+    return json.dumps(compact_packet(packet, codes), separators=(',', ':'))
+
+def compact_packet(packet, codes):
+    '''
+    Replaces a packet's keys and type with their short codes.
+    '''
+
+    keys = codes['keys']
+    types = codes['types']
+
+    compact = dict((keys.get(key, key), value) for key, value in packet.items())
+    compact[keys['type']] = types.get(packet['type'], packet['type'])
+
+    return compact
+
+class LogEntry(object):
+    '''
+    A log entry waiting to be shipped.  The packet is encoded by encode(),
+    which only the log shipper thread calls, so that callers of Control.log
+    don't pay for serialization.
+    '''
+
+    __slots__ = ('queued_at', 'ident', 'log_channel', 'log_key', 'packet',
+                 'message')
+
+    def __init__(self, queued_at, ident, log_channel, log_key, packet,
+                 message=None):
+        self.queued_at = queued_at
+        self.ident = ident
+        self.log_channel = log_channel
+        self.log_key = log_key
+        self.packet = packet
+        self.message = message
+
+    def encode(self, codes=None):
+        if self.message is None:
+            self.message = encode_packet(self.packet, codes)
+            self.packet = None
+
+        return self.message
+
+    def spooled(self, codes=None):
+        '''
+        Returns this entry in a form that LogSpool can store.
+        '''
+
+        return [self.queued_at, self.ident, self.log_channel, self.log_key,
+                self.encode(codes)]
+
+    @classmethod
+    def from_spooled(cls, data):
+        queued_at, ident, log_channel, log_key, message = data
+
+        return cls(queued_at, ident, log_channel, log_key, None, message)
+
+def entry_size(entry, codes=None):
+    '''
+    Size of a log entry's encoded packet, for FlushPolicy.max_bytes.
+    '''
+
+    return len(entry.encode(codes))
+
+class Counters(object):
+    '''
+    Running totals of the counts a Control adds to the job's hash.  Each
+    thread that counts gets its own Counters, so that counting takes no
+    lock; the log shipper sums them up and ships the change since its last
+    flush.
+    '''
+
+    __slots__ = ('bytes_downloaded', 'items_downloaded', 'items_queued',
+                 'log_entries_dropped')
+
+    def __init__(self):
+        self.bytes_downloaded = 0
+        self.items_downloaded = 0
+        self.items_queued = 0
+        self.log_entries_dropped = 0
+
+COUNTER_FIELDS = Counters.__slots__
+
+class ShipperStats(object):
+    '''
+    Statistics about log shipping: how big batches are, how long entries
+    wait before they reach Redis, and how deep the log queue gets.  Only
+    the log shipper thread updates these.
+    '''
+
+    def __init__(self):
+        self.flushes = 0
+        self.entries = 0
+        self.bytes = 0
+        self.max_batch = 0
+        self.batch_sizes = {}       # power-of-two bucket -> number of flushes
+        self.latency = 0.0          # total, over flushes, of oldest entry's wait
+        self.max_latency = 0.0
+        self.round_trip = 0.0       # total time spent in pipe.execute()
+        self.queue_depth = 0        # queue depth at the last flush
+        self.max_queue_depth = 0
+        self.spooled = 0            # entries written to the spool
+        self.spool_depth = 0        # entries in the spool at the last flush
+
+    def record_flush(self, entries, nbytes, latency, round_trip, queue_depth):
+        self.flushes += 1
+        self.entries += entries
+        self.bytes += nbytes
+        self.max_batch = max(self.max_batch, entries)
+
+        bucket = 1
+        while bucket < entries:
+            bucket *= 2
+        self.batch_sizes[bucket] = self.batch_sizes.get(bucket, 0) + 1
+
+        self.latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        self.round_trip += round_trip
+        self.queue_depth = queue_depth
+        self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+
+    def as_dict(self):
+        flushes = self.flushes or 1
+
+        return dict(
+            flushes=self.flushes,
+            entries=self.entries,
+            bytes=self.bytes,
+            mean_batch=self.entries / flushes,
+            max_batch=self.max_batch,
+            batch_sizes=dict(self.batch_sizes),
+            mean_latency=self.latency / flushes,
+            max_latency=self.max_latency,
+            mean_round_trip=self.round_trip / flushes,
+            queue_depth=self.queue_depth,
+            max_queue_depth=self.max_queue_depth,
+            spooled=self.spooled,
+            spool_depth=self.spool_depth
+        )
+
+class ConnectionStats(object):
+    '''
+    Counts Redis connection churn: clients connected, connection failures
+    and calls refused while waiting to reconnect.
+    '''
+
+    __slots__ = ('connects', 'failures', 'refused')
+
+    def __init__(self):
+        for field in self.__slots__:
+            setattr(self, field, 0)
+
+    def as_dict(self):
+        return dict((field, getattr(self, field)) for field in self.__slots__)
+
+class Backoff(object):
+    '''
+    Exponential backoff with full jitter.  After the nth failure in a row,
+    the delay is picked uniformly between 0 and min(cap, base * 2 ** (n - 1))
+    seconds, so that the many processes that lose Redis at the same moment
+    don't all come back at the same moment too.
+    '''
+
+    def __init__(self, base=RECONNECT_BACKOFF_BASE, cap=RECONNECT_BACKOFF_CAP,
+                 random=random.random):
+        self.base = base
+        self.cap = cap
+        self.random = random
+        self.failures = 0
+
+    def failed(self):
+        '''
+        Records a failure.  Returns the number of seconds to wait before
+        trying again.
+        '''
+
+        self.failures += 1
+        ceiling = min(self.cap, self.base * 2 ** min(self.failures - 1, 32))
+
+        return self.random() * ceiling
+
+    def succeeded(self):
+        self.failures = 0
+
+# One connection pool per Redis URL, shared by everything in this process.
+connection_pools = {}
+connection_pools_lock = threading.Lock()
+
+def connection_pool(redis_url):
+    '''
+    Returns the process-wide connection pool for redis_url.  Clients built
+    on it decode responses.
+    '''
+
+    with connection_pools_lock:
+        pool = connection_pools.get(redis_url)
+
+        if pool is None:
+            pool = redis.ConnectionPool.from_url(redis_url,
+                                                 decode_responses=True)
+            connection_pools[redis_url] = pool
+
+        return pool
+
+class Endpoint(object):
+    '''
+    A Redis server that Control talks to.  Clients share the process-wide
+    connection pool for redis_url.
+
+    If a message cannot be processed due to a connection error, the client
+    is deleted and a redis.exceptions.ConnectionError is raised.
+    Reconnection is delayed with a Backoff; until then, connect() raises
+    ConnectionError without touching the network.
+
+    on_connect, if given, is called with each new client, e.g. to register
+    scripts on it.  pool, if given, is used instead of the process-wide
+    pool; tests pass one to talk to a fake Redis.
+    '''
+
+    def __init__(self, redis_url, ident=None, on_connect=None, pool=None):
+        self.redis_url = redis_url
+        self.ident = ident
+        self.on_connect = on_connect
+        self.pool = pool
+        self.redis = None
+        self.backoff = Backoff()
+        self.connection_stats = ConnectionStats()
+        self.reconnect_at = 0.0
+
+        # Guards everything above but redis_url, as the log shipper,
+        # settings listener and plugin all connect.
+        self.lock = threading.Lock()
+
+    def connected(self):
+        return self.redis is not None
+
+    def connect(self):
+        with self.lock:
+            if self.redis is not None:
+                return
+
+            wait = self.reconnect_delay()
+
+            if wait > 0:
+                self.connection_stats.refused += 1
+                raise RedisConnectionError('Reconnecting in {:.1f} seconds'
+                                           .format(wait))
+
+            logger.info('Attempting to connect to redis with ident={}, thread={}'.format(
+                self.ident, threading.get_ident()))
+            if self.redis_url is None:
+                raise RedisConnectionError('self.redis_url not set')
+
+            client = redis.StrictRedis(
+                connection_pool=self.pool or connection_pool(self.redis_url))
+
+            if self.on_connect:
+                self.on_connect(client)
+
+            self.redis = client
+            self.connection_stats.connects += 1
+            logger.info('Redis connection successful with ident={}, thread={}'.format(
+                self.ident, threading.get_ident()))
+
+    def connection_failed(self):
+        '''
+        Drops the client after a connection error and backs off before the
+        next reconnect.  Threads that fail on a client that has already been
+        dropped don't extend the backoff.
+        '''
+
+        with self.lock:
+            if self.redis is None:
+                return
+
+            self.redis = None
+            self.connection_stats.failures += 1
+            self.reconnect_at = time.monotonic() + self.backoff.failed()
+
+    def connection_succeeded(self):
+        self.backoff.succeeded()
+
+    def reconnect_delay(self):
+        '''
+        Returns the number of seconds until the next reconnect is allowed.
+        '''
+
+        return max(0.0, self.reconnect_at - time.monotonic())
+
+    def disconnect(self):
+        self.redis = None
+
 @contextmanager
-def conn(controller):
+def conn(endpoint):
+    if not endpoint.connected():
+        endpoint.connect()
+
     try:
-        if not controller.connected():
-            controller.connect()
         yield
     except RedisConnectionError as e:
-        controller.disconnect()
+        endpoint.connection_failed()
         raise e
 
+    endpoint.connection_succeeded()
+
 def candidate_queues(named_queues, pipeline_nick, ao_only, large):
     '''
     Generates names of queues that this pipeline will check for work.
@@ -46,30 +415,68 @@ class Control(object):
     '''
     Handles communication to and from the ArchiveBot control server.
 
-    If a message cannot be processed due to a connection error, the Redis
-    connection is closed and deleted.  A redis.exceptions.ConnectionError
-    is also raised.
+    Job logs, their sequence numbers and the announcements on log_channel
+    go to log_redis_url if it is given, and everything else to redis_url.
+    A flood of log entries then can't slow down job reservation or settings
+    delivery.
+
+    Each Redis is an Endpoint.  If a message cannot be processed due to a
+    connection error, a redis.exceptions.ConnectionError is raised.
+
+    pool, if given, is the connection pool for redis_url; see Endpoint.  If
+    start_shipper is false, log entries are queued but never shipped.  Both
+    are meant for tests and benchmarks.
     '''
 
-    def __init__(self, redis_url, log_channel, pipeline_channel):
+    def __init__(self, redis_url, log_channel, pipeline_channel,
+                 flush_policy=None, packet_codes=None, log_stream_maxlen=None,
+                 log_redis_url=None, pool=None, start_shipper=True):
         self.log_channel = log_channel
         self.pipeline_channel = pipeline_channel
-        self.items_downloaded_outstanding = 0
-        self.items_queued_outstanding = 0
-        self.bytes_downloaded_outstanding = 0
-        self.redis_url = redis_url
+        self.local_counters = threading.local()
+        self.all_counters = []
+        self.shipped_counts = dict.fromkeys(COUNTER_FIELDS, 0)
         self.log_queue = Queue(maxsize = 10000)
+        self.flush_policy = flush_policy or flush_policy_from_env()
+        self.packet_codes = packet_codes
+        self.log_stream_maxlen = log_stream_maxlen
+        self.shipper_stats = ShipperStats()
+        self.last_shipper_stats = time.monotonic()
+        self.last_counts_shipped = 0.0
 
         # if ITEM_IDENT is set, we are running inside a wpull process
         self.ident = os.getenv('ITEM_IDENT')
         logger.info('Started new control process with ident={}, thread={}, this={}'.format(
             self.ident, threading.get_ident(), self))
-        # and as such this lock will be used to manage count concurrency
+        # and as such this lock guards all_counters, which each thread joins
+        # the first time it counts something
         self.countslock = threading.Lock()
 
-        self.redis = self.connect()
+        self.endpoint = Endpoint(redis_url, self.ident, self.register_scripts,
+                                 pool)
+
+        if log_redis_url and log_redis_url != redis_url:
+            self.log_endpoint = Endpoint(log_redis_url, self.ident,
+                                         self.register_log_scripts)
+        else:
+            self.log_endpoint = self.endpoint
+
+        # Only the log shipper thread touches the spool.
+        self.spool = self.open_spool()
+        self.spool_rejections = 0
+        self.rejection_backoff = Backoff()
+
+        self.endpoint.connect()
+        self.log_endpoint.connect()
 
         self.ending = False
+        self.drain_deadline = None
+        self.drain_requested = threading.Event()
+        self.log_thread = None
+
+        if not start_shipper:
+            return
+
         self.log_thread = threading.Thread(target=self.ship_logs)
 
         # At some point it would be preferable to not use a daemonic thread
@@ -77,78 +484,82 @@ class Control(object):
         self.log_thread.setDaemon(True)
         self.log_thread.start()
 
-    def connected(self):
-        return self.redis is not None
+    def open_spool(self):
+        '''
+        Opens a log spool in the job's item directory, if we know it.  The
+        spool's size can be set with LOG_SPOOL_MAX_BYTES.
+        '''
 
-    def connect(self):
-        logger.info('Attempting to connect to redis with ident={}, thread={}'.format(
-            self.ident, threading.get_ident()))
-        if self.redis_url is None:
-            raise RedisConnectionError('self.redis_url not set')
+        item_dir = os.getenv('ITEM_DIR')
 
-        self.redis = redis.StrictRedis.from_url(self.redis_url,
-                                                decode_responses=True)
+        if not item_dir:
+            return None
 
-        self.register_scripts()
-        logger.info('Redis connection successful with ident={}, thread={}'.format(
-            self.ident, threading.get_ident()))
+        max_bytes = int(os.getenv('LOG_SPOOL_MAX_BYTES') or LOG_SPOOL_MAX_BYTES)
+
+        return LogSpool(os.path.join(item_dir, 'log_spool'), max_bytes)
+
+    @property
+    def redis(self):
+        return self.endpoint.redis
+
+    @property
+    def log_redis(self):
+        return self.log_endpoint.redis
+
+    def separate_log_redis(self):
+        return self.log_endpoint is not self.endpoint
 
     def disconnect(self):
-        self.redis = None
+        self.endpoint.disconnect()
+        self.log_endpoint.disconnect()
 
     def stop(self):
         logger.info('Control subsystem got immediate stop')
         self.disconnect()
+        self.drain_deadline = time.monotonic()
         self.ending = True
+        self.drain_requested.set()
 
-    def register_scripts(self):
-        self.mark_done_script = self.redis.register_script(MARK_DONE_SCRIPT)
-        self.mark_aborted_script = self.redis.register_script(MARK_ABORTED_SCRIPT)
-        self.log_script = self.redis.register_script(LOGGER_SCRIPT)
-
-    def all_named_pending_queues(self):
-        with conn(self):
-            pipelines = set()
+    def register_scripts(self, client):
+        self.mark_done_script = client.register_script(MARK_DONE_SCRIPT)
+        self.mark_aborted_script = client.register_script(MARK_ABORTED_SCRIPT)
+        self.get_settings_script = client.register_script(GET_SETTINGS_SCRIPT)
+        self.counts_script = client.register_script(COUNTS_SCRIPT)
+        self.reserve_job_script = client.register_script(RESERVE_JOB_SCRIPT)
 
-            for name in self.redis.scan_iter('pending:*'):
-                pipelines.add(name)
+        if not self.separate_log_redis():
+            self.register_log_scripts(client)
 
-            return pipelines
+    def register_log_scripts(self, client):
+        self.log_batch_script = client.register_script(LOGGER_BATCH_SCRIPT)
 
     def reserve_job(self, pipeline_id, pipeline_nick, ao_only, large):
-        named_queues = self.all_named_pending_queues()
+        '''
+        Moves a job from the first non-empty queue this pipeline takes work
+        from to the working list, and marks it as started by this pipeline.
+        Returns the job's ident and hash, or (None, None) if every queue is
+        empty.
+        '''
 
-        for queue in candidate_queues(named_queues, pipeline_nick, ao_only,
-            large):
-            ident = self.dequeue_item(queue)
+        # Named queues are matched by RESERVE_JOB_SCRIPT, from the
+        # pending_queues registry; the rest are always the same.
+        queues = candidate_queues([], pipeline_nick, ao_only, large)
 
-            if ident:
-                return self.complete_reservation(ident, pipeline_id)
+        with conn(self.endpoint):
+            reply = self.reserve_job_script(args=[pipeline_id, time.time(),
+                pipeline_nick, '' if ao_only else '1'] + queues)
 
-        return None, None
+        if not reply:
+            return None, None
 
-    def dequeue_item(self, queue):
-        with conn(self):
-            return self.redis.rpoplpush(queue, 'working')
+        ident, fields = reply
+        it = iter(fields)
 
-    def complete_reservation(self, ident, pipeline_id):
-        with conn(self):
-            self.redis.hmset(ident, dict(
-                started_at=time.time(),
-                pipeline_id=pipeline_id
-            ))
-
-            return ident, self.redis.hgetall(ident)
-
-    def heartbeat(self, ident):
-        try:
-            with conn(self):
-                self.redis.hincrby(ident, 'heartbeat', 1)
-        except RedisConnectionError:
-            pass
+        return ident, dict(zip(it, it))
 
     def is_aborted(self, ident):
-        with conn(self):
+        with conn(self.endpoint):
             return self.redis.hget(ident, 'aborted')
 
     def flag_logging_thread_for_termination(self):
@@ -166,45 +577,146 @@ class Control(object):
         #logger.info('Logger thread joined to thread {}'.format(threading.get_ident()))
 
     def mark_done(self, item, expire_time): # used from main controller
-        with conn(self):
-            self.mark_done_script(keys=[item['ident']], args=[expire_time,
+        with conn(self.endpoint):
+            ttl = self.mark_done_script(keys=[item['ident']], args=[expire_time,
                 self.log_channel, int(time.time()), json.dumps(item['info']),
                                                               item['log_key']])
 
+        self.announce(item['ident'], item['log_key'], ttl)
+
     def mark_aborted(self, ident): # used when in wpull subprocess
         #self.flag_logging_thread_for_termination()
-        with conn(self):
+        with conn(self.endpoint):
             self.mark_aborted_script(keys=[ident], args=[self.log_channel])
 
-    def advise_exiting(self): # used when in wpull subprocess
+        self.announce(ident)
+
+    def announce(self, ident, log_key=None, ttl=None):
+        '''
+        With a separate log Redis, announces a job update on its log channel
+        too, so that log consumers see it.  If ttl is given, the job's log
+        and log sequence number there expire in ttl seconds, as the job does
+        on the control Redis.
+
+        The job's state has already changed by now, so connection errors are
+        logged rather than raised; retrying the caller would change it twice.
+        '''
+
+        if not self.separate_log_redis():
+            return
+
+        try:
+            with conn(self.log_endpoint):
+                pipe = self.log_redis.pipeline(transaction=False)
+
+                if ttl is not None:
+                    pipe.expire(ident, ttl)
+                    pipe.expire(log_key, ttl)
+
+                pipe.publish(self.log_channel, ident)
+                pipe.execute()
+        except RedisConnectionError as e:
+            logger.warning('Could not announce update of {} on the log redis: {!r}'
+                           .format(ident, e))
+
+    def advise_exiting(self, timeout=LOG_DRAIN_TIMEOUT): # used when in wpull subprocess
+        '''
+        Gives the log shipper up to timeout seconds to ship the entries it
+        has queued and spooled, then stops it.  The spool lives in the item
+        directory, which is removed once wpull exits.
+        '''
+
         logger.info('Got exit advice with ident={}, thread={}'
                     .format(self.ident, threading.get_ident()))
-        #self.flag_logging_thread_for_termination()
 
-    def update_bytes_downloaded(self, size: int):
+        if self.log_thread is None:
+            return
+
+        self.drain_deadline = time.monotonic() + timeout
+        self.ending = True
+        self.drain_requested.set()
+        # Leave a moment to count what is left and close the spool.
+        self.log_thread.join(timeout + 1)
+
+        if self.log_thread.is_alive():
+            logger.warning('Log shipper with ident={} did not stop within {} '
+                           'seconds'.format(self.ident, timeout))
+
+    def counters(self):
+        '''
+        Returns the calling thread's Counters.
+        '''
+
+        try:
+            return self.local_counters.counters
+        except AttributeError:
+            counters = Counters()
+
+            with self.countslock:
+                self.all_counters.append(counters)
+
+            self.local_counters.counters = counters
+
+            return counters
+
+    def count_totals(self):
+        '''
+        Returns a dict of each count's total over all threads.
+        '''
+
         with self.countslock:
-            self.bytes_downloaded_outstanding += size
+            all_counters = list(self.all_counters)
+
+        totals = dict.fromkeys(COUNTER_FIELDS, 0)
+
+        for counters in all_counters:
+            for field in COUNTER_FIELDS:
+                totals[field] += getattr(counters, field)
+
+        return totals
+
+    def update_bytes_downloaded(self, size: int):
+        self.counters().bytes_downloaded += size
 
     def update_items_downloaded(self, count: int):
-        with self.countslock:
-            self.items_downloaded_outstanding += count
+        self.counters().items_downloaded += count
 
     def update_items_queued(self, count: int):
-        with self.countslock:
-            self.items_queued_outstanding += count
+        self.counters().items_queued += count
+
+    def report(self, pipeline_id, report, heartbeats, register):
+        '''
+        In one round trip, beats the heartbeat of each job in heartbeats,
+        stores report, a dict of pipeline fields, and announces the update.
+        If register is true, also adds the pipeline to the pipelines set.
+
+        Returns None if the report could not be sent.  Otherwise, returns
+        whether the pipeline's hash existed before report was stored; if it
+        didn't, only the fields in report are there now.
+        '''
 
-    def pipeline_report(self, pipeline_id, report):
         try:
-            with conn(self):
-                self.redis.hmset(pipeline_id, report)
-                self.redis.sadd('pipelines', pipeline_id)
-                self.redis.publish(self.pipeline_channel, pipeline_id)
+            with conn(self.endpoint):
+                pipe = self.redis.pipeline(transaction=False)
+                pipe.exists(pipeline_id)
+
+                for ident in heartbeats:
+                    pipe.hincrby(ident, 'heartbeat', 1)
+
+                if report:
+                    pipe.hmset(pipeline_id, report)
+                if register:
+                    pipe.sadd('pipelines', pipeline_id)
+
+                pipe.publish(self.pipeline_channel, pipeline_id)
+
+                return bool(pipe.execute()[0])
         except RedisConnectionError:
-            pass
+            return None
 
     def unregister_pipeline(self, pipeline_id):
         try:
-            with conn(self):
+            with conn(self.endpoint):
                 self.redis.delete(pipeline_id)
                 self.redis.srem('pipelines', pipeline_id)
                 self.redis.publish(self.pipeline_channel, pipeline_id)
@@ -214,77 +726,419 @@ class Control(object):
     # This function is a thread used to asynchronously ship logs to redis for
     # this job, in a daemonic thread
     def ship_logs(self):
-        shipping_count = 0
-
         logger.info('Started log shipper thread with ident={}, thread={}'
                     .format(self.ident, threading.get_ident()))
 
-        while not (self.ending and self.log_queue.empty()):
+        while not (self.ending and self.log_queue.empty() and not self.spool) \
+                and not self.drain_expired():
             try:
-                with conn(self):
-                    with self.redis.pipeline(transaction=False) as pipe:
-                        while not (self.ending and self.log_queue.empty()):
-                            try:
-                                # Ship a log entry
-                                try:
-                                    entry = self.log_queue.get(timeout=5)
-                                    with conn(self):
-                                        self.log_script(keys=entry['keys'], args=entry['args'], client=pipe)
-
-                                    shipping_count += 1
-
-                                    self.log_queue.task_done()
-
-                                except Empty:
-                                    pass #don't task_done() without tasks
-                                except RedisConnectionError:
-                                    # If we couldn't ship it due to redis being down, discard
-                                    self.log_queue.task_done()
-
-                                # If we have accreted enough or the queue is empty, commit logs and counts
-                                # The magic constant is necessary to resolve a race condition that might
-                                # prevent shipping
-                                if self.log_queue.empty() or shipping_count >= 64:
-                                    with conn(self):
-                                        # This locking structure is necessary to avoid a deadlock that
-                                        # happens when redis is trying to send while another thread is
-                                        # trying to acquire the lock
-                                        with self.countslock:
-                                            t_bytes_downloaded = self.bytes_downloaded_outstanding
-                                            self.bytes_downloaded_outstanding = 0
-                                            t_items_downloaded = self.items_downloaded_outstanding
-                                            self.items_downloaded_outstanding = 0
-                                            t_items_queued = self.items_queued_outstanding
-                                            self.items_queued_outstanding = 0
-
-                                        if t_bytes_downloaded > 0:
-                                            pipe.hincrby(self.ident, 'bytes_downloaded', t_bytes_downloaded)
-                                        if t_items_downloaded > 0:
-                                            pipe.hincrby(self.ident, 'items_downloaded', t_items_downloaded)
-                                        if t_items_queued > 0:
-                                            pipe.hincrby(self.ident, 'items_queued', t_items_queued)
-
-                                        pipe.execute()
-
-                                    shipping_count = 0
+                with conn(self.log_endpoint):
+                    with self.log_redis.pipeline(transaction=False) as pipe:
+                        while not (self.ending and self.log_queue.empty()
+                                   and not self.spool) \
+                                and not self.drain_expired():
+                            # Once anything is spooled, everything goes
+                            # through the spool until it is empty, so that
+                            # entries are shipped in order.
+                            spooling = bool(self.spool)
+
+                            if spooling:
+                                self.spill(self.take_queued())
+                                entries = [LogEntry.from_spooled(data) for data in
+                                           self.spool.peek(self.flush_policy.max_entries)]
+                            else:
+                                entries = self.next_log_batch()
+
+                            # Unless the log Redis is separate, log
+                            # entries and counts are shipped in one round
+                            # trip.
+                            ship_counts = not self.separate_log_redis()
 
+                            try:
+                                # If redis is down, log entries are
+                                # spooled, or discarded if there is no spool.
+                                with conn(self.log_endpoint):
+                                    jobs = self.queue_log_batch(pipe, entries)
+
+                                    if ship_counts:
+                                        counts = self.queue_counts(pipe)
+
+                                    start = time.monotonic()
+                                    results = pipe.execute(raise_on_error=False)
+
+                                # Redis may refuse some commands and carry
+                                # out the rest; only refused entries are
+                                # retried.
+                                refused, error, counts_shipped = \
+                                    self.check_flush(jobs, results)
+
+                                if ship_counts and counts_shipped:
+                                    self.shipped_counts = counts
+
+                                self.record_flush(
+                                    [entry for i, entry in enumerate(entries)
+                                     if i not in refused], start)
+                                self.settle_flush(entries, refused, error,
+                                                  spooling)
+                            except ResponseError as e:
+                                # Redis refused the batch as a whole.
+                                self.settle_flush(entries,
+                                                  set(range(len(entries))), e,
+                                                  spooling)
                             except RedisConnectionError:
                                 logger.info('Log shipper got connection error while '
                                             'incrementing counts or committing logs with '
                                             'ident={}, thread={}'.format(self.ident, threading.get_ident()))
+
+                                if spooling:
+                                    self.shipper_sleep(self.log_endpoint.reconnect_delay())
+                                else:
+                                    self.spill(entries)
+                            finally:
+                                if not spooling:
+                                    for _ in entries:
+                                        self.log_queue.task_done()
+
+                            if not ship_counts:
+                                self.ship_counts()
             except RedisError as e:
                 logger.info('Log shipper (ident={}, thread={}) got a Redis error: {!r}'.format(self.ident, threading.get_ident(), e))
+                self.shipper_sleep(self.log_endpoint.reconnect_delay())
+
+        self.close_spool()
 
         logger.info('Log shipper exiting with ident={}, thread={}'
                     .format(self.ident, threading.get_ident()))
         return True
 
+    def drain_expired(self):
+        return self.drain_deadline is not None and \
+            time.monotonic() >= self.drain_deadline
+
+    def shipper_sleep(self, seconds):
+        '''
+        Sleeps between log shipper retries, but not past the drain deadline.
+        Exit advice cuts a sleep short.
+        '''
+
+        if self.drain_deadline is None:
+            self.drain_requested.wait(seconds)
+        else:
+            time.sleep(max(0.0, min(seconds,
+                                    self.drain_deadline - time.monotonic())))
+
+    def close_spool(self):
+        '''
+        Counts entries still queued or spooled as dropped, closes the spool
+        and ships the counts one last time.
+        '''
+
+        left = len(self.take_queued())
+
+        if self.spool is not None:
+            left += len(self.spool)
+            self.spool.close()
+            self.spool = None
+
+        if left:
+            self.record_dropped(left)
+            self.ship_counts()
+
+    def ship_counts(self):
+        '''
+        Ships counts to the control Redis in a round trip of their own, at
+        most once per max_latency of the flush policy.  Used when log entries
+        go to a separate log Redis.
+        '''
+
+        now = time.monotonic()
+
+        if not self.ending and now - self.last_counts_shipped < self.flush_policy.max_latency:
+            return
+
+        self.last_counts_shipped = now
+
+        try:
+            with conn(self.endpoint):
+                self.shipped_counts = self.queue_counts(self.redis)
+        except RedisConnectionError:
+            logger.info('Log shipper got connection error while incrementing '
+                        'counts with ident={}, thread={}'.format(self.ident,
+                            threading.get_ident()))
+
+    def next_log_batch(self):
+        '''
+        Collects log entries to ship in one round trip, following
+        self.flush_policy.  Waits up to max_latency for a first entry, then
+        for more entries until the first has waited max_latency or the batch
+        reaches max_entries or max_bytes.  Returns an empty list if no
+        entries arrived; counts should still be shipped then.
+        '''
+
+        policy = self.flush_policy
+        entries = []
+        nbytes = 0
+
+        try:
+            entry = self.log_queue.get(timeout=policy.max_latency or None)
+        except Empty:
+            return entries
+
+        deadline = entry.queued_at + policy.max_latency
+
+        while True:
+            entries.append(entry)
+            nbytes += entry_size(entry, self.packet_codes)
+
+            if len(entries) >= policy.max_entries or nbytes >= policy.max_bytes:
+                break
+
+            timeout = deadline - time.monotonic()
+
+            try:
+                if timeout > 0:
+                    entry = self.log_queue.get(timeout=timeout)
+                else:
+                    entry = self.log_queue.get_nowait()
+            except Empty:
+                break
+
+        return entries
+
+    def take_queued(self):
+        '''
+        Takes every entry currently in the log queue, without waiting.
+        '''
+
+        entries = []
+
+        try:
+            while True:
+                entries.append(self.log_queue.get_nowait())
+                self.log_queue.task_done()
+        except Empty:
+            pass
+
+        return entries
+
+    def spill(self, entries):
+        '''
+        Writes entries that could not be shipped to the spool.  Without a
+        spool, or if the spool is full, they are dropped.
+        '''
+
+        if not entries:
+            return
+
+        if self.spool is None:
+            dropped = len(entries)
+        else:
+            dropped = self.spool.append([entry.spooled(self.packet_codes)
+                                         for entry in entries])
+            self.shipper_stats.spooled += len(entries) - dropped
+
+        if dropped:
+            self.record_dropped(dropped)
+
+    def check_flush(self, jobs, results):
+        '''
+        Goes through the results of a flush: those of the commands
+        queue_log_batch added for jobs, then those of queue_counts.  Returns
+        the positions of the entries Redis refused, the first refusal, and
+        whether the counts went through.
+        '''
+
+        refused = set()
+        errors = []
+
+        for positions, commands in jobs:
+            replies, results = results[:commands], results[commands:]
+
+            # The first command stores the entries; the others only bump
+            # the job's log score and announce it.
+            if isinstance(replies[0], ResponseError):
+                refused.update(positions)
+
+            errors.extend(reply for reply in replies
+                          if isinstance(reply, ResponseError))
+
+        counts_errors = [reply for reply in results
+                         if isinstance(reply, ResponseError)]
+
+        if counts_errors:
+            logger.warning('Redis refused counts with ident={}: {!r}'
+                           .format(self.ident, counts_errors[0]))
+
+        errors.extend(counts_errors)
+
+        return refused, errors[0] if errors else None, not counts_errors
+
+    def settle_flush(self, entries, refused, error, spooling):
+        '''
+        Finishes a flush of entries after Redis refused those at the
+        positions in refused.  From the spool, refused entries stay put to be
+        retried; otherwise they are spooled.
+        '''
+
+        if spooling:
+            if refused:
+                self.reject_spooled(refused, error)
+            else:
+                self.spool.commit()
+                self.spool_rejections = 0
+                self.rejection_backoff.succeeded()
+        elif refused:
+            self.spill([entries[i] for i in sorted(refused)])
+
+        if refused:
+            self.shipper_sleep(self.rejection_backoff.failed())
+
+    def reject_spooled(self, refused, error):
+        '''
+        Handles Redis refusing the entries at the positions in refused, out
+        of those returned by the spool's last peek().  The rest are removed
+        from the spool.  After SPOOL_BATCH_ATTEMPTS refusals in a row, the
+        refused entries are removed too and counted as dropped.
+        '''
+
+        self.spool_rejections += 1
+
+        logger.warning('Redis refused {} spooled log entries with ident={} '
+                       '({} of {} attempts): {!r}'.format(len(refused),
+                       self.ident, self.spool_rejections, SPOOL_BATCH_ATTEMPTS,
+                       error))
+
+        if self.spool_rejections >= SPOOL_BATCH_ATTEMPTS:
+            self.spool.commit()
+            self.spool_rejections = 0
+            self.record_dropped(len(refused))
+        else:
+            self.spool.commit(keep=refused)
+
+    def record_dropped(self, count):
+        '''
+        Counts log entries that were lost.  The count is added to the job's
+        log_entries_dropped field with the next flush.
+        '''
+
+        self.counters().log_entries_dropped += count
+        total = self.count_totals()['log_entries_dropped']
+
+        # Warn on the first drop, then once per thousand entries.
+        if total == count or (total - count) // 1000 != total // 1000:
+            logger.warning('Dropped {} log entries with ident={} ({} in total)'
+                           .format(count, self.ident, total))
+
+    def record_flush(self, entries, start):
+        '''
+        Updates shipper statistics after a flush that started at start, and
+        logs them every SHIPPER_STATS_INTERVAL seconds.
+        '''
+
+        now = time.monotonic()
+
+        self.shipper_stats.record_flush(
+            entries=len(entries),
+            nbytes=sum(entry_size(entry, self.packet_codes) for entry in entries),
+            latency=now - entries[0].queued_at if entries else 0.0,
+            round_trip=now - start,
+            queue_depth=self.log_queue.qsize()
+        )
+        self.shipper_stats.spool_depth = len(self.spool or ())
+
+        if now - self.last_shipper_stats >= SHIPPER_STATS_INTERVAL:
+            self.last_shipper_stats = now
+
+            stats = self.shipper_stats.as_dict()
+            stats['dropped'] = self.shipped_counts['log_entries_dropped']
+            stats['connections'] = self.endpoint.connection_stats.as_dict()
+
+            if self.separate_log_redis():
+                stats['log_connections'] = self.log_endpoint.connection_stats.as_dict()
+
+            logger.info('Log shipper statistics with ident={}: {}'.format(
+                self.ident, json.dumps(stats, sort_keys=True)))
+
+    def queue_log_batch(self, pipe, entries):
+        '''
+        Adds commands to pipe that ship entries.  Entries for the same job
+        are shipped together, by one call of LOGGER_BATCH_SCRIPT or, if
+        log_stream_maxlen is set, by queue_log_stream_batch.
+
+        Returns, for each job in the order its commands were added, the
+        positions of its entries in entries and the number of commands.
+        '''
+
+        batches = OrderedDict()
+
+        for i, entry in enumerate(entries):
+            key = (entry.ident, entry.log_channel, entry.log_key)
+            batches.setdefault(key, []).append(i)
+
+        jobs = []
+
+        for (ident, log_channel, log_key), positions in batches.items():
+            messages = [entries[i].encode(self.packet_codes)
+                        for i in positions]
+
+            if self.log_stream_maxlen is None:
+                self.log_batch_script(keys=[ident],
+                    args=[log_channel, log_key] + messages, client=pipe)
+                jobs.append((positions, 1))
+            else:
+                self.queue_log_stream_batch(pipe, ident, log_channel, log_key,
+                                            messages)
+                jobs.append((positions, 3))
+
+        return jobs
+
+    def queue_log_stream_batch(self, pipe, ident, log_channel, log_key, messages):
+        '''
+        Adds commands to pipe that append messages to a job's log stream as
+        one stream entry.  The entry's fields are the messages' positions in
+        the batch, so readers get them back in order.
+        '''
+
+        fields = []
+
+        for i, message in enumerate(messages):
+            fields.append(i)
+            fields.append(message)
+
+        pipe.execute_command('XADD', log_key, 'MAXLEN', '~',
+                             self.log_stream_maxlen, '*', *fields)
+        pipe.hincrby(ident, 'log_score', len(messages))
+        pipe.publish(log_channel, ident)
+
+    def queue_counts(self, pipe):
+        '''
+        Adds a command to pipe that ships counts accumulated since the last
+        successful flush.  Returns the totals the command brings the job up
+        to; set shipped_counts to them once pipe has been executed.
+        '''
+
+        totals = self.count_totals()
+        args = []
+
+        for field in COUNTER_FIELDS:
+            delta = totals[field] - self.shipped_counts[field]
+
+            if delta:
+                args.extend((field, delta))
+
+        if args:
+            self.counts_script(keys=[self.ident], args=args, client=pipe)
+
+        return totals
+
     def log(self, packet, ident, log_key):
+        '''
+        Queues packet, a dict or a DownloadPacket, for the log shipper.
+        '''
+
         try:
-            self.log_queue.put_nowait({'type': 'log',
-                'keys': [ident],
-                'args': [json.dumps(packet), self.log_channel, log_key]
-              })
+            self.log_queue.put_nowait(LogEntry(time.monotonic(), ident,
+                self.log_channel, log_key, packet))
         except Full:
             # If the shipping is currently broken, pop an entry off the queue and retry.
             try:
@@ -293,23 +1147,28 @@ class Control(object):
                 pass
             else:
                 self.log_queue.task_done()
+                self.record_dropped(1)
                 self.log(packet, ident, log_key)
 
     def get_url_file(self, ident):
         try:
-            with conn(self):
+            with conn(self.endpoint):
                 return self.redis.hget(ident, 'url_file')
         except RedisConnectionError:
             pass
 
-    def get_settings(self, ident):
-        with conn(self):
-            data = self.redis.hmget(ident, 'delay_min', 'delay_max',
-                                    'concurrency',
-                                    'settings_age',
-                                    'abort_requested',
-                                    'suppress_ignore_reports',
-                                    'ignore_patterns_set_key')
+    def get_settings(self, ident, ignore_patterns_version=None):
+        '''
+        Fetches a job's settings in one round trip.
+
+        The ignore pattern set is only transferred if its version differs
+        from ignore_patterns_version; otherwise, the ignore_patterns key of
+        the result is None.
+        '''
+
+        with conn(self.endpoint):
+            data = self.get_settings_script(keys=[ident],
+                    args=[ignore_patterns_version or ''])
 
             result = dict(
                 delay_min=data[0],
@@ -317,16 +1176,59 @@ class Control(object):
                 concurrency=data[2],
                 age=data[3],
                 abort_requested=data[4],
-                suppress_ignore_reports=data[5]
+                suppress_ignore_reports=data[5],
+                ignore_patterns_version=data[6],
+                ignore_patterns=data[7]
                 )
 
-            if data[6]:
-                result['ignore_patterns'] = self.redis.smembers(data[6])
-            else:
-                result['ignore_patterns'] = []
-
             return result
 
+class QueueWatcher(object):
+    '''
+    Listens for jobs being queued.  Once started, calls a function with the
+    name of each queue the backend queues a job to.  The function is called
+    from the watcher's own thread.
+
+    Announcements sent while the watcher is reconnecting are lost, so the
+    function is also called with None each time the watcher subscribes.
+    Reconnects are delayed with a Backoff.
+    '''
+
+    def __init__(self, redis_url, channel):
+        self.redis_url = redis_url
+        self.channel = channel
+        self.callback = None
+        self.thread = None
+        self.backoff = Backoff()
+
+    def start(self, callback):
+        self.callback = callback
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                r = redis.StrictRedis(
+                    connection_pool=connection_pool(self.redis_url))
+                p = r.pubsub(ignore_subscribe_messages=True)
+
+                try:
+                    p.subscribe(self.channel)
+                    self.backoff.succeeded()
+                    self.callback(None)
+
+                    for message in p.listen():
+                        self.callback(message['data'])
+                finally:
+                    # Hands the connection back to the pool.
+                    p.close()
+            except RedisError as e:
+                logger.info('Queue watcher got a Redis error: {!r}'.format(e))
+
+            time.sleep(self.backoff.failed())
+
 # ------------------------------------------------------------------------------
 
 MARK_DONE_SCRIPT = '''
@@ -348,18 +1250,20 @@ local was_aborted = redis.call('hget', ident, 'aborted')
 -- case of retrying an aborted job.
 if was_aborted then
     redis.call('incr', 'jobs_aborted')
-    redis.call('expire', ident, 5)
-    redis.call('expire', log_key, 5)
-    redis.call('expire', ident..'_ignores', 5)
+    expire_time = 5
 else
     redis.call('incr', 'jobs_completed')
-    redis.call('expire', ident, expire_time)
-    redis.call('expire', log_key, expire_time)
-    redis.call('expire', ident..'_ignores', expire_time)
 end
 
+redis.call('expire', ident, expire_time)
+redis.call('expire', log_key, expire_time)
+redis.call('expire', ident..'_ignores', expire_time)
+
 redis.call('rpush', 'finish_notifications', info)
 redis.call('publish', log_channel, ident)
+
+-- The expire time used, for Control.announce.
+return tonumber(expire_time)
 '''
 
 MARK_ABORTED_SCRIPT = '''
@@ -370,16 +1274,114 @@ redis.call('hset', ident, 'aborted', 'true')
 redis.call('publish', log_channel, ident)
 '''
 
-LOGGER_SCRIPT = '''
+LOGGER_BATCH_SCRIPT = '''
 local ident = KEYS[1]
-local message = ARGV[1]
-local log_channel = ARGV[2]
-local log_key = ARGV[3]
+local log_channel = ARGV[1]
+local log_key = ARGV[2]
+local count = #ARGV - 2
+
+-- Reserve a sequence number for each message.
+local lastseq = redis.call('hincrby', ident, 'log_score', count)
+local seq = lastseq - count
+
+-- ZADD in chunks, to stay within the limits of unpack().
+local chunk = 1000
+for first = 3, #ARGV, chunk do
+    local args = {}
 
-local nextseq = redis.call('hincrby', ident, 'log_score', 1)
+    for i = first, math.min(first + chunk - 1, #ARGV) do
+        seq = seq + 1
+        args[#args + 1] = seq
+        args[#args + 1] = ARGV[i]
+    end
+
+    redis.call('zadd', log_key, unpack(args))
+end
 
-redis.call('zadd', log_key, nextseq, message)
 redis.call('publish', log_channel, ident)
 '''
 
+RESERVE_JOB_SCRIPT = '''
+local pipeline_id = ARGV[1]
+local started_at = ARGV[2]
+local pipeline_nick = ARGV[3]
+local match_named = ARGV[4] == '1'
+
+local function reserve(queue)
+    local ident = redis.call('rpoplpush', queue, 'working')
+
+    if ident then
+        redis.call('hmset', ident, 'started_at', started_at,
+            'pipeline_id', pipeline_id)
+    end
+
+    return ident
+end
+
+-- Named queues go first.  A named queue applies to this pipeline if its
+-- name, less the pending: prefix, is part of the pipeline's nick.
+if match_named then
+    local prefix = string.len('pending:')
+
+    for _, queue in ipairs(redis.call('smembers', 'pending_queues')) do
+        local name = string.sub(queue, prefix + 1)
+
+        if string.find(pipeline_nick, name, 1, true) then
+            local ident = reserve(queue)
+
+            if ident then
+                return {ident, redis.call('hgetall', ident)}
+            end
+
+            -- The queue is empty; the backend registers it again when it
+            -- next queues a job there.
+            redis.call('srem', 'pending_queues', queue)
+        end
+    end
+end
+
+for i = 5, #ARGV do
+    local ident = reserve(ARGV[i])
+
+    if ident then
+        return {ident, redis.call('hgetall', ident)}
+    end
+end
+
+return false
+'''
+
+COUNTS_SCRIPT = '''
+local ident = KEYS[1]
+
+for i = 1, #ARGV, 2 do
+    redis.call('hincrby', ident, ARGV[i], ARGV[i + 1])
+end
+'''
+
+GET_SETTINGS_SCRIPT = '''
+local ident = KEYS[1]
+local known_version = ARGV[1]
+
+local data = redis.call('hmget', ident, 'delay_min', 'delay_max',
+    'concurrency', 'settings_age', 'abort_requested',
+    'suppress_ignore_reports', 'ignore_patterns_version',
+    'ignore_patterns_set_key')
+
+local version = data[7]
+local set_key = data[8]
+local patterns = {}
+
+-- Jobs queued before ignore sets were versioned have no version; always
+-- send their patterns.
+if version and version == known_version then
+    patterns = false
+elseif set_key then
+    patterns = redis.call('smembers', set_key)
+end
+
+return {data[1], data[2], data[3], data[4], data[5], data[6], version,
+    patterns}
+'''
+
 # vim:ts=4:sw=4:et:tw=78
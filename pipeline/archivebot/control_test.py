@@ -1,6 +1,61 @@
+import json
+import os
+import tempfile
+import threading
+import time
 import unittest
 
-from .control import candidate_queues
+import redis
+
+from redis.exceptions import (ConnectionError as RedisConnectionError,
+                              ResponseError)
+
+from .control import (Backoff, Control, DEFAULT_FLUSH_POLICY, DownloadPacket,
+                      Endpoint, FlushPolicy, LogEntry, SPOOL_BATCH_ATTEMPTS,
+                      ShipperStats, candidate_queues, conn, connection_pool,
+                      encode_packet, flush_policy_from_env)
+from .shared_config import config
+from .spool import LogSpool
+
+TEST_REDIS_URL = 'redis://localhost:6379/1'
+
+def make_control(**kwargs):
+    '''
+    Builds a Control that doesn't ship logs.  Its clients don't connect
+    until a command is sent.
+    '''
+
+    kwargs.setdefault('start_shipper', False)
+    control = Control(TEST_REDIS_URL, 'updates', 'pipeline', **kwargs)
+    control.ident = 'ident'
+
+    return control
+
+def script_pool():
+    '''
+    Returns a connection pool for a Redis that runs Lua scripts: fakeredis
+    if it is installed, otherwise the Redis at TEST_REDIS_URL, whose database
+    is emptied first.  Skips the calling test if neither is available.
+    '''
+
+    try:
+        import fakeredis
+        import lupa
+    except ImportError:
+        pass
+    else:
+        return redis.ConnectionPool(connection_class=fakeredis.FakeConnection,
+                                    server=fakeredis.FakeServer(),
+                                    decode_responses=True)
+
+    pool = redis.ConnectionPool.from_url(TEST_REDIS_URL, decode_responses=True)
+
+    try:
+        redis.StrictRedis(connection_pool=pool).flushdb()
+    except RedisConnectionError:
+        raise unittest.SkipTest('no Redis to run scripts on')
+
+    return pool
 
 class TestCandidateQueues(unittest.TestCase):
     def setUp(self):
@@ -24,3 +79,521 @@ class TestCandidateQueues(unittest.TestCase):
         queues = candidate_queues(self.named_queues, 'ovhca1-reddit-over18-55', True, large=False)
 
         self.assertEqual(set(['pending-ao']), set(queues))
+
+def log_entry(message, queued_at=None):
+    return LogEntry(time.monotonic() if queued_at is None else queued_at,
+                    'ident', 'log_channel', 'ident_log', None, message)
+
+class TestNextLogBatch(unittest.TestCase):
+    def setUp(self):
+        self.control = make_control(flush_policy=FlushPolicy(
+            max_entries=4, max_latency=0.05, max_bytes=100))
+
+    def test_returns_nothing_after_max_latency(self):
+        self.assertEqual([], self.control.next_log_batch())
+
+    def test_stops_at_max_entries(self):
+        for i in range(6):
+            self.control.log_queue.put(log_entry('x'))
+
+        self.assertEqual(4, len(self.control.next_log_batch()))
+        self.assertEqual(2, len(self.control.next_log_batch()))
+
+    def test_stops_at_max_bytes(self):
+        for i in range(3):
+            self.control.log_queue.put(log_entry('x' * 60))
+
+        self.assertEqual(2, len(self.control.next_log_batch()))
+
+    def test_does_not_wait_past_oldest_entry_deadline(self):
+        self.control.log_queue.put(log_entry('x', queued_at=time.monotonic() - 1))
+
+        start = time.monotonic()
+        self.assertEqual(1, len(self.control.next_log_batch()))
+        self.assertLess(time.monotonic() - start, 0.05)
+
+class TestFlushPolicy(unittest.TestCase):
+    def test_overrides_defaults_from_environment(self):
+        policy = flush_policy_from_env({'LOG_FLUSH_MAX_LATENCY': '2'})
+
+        self.assertEqual(2.0, policy.max_latency)
+        self.assertEqual(DEFAULT_FLUSH_POLICY.max_entries, policy.max_entries)
+
+class TestShipperStats(unittest.TestCase):
+    def test_buckets_batch_sizes_by_power_of_two(self):
+        stats = ShipperStats()
+
+        for size in (1, 3, 4, 5):
+            stats.record_flush(size, 10, 0.1, 0.01, 0)
+
+        self.assertEqual({1: 1, 4: 2, 8: 1}, stats.as_dict()['batch_sizes'])
+        self.assertEqual(5, stats.as_dict()['max_batch'])
+
+class TestSpill(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.control = make_control()
+        self.control.spool = LogSpool(os.path.join(self.dir.name, 'log_spool'), 300)
+
+    def tearDown(self):
+        self.control.spool.close()
+        self.dir.cleanup()
+
+    def test_spools_entries_behind_queued_ones(self):
+        self.control.spill([log_entry('a')])
+        self.control.log_queue.put(log_entry('b'))
+        self.control.spill(self.control.take_queued())
+
+        messages = [LogEntry.from_spooled(data).message
+                    for data in self.control.spool.peek(10)]
+
+        self.assertEqual(['a', 'b'], messages)
+        self.assertEqual(2, self.control.shipper_stats.spooled)
+
+    def test_counts_entries_dropped_when_spool_is_full(self):
+        self.control.spill([log_entry('x' * 100) for _ in range(3)])
+
+        dropped = 3 - len(self.control.spool)
+
+        self.assertGreater(dropped, 0)
+        self.assertEqual(dropped, self.control.count_totals()['log_entries_dropped'])
+
+    def test_counts_entries_dropped_without_a_spool(self):
+        self.control.spool.close()
+        self.control.spool = None
+        self.control.spill([log_entry('a'), log_entry('b')])
+
+        self.assertEqual(2, self.control.count_totals()['log_entries_dropped'])
+        self.control.spool = LogSpool(os.path.join(self.dir.name, 'log_spool'), 300)
+
+    def test_drops_a_spooled_batch_refused_too_often(self):
+        self.control.spill([log_entry('a'), log_entry('b'), log_entry('c')])
+        error = ResponseError('refused')
+
+        for _ in range(SPOOL_BATCH_ATTEMPTS - 1):
+            self.control.spool.peek(2)
+            self.control.reject_spooled({0, 1}, error)
+
+        self.assertEqual(3, len(self.control.spool))
+
+        self.control.spool.peek(2)
+        self.control.reject_spooled({0, 1}, error)
+
+        self.assertEqual(['c'], [LogEntry.from_spooled(data).message
+                                 for data in self.control.spool.peek(10)])
+        self.assertEqual(2, self.control.count_totals()['log_entries_dropped'])
+
+    def test_keeps_only_refused_entries_spooled(self):
+        self.control.spill([log_entry('a'), log_entry('b'), log_entry('c')])
+
+        self.control.spool.peek(3)
+        self.control.reject_spooled({1}, ResponseError('refused'))
+
+        self.assertEqual(['b'], [LogEntry.from_spooled(data).message
+                                 for data in self.control.spool.peek(10)])
+
+class TestAdviseExiting(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'log_spool')
+        # Nothing listens on port 1, so nothing can be shipped.
+        self.control = Control('redis://127.0.0.1:1/0', 'updates', 'pipeline',
+                               start_shipper=False)
+        self.control.spool = LogSpool(self.path, 1024 * 1024)
+        self.control.log_thread = threading.Thread(target=self.control.ship_logs)
+        self.control.log_thread.daemon = True
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_counts_unshipped_entries_as_dropped_and_closes_the_spool(self):
+        self.control.spill([log_entry('a'), log_entry('b')])
+        self.control.log_queue.put(log_entry('c'))
+        self.control.log_thread.start()
+
+        start = time.monotonic()
+        self.control.advise_exiting(timeout=0.5)
+
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertFalse(self.control.log_thread.is_alive())
+        self.assertEqual(3, self.control.count_totals()['log_entries_dropped'])
+        self.assertIsNone(self.control.spool)
+        self.assertFalse(os.path.exists(self.path))
+
+class TestLogEntry(unittest.TestCase):
+    def test_encodes_download_packet_like_a_dict(self):
+        packet = DownloadPacket(ts=1, url='http://example.com/', response_code=200,
+                                wget_code='RETRFINISHED', is_error=False, is_warning=False)
+        entry = LogEntry(0, 'ident', 'log_channel', 'ident_log', packet)
+
+        self.assertEqual(dict(packet._asdict(), type='download'), json.loads(entry.encode()))
+
+    def test_survives_spooling(self):
+        entry = LogEntry(1.5, 'ident', 'log_channel', 'ident_log', {'type': 'stdout'})
+        restored = LogEntry.from_spooled(json.loads(json.dumps(entry.spooled())))
+
+        self.assertEqual((1.5, 'ident', 'log_channel', 'ident_log', entry.message),
+                         (restored.queued_at, restored.ident, restored.log_channel,
+                          restored.log_key, restored.message))
+
+class TestCompactPackets(unittest.TestCase):
+    def setUp(self):
+        c = config()['log_packets']
+        self.codes = dict(keys=c['keys'], types=c['types'])
+
+    def test_shortens_keys_and_type(self):
+        packet = DownloadPacket(ts=1, url='http://example.com/', response_code=200,
+                                wget_code='OK', is_error=False, is_warning=False)
+
+        self.assertEqual(dict(y='d', t=1, u='http://example.com/', r=200, w='OK',
+                              e=False, a=False),
+                         json.loads(encode_packet(packet, self.codes)))
+
+    def test_keeps_unknown_keys_and_types(self):
+        packet = dict(type='ignore_stats', ts=1, checks=10)
+
+        self.assertEqual(dict(y='ignore_stats', t=1, checks=10),
+                         json.loads(encode_packet(packet, self.codes)))
+
+    def test_is_smaller(self):
+        packet = DownloadPacket(ts=1700000000.123456, url='http://example.com/',
+                                response_code=200, wget_code='OK',
+                                is_error=False, is_warning=False)
+
+        self.assertLess(len(encode_packet(packet, self.codes)),
+                        len(encode_packet(packet)) * 0.7)
+
+class RecordingPipeline(object):
+    def __init__(self):
+        self.commands = []
+
+    def execute_command(self, *args):
+        self.commands.append(args)
+
+    def hincrby(self, *args):
+        self.commands.append(('HINCRBY',) + args)
+
+    def publish(self, *args):
+        self.commands.append(('PUBLISH',) + args)
+
+class TestQueueLogStreamBatch(unittest.TestCase):
+    def setUp(self):
+        self.control = make_control(log_stream_maxlen=100)
+        self.pipe = RecordingPipeline()
+
+    def test_adds_one_stream_entry_per_job(self):
+        entries = [LogEntry(0, 'a', 'updates', 'a_log', None, 'one'),
+                   LogEntry(0, 'b', 'updates', 'b_log', None, 'two'),
+                   LogEntry(0, 'a', 'updates', 'a_log', None, 'three')]
+
+        self.control.queue_log_batch(self.pipe, entries)
+
+        self.assertEqual([
+            ('XADD', 'a_log', 'MAXLEN', '~', 100, '*', 0, 'one', 1, 'three'),
+            ('HINCRBY', 'a', 'log_score', 2),
+            ('PUBLISH', 'updates', 'a'),
+            ('XADD', 'b_log', 'MAXLEN', '~', 100, '*', 0, 'two'),
+            ('HINCRBY', 'b', 'log_score', 1),
+            ('PUBLISH', 'updates', 'b')
+        ], self.pipe.commands)
+
+class TestCounts(unittest.TestCase):
+    def setUp(self):
+        self.control = make_control()
+        self.control.counts_script = self.record_counts
+        self.shipped = []
+
+    def record_counts(self, keys, args, client):
+        self.shipped.append((keys, args))
+
+    def test_sums_counts_from_every_thread(self):
+        def count():
+            for _ in range(1000):
+                self.control.update_items_queued(1)
+
+        threads = [threading.Thread(target=count) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.control.update_items_queued(1)
+
+        self.assertEqual(4001, self.control.count_totals()['items_queued'])
+
+    def test_ships_changes_since_last_flush_in_one_call(self):
+        self.control.update_items_queued(5)
+        self.control.update_bytes_downloaded(100)
+        self.control.shipped_counts = self.control.queue_counts(None)
+
+        self.control.update_items_queued(2)
+        self.control.queue_counts(None)
+
+        self.assertEqual([
+            (['ident'], ['bytes_downloaded', 100, 'items_queued', 5]),
+            (['ident'], ['items_queued', 2])
+        ], self.shipped)
+
+    def test_reships_counts_after_a_failed_flush(self):
+        self.control.update_items_downloaded(3)
+        self.control.queue_counts(None)
+        self.control.queue_counts(None)
+
+        self.assertEqual(2, len(self.shipped))
+        self.assertEqual(self.shipped[0], self.shipped[1])
+
+    def test_ships_nothing_without_changes(self):
+        self.control.queue_counts(None)
+
+        self.assertEqual([], self.shipped)
+
+    def test_tells_apart_refused_counts_from_refused_entries(self):
+        error = ResponseError('refused')
+
+        self.assertEqual((set(), error, False),
+                         self.control.check_flush([([0], 1)], [1, error]))
+        self.assertEqual(({0}, error, True),
+                         self.control.check_flush([([0], 1)], [error, 1]))
+
+class TestBackoff(unittest.TestCase):
+    def test_doubles_up_to_the_cap(self):
+        backoff = Backoff(base=0.5, cap=4, random=lambda: 1.0)
+
+        self.assertEqual([0.5, 1, 2, 4, 4], [backoff.failed() for _ in range(5)])
+
+    def test_jitters_below_the_ceiling(self):
+        backoff = Backoff(base=0.5, cap=4, random=lambda: 0.25)
+        backoff.failed()
+
+        self.assertEqual(0.25, backoff.failed())
+
+    def test_resets_after_success(self):
+        backoff = Backoff(base=0.5, cap=4, random=lambda: 1.0)
+        backoff.failed()
+        backoff.failed()
+        backoff.succeeded()
+
+        self.assertEqual(0.5, backoff.failed())
+
+class TestConnectionPool(unittest.TestCase):
+    def test_shares_one_pool_per_url(self):
+        pool = connection_pool(TEST_REDIS_URL)
+
+        self.assertIs(pool, connection_pool(TEST_REDIS_URL))
+        self.assertIsNot(pool, connection_pool('redis://localhost:6379/2'))
+
+class TestEndpoint(unittest.TestCase):
+    def setUp(self):
+        self.endpoint = Endpoint(TEST_REDIS_URL, 'ident')
+        self.endpoint.backoff = Backoff(base=10, random=lambda: 1.0)
+
+    def fail(self):
+        with self.assertRaises(RedisConnectionError):
+            with conn(self.endpoint):
+                raise RedisConnectionError('lost')
+
+    def test_clients_share_the_process_pool(self):
+        self.endpoint.connect()
+
+        self.assertIs(connection_pool(self.endpoint.redis_url),
+                      self.endpoint.redis.connection_pool)
+
+    def test_refuses_to_reconnect_while_backing_off(self):
+        self.fail()
+
+        with self.assertRaises(RedisConnectionError):
+            self.endpoint.connect()
+
+        self.assertIsNone(self.endpoint.redis)
+        self.assertEqual(dict(connects=1, failures=1, refused=1),
+                         self.endpoint.connection_stats.as_dict())
+
+    def test_reconnects_once_the_backoff_has_passed(self):
+        self.fail()
+        self.endpoint.reconnect_at = time.monotonic() - 1
+
+        with conn(self.endpoint):
+            pass
+
+        self.assertIsNotNone(self.endpoint.redis)
+        self.assertEqual(0, self.endpoint.backoff.failures)
+
+    def test_stale_failures_do_not_extend_the_backoff(self):
+        self.endpoint.connect()
+        self.endpoint.connection_failed()
+        reconnect_at = self.endpoint.reconnect_at
+
+        self.endpoint.connection_failed()
+
+        self.assertEqual(reconnect_at, self.endpoint.reconnect_at)
+        self.assertEqual(1, self.endpoint.backoff.failures)
+
+class TestSeparateLogRedis(unittest.TestCase):
+    def test_registers_log_scripts_on_the_log_redis(self):
+        c = make_control(log_redis_url='redis://localhost:6379/2')
+
+        self.assertTrue(c.separate_log_redis())
+        self.assertIs(c.log_redis, c.log_batch_script.registered_client)
+        self.assertIs(c.redis, c.counts_script.registered_client)
+        self.assertIsNot(c.redis.connection_pool, c.log_redis.connection_pool)
+
+    def test_shares_the_control_redis_by_default(self):
+        c = make_control()
+
+        self.assertFalse(c.separate_log_redis())
+        self.assertIs(c.redis, c.log_batch_script.registered_client)
+
+    def test_log_redis_failures_do_not_hold_back_the_control_redis(self):
+        c = make_control(log_redis_url='redis://localhost:6379/2')
+
+        with self.assertRaises(RedisConnectionError):
+            with conn(c.log_endpoint):
+                raise RedisConnectionError('lost')
+
+        self.assertEqual(0, c.endpoint.reconnect_delay())
+        self.assertIsNotNone(c.redis)
+
+class TestGetSettingsScript(unittest.TestCase):
+    def setUp(self):
+        self.control = make_control(pool=script_pool())
+        self.redis = self.control.redis
+        self.redis.hmset('job', {'delay_min': '0', 'delay_max': '0',
+                                 'ignore_patterns_version': 'v2',
+                                 'ignore_patterns_set_key': 'job_ignores'})
+        self.redis.sadd('job_ignores', 'foo', 'bar')
+
+    def test_sends_patterns_of_a_new_version(self):
+        settings = self.control.get_settings('job', 'v1')
+
+        self.assertEqual('v2', settings['ignore_patterns_version'])
+        self.assertEqual(['bar', 'foo'], sorted(settings['ignore_patterns']))
+
+    def test_sends_no_patterns_for_a_known_version(self):
+        settings = self.control.get_settings('job', 'v2')
+
+        self.assertEqual('v2', settings['ignore_patterns_version'])
+        self.assertIsNone(settings['ignore_patterns'])
+
+    def test_always_sends_patterns_of_unversioned_jobs(self):
+        self.redis.hdel('job', 'ignore_patterns_version')
+        settings = self.control.get_settings('job', '')
+
+        self.assertIsNone(settings['ignore_patterns_version'])
+        self.assertEqual(['bar', 'foo'], sorted(settings['ignore_patterns']))
+
+class TestLogBatchScript(unittest.TestCase):
+    def setUp(self):
+        self.control = make_control(pool=script_pool())
+        self.redis = self.control.log_redis
+
+    def ship(self, entries):
+        pipe = self.redis.pipeline(transaction=False)
+        self.control.queue_log_batch(pipe, entries)
+        pipe.execute()
+
+    def log(self, ident):
+        return self.redis.zrange(ident + '_log', 0, -1, withscores=True)
+
+    def entries(self, ident, messages):
+        return [LogEntry(0, ident, 'updates', ident + '_log', None, message)
+                for message in messages]
+
+    def test_reports_entries_of_refused_jobs_only(self):
+        self.redis.set('b', 'not a hash')
+        entries = (self.entries('a', ['one']) + self.entries('b', ['two']) +
+                   self.entries('a', ['three']))
+
+        pipe = self.redis.pipeline(transaction=False)
+        jobs = self.control.queue_log_batch(pipe, entries)
+        refused, error, counts_shipped = self.control.check_flush(
+            jobs, pipe.execute(raise_on_error=False))
+
+        self.assertEqual({1}, refused)
+        self.assertIsInstance(error, ResponseError)
+        self.assertTrue(counts_shipped)
+        self.assertEqual([('one', 1), ('three', 2)], self.log('a'))
+
+    def test_ships_batches_larger_than_a_chunk(self):
+        messages = ['message %d' % i for i in range(2500)]
+        self.ship(self.entries('a', messages))
+
+        self.assertEqual([(m, i + 1) for i, m in enumerate(messages)],
+                         self.log('a'))
+        self.assertEqual('2500', self.redis.hget('a', 'log_score'))
+
+    def test_ships_several_jobs_in_one_batch(self):
+        self.ship(self.entries('a', ['one']) + self.entries('b', ['two']) +
+                  self.entries('a', ['three']))
+
+        self.assertEqual([('one', 1), ('three', 2)], self.log('a'))
+        self.assertEqual([('two', 1)], self.log('b'))
+        self.assertEqual('2', self.redis.hget('a', 'log_score'))
+        self.assertEqual('1', self.redis.hget('b', 'log_score'))
+
+    def test_continues_log_scores_across_batches(self):
+        self.ship(self.entries('a', ['one', 'two']))
+        self.ship(self.entries('a', ['three']))
+
+        self.assertEqual([('one', 1), ('two', 2), ('three', 3)], self.log('a'))
+
+class TestReserveJobScript(unittest.TestCase):
+    def setUp(self):
+        self.control = make_control(pool=script_pool())
+        self.redis = self.control.redis
+
+    def queue(self, queue, ident):
+        self.redis.hset(ident, 'url', 'http://example.com/' + ident)
+        self.redis.lpush(queue, ident)
+
+    def test_reserves_from_matching_named_queue_first(self):
+        self.queue('pending', 'plain')
+        self.queue('pending:ovhca1', 'named')
+        self.redis.sadd('pending_queues', 'pending:ovhca1', 'pending:other')
+
+        ident, job = self.control.reserve_job('p1', 'ovhca1-47', False, False)
+
+        self.assertEqual('named', ident)
+        self.assertEqual('http://example.com/named', job['url'])
+        self.assertEqual('p1', job['pipeline_id'])
+        self.assertIn('started_at', job)
+
+    def test_unregisters_empty_named_queues(self):
+        self.queue('pending', 'plain')
+        self.redis.sadd('pending_queues', 'pending:ovhca1', 'pending:other')
+
+        ident, _ = self.control.reserve_job('p1', 'ovhca1-47', False, False)
+
+        self.assertEqual('plain', ident)
+        self.assertEqual(set(['pending:other']),
+                         self.redis.smembers('pending_queues'))
+
+    def test_moves_reserved_jobs_to_working(self):
+        self.queue('pending', 'a')
+        self.queue('pending', 'b')
+
+        self.control.reserve_job('p1', 'p1', False, False)
+        self.control.reserve_job('p2', 'p2', False, False)
+
+        self.assertEqual(['b', 'a'], self.redis.lrange('working', 0, -1))
+        self.assertEqual(0, self.redis.llen('pending'))
+
+    def test_returns_nothing_when_every_queue_is_empty(self):
+        self.redis.sadd('pending_queues', 'pending:ovhca1')
+
+        self.assertEqual((None, None),
+                         self.control.reserve_job('p1', 'ovhca1-47', False, False))
+        self.assertEqual(0, self.redis.llen('working'))
+
+class TestReport(unittest.TestCase):
+    def setUp(self):
+        self.control = make_control(pool=script_pool())
+        self.redis = self.control.redis
+
+    def test_tells_whether_the_pipeline_hash_existed(self):
+        self.assertFalse(self.control.report('pipeline:1', dict(ts=1), ['job'], True))
+        self.assertTrue(self.control.report('pipeline:1', dict(ts=2), ['job'], False))
+
+        self.redis.delete('pipeline:1')
+
+        self.assertFalse(self.control.report('pipeline:1', dict(ts=3), [], False))
+        self.assertEqual('2', self.redis.hget('job', 'heartbeat'))
@@ -1,4 +1,3 @@
-import functools
 import hashlib
 import os
 import socket
@@ -20,25 +19,58 @@ def pipeline_id():
     return (pid, hostname, fqdn, 'pipeline:%s' % m.hexdigest())
 
 
-def start(pipeline, control, version, nickname):
-    pid, hostname, fqdn, pipe_id = pipeline_id()
+class Reporter(object):
+    '''
+    Reports on this pipeline and keeps its jobs' heartbeats going.  Once
+    per interval, the heartbeats of all running jobs and the fields of the
+    pipeline report that changed are sent to the control server in one
+    round trip.  The whole report is sent every full_report_interval seconds,
+    after a failed report, and right away if the pipeline's hash turns out
+    to be missing, e.g. because the backend removed it.
+    '''
 
-    def report():
+    interval = 1
+    full_report_interval = 60
+
+    def __init__(self, control, version, nickname):
+        self.control = control
+        self.version = version
+        self.nickname = nickname
+        self.pid, self.hostname, self.fqdn, self.pipeline_id = pipeline_id()
+        self.pipeline = None
+        self.heartbeats = set()
+        self.last_report = {}
+        self.last_full_report = None
+
+    def add_heartbeat(self, ident):
+        self.heartbeats.add(ident)
+
+    def remove_heartbeat(self, ident):
+        self.heartbeats.discard(ident)
+
+    def start(self, pipeline):
+        self.pipeline = pipeline
+        self.report()
+
+        cb = tornado.ioloop.PeriodicCallback(self.report, self.interval * 1000)
+        cb.start()
+
+    def process_report(self):
         # If the data dir doesn't exist yet, recurse up the path to the deepest path that does exist.
-        dudir = os.path.normpath(pipeline.data_dir)
+        dudir = os.path.normpath(self.pipeline.data_dir)
         while not os.path.isdir(dudir):
             dudir = os.path.dirname(dudir)
         du = psutil.disk_usage(dudir)
         mu = psutil.virtual_memory()
         load_avg = os.getloadavg()
 
-        process_report = {
-            'id': pipe_id,
-            'hostname': hostname,
-            'nickname': nickname,
-            'fqdn': fqdn,
-            'pid': pid,
-            'version': version,
+        return {
+            'id': self.pipeline_id,
+            'hostname': self.hostname,
+            'nickname': self.nickname,
+            'fqdn': self.fqdn,
+            'pid': self.pid,
+            'version': self.version,
             'mem_usage': mu.percent,
             'mem_available': mu.available,
             'disk_usage': du.percent,
@@ -48,13 +80,39 @@ def start(pipeline, control, version, nickname):
             'load_average_15m': load_avg[2],
             'ts': int(time.time()),
             'python': sys.version,
-            'status': pipeline.running_status,
+            'status': self.pipeline.running_status,
         }
 
-        control.pipeline_report(pipe_id, process_report)
+    def report(self):
+        report = self.process_report()
+        now = time.monotonic()
+        full = self.last_full_report is None or \
+            now - self.last_full_report >= self.full_report_interval
+
+        if full:
+            changes = report
+        else:
+            changes = dict((k, v) for k, v in report.items()
+                           if self.last_report.get(k) != v)
+
+        existed = self.control.report(self.pipeline_id, changes,
+                                      self.heartbeats, register=full)
+
+        if existed is None:
+            self.last_full_report = None
+            return
+
+        self.last_report = report
 
-    report()
-    cb = tornado.ioloop.PeriodicCallback(report, 1000)
-    cb.start()
+        if full:
+            self.last_full_report = now
+        elif not existed:
+            # Only the changed fields made it into the new hash; fill in the
+            # rest.  The heartbeats have been beaten already.
+            if self.control.report(self.pipeline_id, report, (),
+                                   register=True) is None:
+                self.last_full_report = None
+            else:
+                self.last_full_report = now
 
 # vim:ts=4:sw=4:et:tw=78
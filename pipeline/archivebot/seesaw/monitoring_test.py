@@ -0,0 +1,62 @@
+import unittest
+
+from .monitoring import Reporter
+
+class RecordingControl(object):
+    def __init__(self):
+        self.reports = []
+        self.up = True
+        self.exists = False
+
+    def report(self, pipeline_id, report, heartbeats, register):
+        self.reports.append((dict(report), set(heartbeats), register))
+
+        if not self.up:
+            return None
+
+        existed, self.exists = self.exists, True
+
+        return existed
+
+class TestReporter(unittest.TestCase):
+    def setUp(self):
+        self.control = RecordingControl()
+        self.reporter = Reporter(self.control, 'version', 'nick')
+        self.fields = dict(id='pipeline:1', ts=1, status='Running')
+        self.reporter.process_report = lambda: dict(self.fields)
+
+    def test_sends_full_report_first(self):
+        self.reporter.report()
+
+        self.assertEqual([(self.fields, set(), True)], self.control.reports)
+
+    def test_sends_only_changed_fields_with_heartbeats(self):
+        self.reporter.report()
+        self.reporter.add_heartbeat('job1')
+        self.fields['ts'] = 2
+        self.reporter.report()
+
+        self.assertEqual((dict(ts=2), set(['job1']), False), self.control.reports[-1])
+
+    def test_sends_full_report_after_a_failure(self):
+        self.reporter.report()
+        self.control.up = False
+        self.reporter.report()
+        self.control.up = True
+        self.reporter.report()
+
+        self.assertEqual((self.fields, set(), True), self.control.reports[-1])
+
+    def test_fills_in_a_missing_pipeline_hash(self):
+        self.reporter.report()
+        self.reporter.add_heartbeat('job1')
+        self.control.exists = False
+        self.fields['ts'] = 2
+        self.reporter.report()
+
+        self.assertEqual([(dict(ts=2), set(['job1']), False),
+                          (self.fields, set(), True)], self.control.reports[1:])
+
+        self.reporter.report()
+
+        self.assertEqual(({}, set(['job1']), False), self.control.reports[-1])
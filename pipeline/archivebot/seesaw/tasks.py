@@ -12,10 +12,11 @@ import socket
 from seesaw.externalprocess import WgetDownload
 from seesaw.task import Task, SimpleTask
 from tornado.ioloop import IOLoop
-import tornado.ioloop
 
 from redis.exceptions import ConnectionError
 
+from ..control import candidate_queues
+
 
 class CheckIP(SimpleTask):
     def __init__(self):
@@ -78,10 +79,11 @@ class RetryableTask(Task):
         item.log_output('Starting %s for %s' % (self, item.description()))
         self.process(item)
 
-    def schedule_retry(self, item):
+    def schedule_retry(self, item, delay=None):
         item.may_be_canceled = self.cancelable
 
-        IOLoop.instance().add_timeout(datetime.timedelta(seconds=self.retry_delay),
+        return IOLoop.instance().add_timeout(
+               datetime.timedelta(seconds=delay or self.retry_delay),
                functools.partial(self.retry, item))
 
     def retry(self, item):
@@ -100,8 +102,21 @@ class RetryableTask(Task):
 # ------------------------------------------------------------------------------
 
 class GetItemFromQueue(RetryableTask):
+    '''
+    Reserves a job for an item.  If no job is available, the item waits
+    until the queue watcher, if given, announces a job in a queue this
+    pipeline takes work from, or until idle_retry_delay seconds pass.
+
+    The watcher also wakes every waiting item whenever it (re)subscribes,
+    since announcements sent while it was reconnecting are lost.  The long
+    poll only catches jobs left in a queue by another pipeline.
+    '''
+
+    # Seconds an item waits for a job when the queue watcher is running.
+    idle_retry_delay = 30
+
     def __init__(self, control, pipeline_id, pipeline_nick, retry_delay=5,
-        ao_only=False, large=False, version_check = None):
+        ao_only=False, large=False, version_check = None, queue_watcher=None):
         RetryableTask.__init__(self, 'GetItemFromQueue')
         self.control = control
         self.pipeline_id = pipeline_id
@@ -113,6 +128,13 @@ class GetItemFromQueue(RetryableTask):
         self.large = large
         # (versionOnStartup, versionFunc) where the latter is an argument-less function returning the current version of the files
         self.version_on_startup, self.version_func = version_check
+        # (item, timeout handle) for each item waiting for a job
+        self.waiting = []
+
+        if queue_watcher:
+            queue_watcher.start(self.job_queued)
+        else:
+            self.idle_retry_delay = retry_delay
 
     def process(self, item):
         # Check that the files haven't changed since the pipeline was launched
@@ -126,7 +148,7 @@ class GetItemFromQueue(RetryableTask):
                     self.pipeline_nick, self.ao_only, self.large)
 
             if ident == None:
-                self.schedule_retry(item)
+                self.wait_for_job(item)
             else:
                 item['fetch_depth'] = job_data.get('fetch_depth')
                 item['ident'] = ident
@@ -149,24 +171,42 @@ class GetItemFromQueue(RetryableTask):
             self.notify_connection_error(item)
             self.schedule_retry(item)
 
+    def wait_for_job(self, item):
+        timeout = self.schedule_retry(item, self.idle_retry_delay)
+        self.waiting.append((item, timeout))
+
+    def retry(self, item):
+        self.waiting = [(i, t) for i, t in self.waiting if i is not item]
+
+        RetryableTask.retry(self, item)
+
+    def job_queued(self, queue):
+        # Called from the queue watcher's thread.  None means the watcher
+        # has just (re)subscribed and may have missed announcements.
+        if queue is None or queue in candidate_queues([queue], self.pipeline_nick,
+                                     self.ao_only, self.large):
+            IOLoop.instance().add_callback(self.wake_waiting)
+
+    def wake_waiting(self):
+        waiting, self.waiting = self.waiting, []
+
+        for item, timeout in waiting:
+            IOLoop.instance().remove_timeout(timeout)
+            RetryableTask.retry(self, item)
+
 # ------------------------------------------------------------------------------
 
 class StartHeartbeat(SimpleTask):
-    def __init__(self, control):
+    def __init__(self, reporter):
         SimpleTask.__init__(self, 'StartHeartbeat')
-        self.control = control
+        self.reporter = reporter
 
     def process(self, item):
-        cb = tornado.ioloop.PeriodicCallback(
-                functools.partial(self.send_heartbeat, item),
-                1000)
-
-        item['heartbeat'] = cb
+        # The reporter beats every running job's heartbeat along with the
+        # pipeline report.
+        self.reporter.add_heartbeat(item['ident'])
 
-        cb.start()
-
-    def send_heartbeat(self, item):
-        self.control.heartbeat(item['ident'])
+        item['heartbeat'] = item['ident']
 
 # ------------------------------------------------------------------------------
 
@@ -383,12 +423,13 @@ class DownloadUrlFile(RetryableTask):
 # ------------------------------------------------------------------------------
 
 class StopHeartbeat(SimpleTask):
-    def __init__(self):
+    def __init__(self, reporter):
         SimpleTask.__init__(self, 'StopHeartbeat')
+        self.reporter = reporter
 
     def process(self, item):
         if 'heartbeat' in item:
-            item['heartbeat'].stop()
+            self.reporter.remove_heartbeat(item['heartbeat'])
             del item['heartbeat']
         else:
             item.log_output("Warning: couldn't find a heartbeat to stop")
@@ -0,0 +1,89 @@
+import datetime
+import threading
+import time
+import unittest
+
+from seesaw.item import Item
+from tornado.ioloop import IOLoop
+
+from .tasks import GetItemFromQueue
+
+class QueueControl(object):
+    '''
+    Stands in for Control: has a job to hand out once queued is set.
+    '''
+
+    def __init__(self):
+        self.queued = False
+
+    def reserve_job(self, pipeline_id, pipeline_nick, ao_only, large):
+        if self.queued:
+            return 'ident', dict(url='http://example.com/')
+
+        return None, None
+
+class ManualQueueWatcher(object):
+    def start(self, callback):
+        self.callback = callback
+
+class TestGetItemFromQueue(unittest.TestCase):
+    def setUp(self):
+        self.loop = IOLoop.instance()
+        self.control = QueueControl()
+        self.watcher = ManualQueueWatcher()
+        self.task = GetItemFromQueue(self.control, 'pipeline:1', 'nick',
+                version_check=('1', lambda: '1'), queue_watcher=self.watcher)
+        self.task.on_complete_item.handle(lambda task, item: self.loop.stop())
+        self.item = Item(None, '1', 1, prepare_data_directory=False)
+
+    def tearDown(self):
+        IOLoop.clear_instance()
+        self.loop.close(all_fds=True)
+
+    def run_loop(self, seconds):
+        self.loop.add_timeout(datetime.timedelta(seconds=seconds), self.loop.stop)
+        self.loop.start()
+
+    def test_announced_job_cuts_the_wait_short(self):
+        self.task.enqueue(self.item)
+        self.assertEqual(1, len(self.task.waiting))
+
+        self.control.queued = True
+        start = time.monotonic()
+        # The watcher calls back from its own thread.
+        threading.Thread(target=self.watcher.callback, args=('pending',)).start()
+        self.run_loop(self.task.retry_delay)
+
+        self.assertEqual('ident', self.item['ident'])
+        self.assertLess(time.monotonic() - start, self.task.retry_delay)
+        self.assertEqual([], self.task.waiting)
+
+    def test_ignores_queues_of_other_pipelines(self):
+        self.task.enqueue(self.item)
+
+        self.control.queued = True
+        self.watcher.callback('pending:other')
+        self.run_loop(0.2)
+
+        self.assertNotIn('ident', self.item.properties)
+        self.assertEqual(1, len(self.task.waiting))
+
+    def test_resubscribing_wakes_waiting_items(self):
+        self.task.enqueue(self.item)
+
+        self.control.queued = True
+        self.watcher.callback(None)
+        self.run_loop(self.task.retry_delay)
+
+        self.assertEqual('ident', self.item['ident'])
+        self.assertEqual([], self.task.waiting)
+
+    def test_waits_longer_with_a_queue_watcher(self):
+        self.task.retry_delay = 0.1
+        self.task.enqueue(self.item)
+
+        self.control.queued = True
+        self.run_loop(0.5)
+
+        self.assertNotIn('ident', self.item.properties)
+        self.assertEqual(1, len(self.task.waiting))
@@ -22,6 +22,11 @@ def pipeline_channel():
 
     return c['channels']['pipeline']
 
+def queue_channel():
+    c = config()
+
+    return c['channels']['queue']
+
 def job_channel(ident):
     return '%s%s' % (job_channel_prefix(), ident)
 
@@ -30,4 +35,30 @@ def job_channel_prefix():
 
     return c['channels']['job_prefix']
 
+def log_packet_codes():
+    '''
+    Returns the short codes to encode log packets with, or None if log
+    packets are to be written as plain JSON.
+    '''
+
+    c = config()['log_packets']
+
+    if c['encoding'] != 'compact':
+        return None
+
+    return dict(keys=c['keys'], types=c['types'])
+
+def log_stream_maxlen():
+    '''
+    Returns the approximate number of batches to keep in a job's log stream,
+    or None if job logs are kept in sorted sets.
+    '''
+
+    c = config()
+
+    if c['log_backend'] != 'stream':
+        return None
+
+    return c['log_stream_maxlen']
+
 # vim:ts=4:sw=4:et:tw=78
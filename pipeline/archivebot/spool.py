@@ -0,0 +1,146 @@
+import json
+import os
+import struct
+
+# Each record is a big-endian length followed by that many bytes of JSON.
+HEADER = struct.Struct('>I')
+
+# Bytes moved at a time when compacting.
+COPY_CHUNK = 1024 * 1024
+
+class LogSpool(object):
+    '''
+    A bounded, append-only file of log entries.  The log shipper keeps
+    entries here while Redis is unreachable and ships them, in the order
+    they were appended, once it comes back.
+
+    Entries that would take the file past max_bytes are dropped and counted.
+    The file is truncated whenever every entry in it has been shipped, and
+    compacted once shipped entries take up more than compact_bytes, so that
+    a spool that never quite drains doesn't fill up with them.
+
+    A LogSpool must only be used from one thread.
+    '''
+
+    def __init__(self, path, max_bytes, compact_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.compact_bytes = (max_bytes // 2 if compact_bytes is None
+                              else compact_bytes)
+        self.file = open(path, 'w+b')
+        self.read_offset = 0
+        self.write_offset = 0
+        self.entries = 0
+        self.dropped = 0
+        self.peeked = None
+
+    def __len__(self):
+        return self.entries
+
+    def append(self, entries):
+        '''
+        Appends entries to the spool.  Returns the number of entries that
+        were dropped because the spool is full.
+        '''
+
+        dropped = 0
+        self.file.seek(self.write_offset)
+
+        for entry in entries:
+            data = json.dumps(entry).encode('utf-8')
+            size = HEADER.size + len(data)
+
+            if self.write_offset + size > self.max_bytes:
+                dropped += 1
+                continue
+
+            self.file.write(HEADER.pack(len(data)))
+            self.file.write(data)
+            self.write_offset += size
+            self.entries += 1
+
+        self.file.flush()
+        self.dropped += dropped
+
+        return dropped
+
+    def peek(self, max_entries):
+        '''
+        Returns up to max_entries of the oldest entries in the spool without
+        removing them.  Call commit() once they have been shipped.
+        '''
+
+        entries = []
+        records = []
+        offset = self.read_offset
+        self.file.seek(offset)
+
+        while len(entries) < max_entries and offset < self.write_offset:
+            header = self.file.read(HEADER.size)
+            length, = HEADER.unpack(header)
+            data = self.file.read(length)
+            entries.append(json.loads(data.decode('utf-8')))
+            records.append(header + data)
+            offset += HEADER.size + length
+
+        self.peeked = (offset, records)
+
+        return entries
+
+    def commit(self, keep=()):
+        '''
+        Removes the entries returned by the last call of peek(), except
+        those at the positions in keep, which stay at the head of the spool
+        in the order they were appended.
+        '''
+
+        if self.peeked is None:
+            return
+
+        self.read_offset, records = self.peeked
+        kept = b''.join(records[i] for i in sorted(set(keep)))
+        self.entries -= len(records) - len(set(keep))
+        self.peeked = None
+
+        if kept:
+            # The kept records came from just before read_offset, so they
+            # fit there again.
+            self.read_offset -= len(kept)
+            self.file.seek(self.read_offset)
+            self.file.write(kept)
+            self.file.flush()
+
+        if self.read_offset == self.write_offset:
+            self.file.truncate(0)
+            self.read_offset = self.write_offset = 0
+        elif self.read_offset > self.compact_bytes:
+            self.compact()
+
+    def compact(self):
+        '''
+        Moves the entries not yet shipped to the start of the file and
+        discards the rest.
+        '''
+
+        remaining = self.write_offset - self.read_offset
+        copied = 0
+
+        # The destination always lies before the source, so copying forwards
+        # never overwrites bytes that are still to be copied.
+        while copied < remaining:
+            self.file.seek(self.read_offset + copied)
+            chunk = self.file.read(min(COPY_CHUNK, remaining - copied))
+            self.file.seek(copied)
+            self.file.write(chunk)
+            copied += len(chunk)
+
+        self.file.truncate(remaining)
+        self.file.flush()
+        self.read_offset = 0
+        self.write_offset = remaining
+
+    def close(self):
+        self.file.close()
+        os.remove(self.path)
+
+# vim: ts=4:sw=4:et:tw=78
@@ -0,0 +1,84 @@
+import os
+import tempfile
+import unittest
+
+from .control import LogEntry
+from .spool import LogSpool
+
+def entry(message):
+    return LogEntry(0, 'ident', 'channel', 'ident_log', None, message).spooled()
+
+class TestLogSpool(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.spool = LogSpool(os.path.join(self.dir.name, 'log_spool'), 1024)
+
+    def tearDown(self):
+        self.spool.close()
+        self.dir.cleanup()
+
+    def test_returns_entries_in_order(self):
+        self.spool.append([entry('a'), entry('b')])
+        self.spool.append([entry('c')])
+
+        self.assertEqual([entry('a'), entry('b')], self.spool.peek(2))
+        self.spool.commit()
+        self.assertEqual([entry('c')], self.spool.peek(2))
+
+    def test_keeps_entries_until_committed(self):
+        self.spool.append([entry('a'), entry('b')])
+
+        self.spool.peek(1)
+        self.assertEqual([entry('a')], self.spool.peek(1))
+        self.assertEqual(2, len(self.spool))
+
+    def test_keeps_chosen_entries_at_the_head(self):
+        self.spool.append([entry('a'), entry('b'), entry('c'), entry('d')])
+
+        self.spool.peek(3)
+        self.spool.commit(keep=[2, 0])
+
+        self.assertEqual(3, len(self.spool))
+        self.assertEqual([entry('a'), entry('c'), entry('d')], self.spool.peek(10))
+
+    def test_truncates_once_drained(self):
+        self.spool.append([entry('a')])
+        self.spool.peek(10)
+        self.spool.commit()
+
+        self.assertEqual(0, len(self.spool))
+        self.assertEqual(0, os.path.getsize(self.spool.path))
+
+    def test_drops_entries_past_max_bytes(self):
+        dropped = self.spool.append([entry('x' * 400) for _ in range(3)])
+
+        self.assertEqual(1, dropped)
+        self.assertEqual(1, self.spool.dropped)
+        self.assertEqual(2, len(self.spool))
+        self.assertLessEqual(os.path.getsize(self.spool.path), 1024)
+
+    def test_compacts_once_shipped_entries_pass_the_threshold(self):
+        spool = LogSpool(os.path.join(self.dir.name, 'compacted'), 1024, 100)
+        spool.append([entry('x' * 40) for _ in range(2)] + [entry('y')])
+
+        spool.peek(1)
+        spool.commit()
+        size = os.path.getsize(spool.path)
+
+        spool.peek(1)
+        spool.commit()
+
+        self.assertLess(os.path.getsize(spool.path), size)
+        self.assertEqual([entry('y')], spool.peek(10))
+
+        spool.append([entry('z')])
+        self.assertEqual([entry('y'), entry('z')], spool.peek(10))
+        spool.close()
+
+    def test_compaction_makes_room_for_new_entries(self):
+        self.spool.append([entry('x' * 290) for _ in range(3)])
+        self.spool.peek(2)
+        self.spool.commit()
+
+        self.assertEqual(0, self.spool.append([entry('x' * 290)]))
+        self.assertEqual(2, len(self.spool))
@@ -0,0 +1,231 @@
+'''guard: keep pathologically slow ignore patterns away from the crawler
+
+Python's regex engine backtracks, so a pattern like (a+)+b can take
+exponential time on an input like aaaaaaaaaaaaaaaaaaaaaaaaaaaa!.  Since
+patterns run on wpull's event loop, one such pattern stalls the whole job.
+
+Patterns are assessed twice over: statically, for constructs known to
+backtrack super-linearly, and empirically, by timing the pattern against
+synthetic worst-case URLs of increasing length.  The timing decides; static
+findings only make the length ladder finer, so that an exponential pattern
+is caught before an input long enough to hang the assessment.
+'''
+
+import re
+import time
+
+from collections import namedtuple
+
+try:
+    from re import _parser as sre_parse
+    from re import _constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
+# A single evaluation of a pattern slower than this gets it quarantined.  This
+# is generous: polynomial patterns like .*\..*\..*\.pl are slow on long URLs
+# but tolerable, whereas exponential ones blow through any budget.
+TIME_BUDGET = 0.25
+
+# Total time an assessment may spend evaluating a pattern.  A pattern that
+# slows down as the input grows can run through this long before any single
+# evaluation reaches TIME_BUDGET; it is quarantined all the same.
+TOTAL_BUDGET = 1.0
+
+# Input lengths to try, shortest first.  Short lengths go up in small steps
+# so that exponential blowup is noticed well before an input long enough to
+# hang the assessment; flagged patterns take even smaller steps.  Longer
+# lengths catch polynomial blowup on long URLs.
+LONG_LENGTHS = (96, 128, 192, 256, 384, 512, 768, 1024)
+COARSE_LENGTHS = tuple(range(4, 64, 4)) + LONG_LENGTHS
+FINE_LENGTHS = tuple(range(2, 64, 2)) + LONG_LENGTHS
+
+URL_HOST = 'www.example.com'
+URL_PREFIX = 'http://' + URL_HOST + '/'
+
+_REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+_MAXREPEAT = sre_constants.MAXREPEAT
+
+Assessment = namedtuple('Assessment', [
+    'constructs',   # list of descriptions of suspicious constructs
+    'seconds',      # slowest evaluation observed
+    'sample',       # input that took that long
+    'total',        # seconds spent evaluating the pattern altogether
+    'slow'          # whether the pattern went over either budget
+])
+
+def _subpatterns(op, av):
+    '''
+    Yields the nested subpatterns of a parsed item.
+    '''
+
+    if op in _REPEATS:
+        yield av[2]
+    elif op == sre_constants.SUBPATTERN:
+        yield av[-1]
+    elif op == sre_constants.BRANCH:
+        for alternative in av[1]:
+            yield alternative
+    elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+        yield av[1]
+
+def _has_variable_repeat(items):
+    for op, av in items:
+        if op in _REPEATS and av[1] == _MAXREPEAT and av[0] != av[1]:
+            return True
+
+        for sub in _subpatterns(op, av):
+            if _has_variable_repeat(sub):
+                return True
+
+    return False
+
+def _first_literal(items):
+    items = list(items)
+
+    if items and items[0][0] == sre_constants.LITERAL:
+        return items[0][1]
+
+    return None
+
+def _overlapping_branch(items):
+    '''
+    Whether items (optionally wrapped in a group) contain an alternation
+    whose alternatives might start with the same character.  The parser
+    factors common prefixes out of alternatives, so a|ab shows up as an
+    a followed by an alternation with an empty alternative.
+    '''
+
+    items = list(items)
+
+    if len(items) == 1 and items[0][0] == sre_constants.SUBPATTERN:
+        items = list(items[0][1][-1])
+
+    for op, av in items:
+        if op != sre_constants.BRANCH:
+            continue
+
+        firsts = [_first_literal(alternative) for alternative in av[1]]
+
+        if None in firsts or len(set(firsts)) != len(firsts):
+            return True
+
+    return False
+
+def _walk(items, constructs):
+    for op, av in items:
+        if op in _REPEATS:
+            low, high, body = av
+
+            if high > 1 and _has_variable_repeat(body):
+                constructs.append('nested quantifier')
+
+            if high == _MAXREPEAT and _overlapping_branch(body):
+                constructs.append('quantified overlapping alternation')
+
+        for sub in _subpatterns(op, av):
+            _walk(sub, constructs)
+
+def superlinear_constructs(compiled):
+    '''
+    Returns a list of descriptions of constructs in a compiled pattern that
+    are known to cause super-linear backtracking.  An empty list doesn't mean
+    the pattern is fast, and a non-empty one doesn't mean it's slow.
+    '''
+
+    try:
+        parsed = sre_parse.parse(compiled.pattern, compiled.flags)
+    except (re.error, TypeError):
+        return []
+
+    constructs = []
+    _walk(parsed, constructs)
+
+    return sorted(set(constructs))
+
+def _literal_chars(items, chars):
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            chars.add(chr(av))
+
+        for sub in _subpatterns(op, av):
+            _literal_chars(sub, chars)
+
+def attack_alphabet(compiled):
+    '''
+    Returns the characters used to build worst-case inputs for a pattern:
+    its own literal characters plus a few that are common in URLs.
+    '''
+
+    chars = set('a1/%=&.')
+
+    try:
+        _literal_chars(sre_parse.parse(compiled.pattern, compiled.flags), chars)
+    except (re.error, TypeError):
+        pass
+
+    return sorted(chars)
+
+def worst_case_inputs(alphabet, length):
+    '''
+    Yields synthetic URLs whose path is length characters long and made of
+    long runs of the alphabet, each ending in a character unlikely to let a
+    pattern finish matching.
+    '''
+
+    for ch in alphabet:
+        yield URL_PREFIX + ch * length + '!'
+
+    yield URL_PREFIX + (''.join(alphabet) * length)[:length] + '!'
+    yield URL_PREFIX + ('a/' * length)[:length]
+
+def assess(compiled, time_budget=TIME_BUDGET, total_budget=TOTAL_BUDGET):
+    '''
+    Times a compiled pattern against worst-case inputs of increasing length,
+    stopping as soon as one evaluation exceeds time_budget or all of them
+    together exceed total_budget.  Returns an Assessment; the pattern should
+    be quarantined if it is slow.
+    '''
+
+    constructs = superlinear_constructs(compiled)
+    alphabet = attack_alphabet(compiled)
+    lengths = FINE_LENGTHS if constructs else COARSE_LENGTHS
+
+    slowest = 0.0
+    sample = None
+    total = 0.0
+
+    for length in lengths:
+        for url in worst_case_inputs(alphabet, length):
+            start = time.perf_counter()
+            compiled.search(url)
+            elapsed = time.perf_counter() - start
+            total += elapsed
+
+            if elapsed > slowest:
+                slowest = elapsed
+                sample = url
+
+            if slowest > time_budget or total > total_budget:
+                return Assessment(constructs, slowest, sample, total, True)
+
+    return Assessment(constructs, slowest, sample, total, False)
+
+def describe(assessment):
+    '''
+    Returns a short, human-readable explanation of an Assessment.
+    '''
+
+    reason = 'took %.3f s on a %d-character URL' % (
+        assessment.seconds, len(assessment.sample or ''))
+
+    if assessment.total > assessment.seconds:
+        reason += ', %.3f s in total' % assessment.total
+
+    if assessment.constructs:
+        reason += ' (%s)' % ', '.join(assessment.constructs)
+
+    return reason
+
+# vim: ts=4:sw=4:et:tw=78
@@ -0,0 +1,48 @@
+import re
+import unittest
+
+from .guard import assess, attack_alphabet, describe, superlinear_constructs
+
+class TestSuperlinearConstructs(unittest.TestCase):
+    def test_flags_nested_quantifiers(self):
+        self.assertEqual(['nested quantifier'], superlinear_constructs(re.compile('(a+)+b')))
+        self.assertEqual(['nested quantifier'], superlinear_constructs(re.compile('([^/]+\\.)+com')))
+
+    def test_flags_quantified_overlapping_alternations(self):
+        self.assertEqual(['quantified overlapping alternation'], superlinear_constructs(re.compile('(a|a)*b')))
+        self.assertEqual(['quantified overlapping alternation'], superlinear_constructs(re.compile('(a|ab)*c')))
+
+    def test_does_not_flag_ordinary_patterns(self):
+        self.assertEqual([], superlinear_constructs(re.compile('^https?://www\\.example\\.com/.+/login')))
+        self.assertEqual([], superlinear_constructs(re.compile('(foo|bar)+/')))
+        self.assertEqual([], superlinear_constructs(re.compile('/(.*)/(\\1/){3,}')))
+
+class TestAttackAlphabet(unittest.TestCase):
+    def test_includes_pattern_literals(self):
+        self.assertIn('z', attack_alphabet(re.compile('(z+)+!')))
+
+class TestAssess(unittest.TestCase):
+    def test_stops_at_the_time_budget(self):
+        assessment = assess(re.compile('(a+)+b'), 0.005)
+
+        self.assertTrue(assessment.slow)
+        self.assertGreater(assessment.seconds, 0.005)
+        self.assertIn('aaaa', assessment.sample)
+
+    def test_stops_at_the_total_budget(self):
+        assessment = assess(re.compile('(a+)+b'), 10, 0.01)
+
+        self.assertTrue(assessment.slow)
+        self.assertGreater(assessment.total, 0.01)
+        self.assertLess(assessment.total, 1)
+
+    def test_passes_ordinary_patterns(self):
+        assessment = assess(re.compile('bar/.+/baz'), 0.05)
+
+        self.assertFalse(assessment.slow)
+        self.assertLess(assessment.seconds, 0.05)
+
+    def test_describe_mentions_constructs(self):
+        assessment = assess(re.compile('(a+)+b'), 0.005)
+
+        self.assertIn('nested quantifier', describe(assessment))
@@ -1,44 +1,61 @@
 '''ignoracle: hold and check URLs against ignore patterns
 '''
 
+import functools
 import re
 import sys
 import threading
+import time
+
+from collections import OrderedDict, namedtuple
 
 from urllib.parse import urlparse
 
 import wpull
 import wpull.pipeline.item
 
-def parameterize_record_info(record_info: wpull.pipeline.item.URLRecord):
+from . import guard
+from .matcher import PatternSet
+
+PrimaryInfo = namedtuple('PrimaryInfo', ['primary_url', 'primary_netloc'])
+
+NO_PRIMARY_INFO = PrimaryInfo(None, None)
+
+# Number of primary URLs whose PrimaryInfo is remembered.  Most URLs in a
+# recursive crawl share a handful of parents.
+PRIMARY_INFO_CACHE_SIZE = 1024
+
+@functools.lru_cache(maxsize=PRIMARY_INFO_CACHE_SIZE)
+def primary_info(primary_url):
+    '''
+    Returns the PrimaryInfo for a primary URL.  Results are cached, so the
+    same tuple is returned for the same URL.
     '''
-    Given a wpull record_info dict, generates a dict with primary_url and
-    primary_netloc keys.  This is meant to be used in Ignoracle.ignores.
 
-    The primary_url key is generally the URL the job was started with, or a
-    URL from a URL list.
+    return PrimaryInfo(primary_url, urlparse(primary_url).netloc)
 
-    If primary_url is a valid URL, the primary_netloc key is the network
-    location component of primary_url (i.e. for HTTP,
-    [user:password@]host[:port]).  Otherwise, primary_netloc is None.
+def parameterize_record_info(record_info: wpull.pipeline.item.URLRecord):
     '''
+    Given a wpull URLRecord, returns a PrimaryInfo tuple of primary_url and
+    primary_netloc.  This is meant to be used in Ignoracle.ignores.
 
-    primary_url = None
-    primary_netloc = None
+    primary_url is generally the URL the job was started with, or a URL from
+    a URL list.
+
+    If primary_url is a valid URL, primary_netloc is the network location
+    component of primary_url (i.e. for HTTP, [user:password@]host[:port]).
+    Otherwise, primary_netloc is None.
+    '''
 
     if record_info.level == 0:
         primary_url = record_info.url
     else:
         primary_url = record_info.parent_url
 
-    if primary_url:
-        parsed = urlparse(primary_url)
-        primary_netloc = parsed.netloc
+    if not primary_url:
+        return NO_PRIMARY_INFO
 
-    return dict(
-        primary_url=primary_url,
-        primary_netloc=primary_netloc
-    )
+    return primary_info(primary_url)
 
 
 '''
@@ -47,6 +64,48 @@ these as positional parameters.
 '''
 pos_placeholders = ['{}'] * 256
 
+def is_parameterized(pattern):
+    '''
+    Returns whether pattern contains a {primary_url} or {primary_netloc}
+    placeholder, i.e. whether its compiled form depends on the primary URL.
+    '''
+
+    return '{primary_url}' in pattern or '{primary_netloc}' in pattern
+
+def compile_pattern(pattern, escapedPrimaryUrl='', escapedPrimaryNetloc=''):
+    '''
+    Expands placeholders in pattern and compiles it.  Returns None (and
+    complains on stderr) if the pattern is invalid.
+    '''
+
+    try:
+        expanded = pattern.replace('{primary_url}', escapedPrimaryUrl)
+        expanded = expanded.replace('{primary_netloc}', escapedPrimaryNetloc)
+        return re.compile(expanded)
+    except re.error as error:
+        print('Pattern %s is invalid (error: %s).  Ignored.'
+              % (pattern, str(error)), file=sys.stderr)
+        return None
+
+# Approximate per-entry overhead of a cached verdict: the key tuple, the
+# OrderedDict node and the string headers.
+VERDICT_OVERHEAD = 256
+
+def verdict_cost(key):
+    '''
+    Estimates the memory, in bytes, held by a verdict cache entry.
+    '''
+
+    return VERDICT_OVERHEAD + len(key[0]) + len(key[1]) + len(key[2])
+
+IgnoreState = namedtuple('IgnoreState', [
+    'generation',               # bumped whenever the pattern set changes
+    'patterns',                 # tuple of all patterns, in ordinal order
+    'static',                   # PatternSet of patterns without placeholders
+    'parameterized_patterns',   # tuple of (ordinal, pattern) with placeholders
+    'quarantined'               # tuple of patterns left out for being too slow
+])
+
 class Ignoracle(object):
     '''
     An Ignoracle tests a URL against a list of patterns and returns whether or
@@ -56,33 +115,368 @@ class Ignoracle(object):
     '''
 
     # Note that set_patterns() is called from a different thread than ignores().
-    # The lock prevents race conditions on iteration over self._compiled.
-
-    patterns = []
+    #
+    # set_patterns() compiles everything it can and publishes the result as a
+    # new, immutable IgnoreState in self._state.  ignores() reads
+    # self._state exactly once per call and never takes a lock, so the hot
+    # path can't be held up by a settings update.  The lock only serializes
+    # writers.
+    #
+    # Each pattern gets an ordinal when it is first added; matching order is
+    # ordinal order, so a pattern keeps its place (and its compiled forms)
+    # across updates that add or remove other patterns.
+    #
+    # Patterns without placeholders are compiled once, kept in self._regexes,
+    # and combined into the state's static PatternSet.  Parameterized
+    # patterns depend on the primary URL and netloc, so their compiled forms
+    # are kept in a bounded LRU keyed by (primary_url, primary_netloc).  Both
+    # are PatternSets, which prefilter patterns by their required literals so
+    # that only a handful of regexes run per URL.
+    #
+    # Every URL is checked at least twice (accept_url and handle_result), so
+    # verdicts are also remembered in a bounded LRU keyed by (url,
+    # primary_url, primary_netloc, generation).
+    #
+    # Both LRUs belong to the thread calling ignores().  They are emptied
+    # when that thread first sees a state they don't belong to, so a verdict
+    # computed against an old pattern list can never be returned for a new
+    # one.
+    #
+    # For pattern_stats(), every match is counted against the pattern that
+    # made it.  Evaluation time is only measured on every
+    # stats_sample_interval-th uncached check (0 turns timing off), so the
+    # common path pays for a counter increment and nothing else.  These
+    # counters also belong to the thread calling ignores().
+    #
+    # Each pattern is assessed by guard.assess() when it is first added.  A
+    # pattern that takes longer than time_budget on a synthetic worst-case
+    # URL is quarantined: it stays in the pattern list, but is never matched.
+    # on_quarantine, if set, is called as on_quarantine(pattern, assessment)
+    # from the thread calling set_patterns().
 
-    def __init__(self):
-        self._primary = None
-        self._compiled = []
+    def __init__(self, cache_size=256, verdict_cache_size=65536,
+                 verdict_cache_bytes=16 * 1024 * 1024, stats_sample_interval=64,
+                 time_budget=guard.TIME_BUDGET):
+        self._state = IgnoreState(0, (), PatternSet([]), (), ())
         self._lock = threading.Lock()
 
+        # Writer-side state; guarded by self._lock.
+        self._ordinals = {}
+        self._next_ordinal = 0
+        self._regexes = {}
+        self._quarantined = {}
+
+        self.time_budget = time_budget
+        self.on_quarantine = None
+
+        # Reader-side state; only touched by ignores().
+        self._parameterized = OrderedDict()
+        self._parameterized_source = ()
+        self._verdicts = OrderedDict()
+        self._verdict_bytes = 0
+        self._verdict_generation = 0
+
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        self.verdict_cache_size = verdict_cache_size
+        self.verdict_cache_bytes = verdict_cache_bytes
+        self.verdict_hits = 0
+        self.verdict_misses = 0
+
+        self.stats_sample_interval = stats_sample_interval
+        self._checks = 0
+        self._hits = {}
+        self._evaluations = {}
+        self._seconds = {}
+
+    @property
+    def patterns(self):
+        return self._state.patterns
+
+    @property
+    def generation(self):
+        return self._state.generation
+
+    @property
+    def quarantined(self):
+        return self._state.quarantined
+
     def set_patterns(self, strings):
         '''
         Given a list of strings, replaces this Ignoracle's pattern state with
         that list.
+
+        Only the difference from the current pattern set is applied: compiled
+        forms of retained patterns are kept, and if the set is unchanged
+        nothing is invalidated at all.
         '''
 
-        patterns = []
+        # New patterns get their ordinals in the order they are listed, so
+        # the first matching pattern doesn't depend on string hashing.
+        patterns = OrderedDict()
 
         for string in strings:
             if isinstance(string, bytes):
                 string = string.decode('utf-8')
 
-            patterns.append(string)
+            patterns[string] = None
+
+        quarantined = []
 
         with self._lock:
-            self.patterns = patterns
-            self._primary = None
-            # Don't replace _compiled here; _primary acts as a trigger for the recompilation.
+            state = self._state
+
+            if set(patterns) == set(state.patterns):
+                return
+
+            for pattern in set(self._ordinals) - set(patterns):
+                del self._ordinals[pattern]
+                self._regexes.pop(pattern, None)
+                self._quarantined.pop(pattern, None)
+
+            for pattern in [p for p in patterns if p not in self._ordinals]:
+                self._ordinals[pattern] = self._next_ordinal
+                self._next_ordinal += 1
+
+                assessment = self._admit(pattern)
+
+                if assessment:
+                    quarantined.append((pattern, assessment))
+
+            ordered = tuple(sorted(patterns, key=self._ordinals.get))
+            admitted = tuple(pattern for pattern in ordered
+                             if pattern not in self._quarantined)
+
+            parameterized_patterns = tuple((self._ordinals[pattern], pattern)
+                for pattern in admitted if is_parameterized(pattern))
+
+            # Keep the same object if nothing changed, so that readers keep
+            # their cache of compiled parameterized patterns.
+            if parameterized_patterns == state.parameterized_patterns:
+                parameterized_patterns = state.parameterized_patterns
+
+            self._state = IgnoreState(
+                generation=state.generation + 1,
+                patterns=ordered,
+                static=self._compile_static(admitted),
+                parameterized_patterns=parameterized_patterns,
+                quarantined=tuple(pattern for pattern in ordered
+                                  if pattern in self._quarantined)
+            )
+
+        if self.on_quarantine:
+            for pattern, assessment in quarantined:
+                self.on_quarantine(pattern, assessment)
+
+    def _admit(self, pattern):
+        '''
+        Assesses a newly added pattern.  Returns its Assessment if it has been
+        quarantined, None otherwise.
+
+        Must be called with self._lock held.
+        '''
+
+        if is_parameterized(pattern):
+            # Assess a representative expansion; the primary URL is escaped
+            # and so can't make a pattern much slower.
+            regex = compile_pattern(pattern,
+                                    re.escape(guard.URL_PREFIX),
+                                    re.escape(guard.URL_HOST))
+        else:
+            regex = self._regexes[pattern] = compile_pattern(pattern)
+
+        if regex is None or self.time_budget is None:
+            return None
+
+        assessment = guard.assess(regex, self.time_budget)
+
+        if assessment.slow:
+            print('Pattern %s is too slow (%s).  Quarantined.'
+                  % (pattern, guard.describe(assessment)), file=sys.stderr)
+            self._quarantined[pattern] = assessment
+            return assessment
+
+        if assessment.constructs:
+            print('Pattern %s contains %s and may be slow on some URLs.'
+                  % (pattern, ', '.join(assessment.constructs)), file=sys.stderr)
+
+        return None
+
+    def _compile_static(self, patterns):
+        '''
+        Must be called with self._lock held.
+        '''
+
+        compiled = []
+
+        for pattern in patterns:
+            if is_parameterized(pattern):
+                continue
+
+            if pattern in self._regexes:
+                regex = self._regexes[pattern]
+            else:
+                # Invalid patterns are remembered as None so that they are
+                # reported once, not on every update.
+                regex = self._regexes[pattern] = compile_pattern(pattern)
+
+            if regex:
+                compiled.append((self._ordinals[pattern], pattern, regex))
+
+        return PatternSet(compiled)
+
+    def _compile_parameterized(self, parameterized_patterns, primaryUrl,
+                               primaryNetloc):
+        compiled = []
+        escapedPrimaryUrl = re.escape(primaryUrl)
+        escapedPrimaryNetloc = re.escape(primaryNetloc)
+
+        for index, pattern in parameterized_patterns:
+            regex = compile_pattern(pattern, escapedPrimaryUrl,
+                                    escapedPrimaryNetloc)
+
+            if regex:
+                compiled.append((index, pattern, regex))
+
+        return PatternSet(compiled)
+
+    def _parameterized_set(self, state, primaryUrl, primaryNetloc):
+        '''
+        Returns the parameterized PatternSet of state for a primary URL and
+        netloc, compiling it if it isn't cached.
+        '''
+
+        if not state.parameterized_patterns:
+            return None
+
+        if self._parameterized_source is not state.parameterized_patterns:
+            self._parameterized.clear()
+            self._parameterized_source = state.parameterized_patterns
+
+        key = (primaryUrl, primaryNetloc)
+        parameterized = self._parameterized.get(key)
+
+        if parameterized is not None:
+            self._parameterized.move_to_end(key)
+            self.cache_hits += 1
+        else:
+            parameterized = self._compile_parameterized(
+                state.parameterized_patterns, primaryUrl, primaryNetloc)
+            self._parameterized[key] = parameterized
+            self.cache_misses += 1
+
+            while len(self._parameterized) > self.cache_size:
+                self._parameterized.popitem(last=False)
+
+        return parameterized
+
+    def _remember_verdict(self, key, verdict):
+        '''
+        Caches verdict under key, evicting the least recently used verdicts
+        to stay within the entry and byte limits.
+        '''
+
+        if key in self._verdicts:
+            return
+
+        self._verdicts[key] = verdict
+        self._verdict_bytes += verdict_cost(key)
+
+        while self._verdicts and (
+                len(self._verdicts) > self.verdict_cache_size
+                or self._verdict_bytes > self.verdict_cache_bytes):
+            evicted, _ = self._verdicts.popitem(last=False)
+            self._verdict_bytes -= verdict_cost(evicted)
+
+    def _timed_first_match(self, pattern_set, url, limit=None):
+        '''
+        Like PatternSet.first_match, but records how long each evaluated
+        pattern took.
+        '''
+
+        for entry in pattern_set.candidates(url):
+            index, pattern, compiled = entry
+
+            if limit is not None and index >= limit:
+                break
+
+            start = time.perf_counter()
+            found = compiled.search(url)
+            elapsed = time.perf_counter() - start
+
+            self._evaluations[pattern] = self._evaluations.get(pattern, 0) + 1
+            self._seconds[pattern] = self._seconds.get(pattern, 0.0) + elapsed
+
+            if found:
+                return entry
+
+        return None
+
+    def pattern_stats(self):
+        '''
+        Returns a dict describing how often each current pattern matched and
+        how much time was spent evaluating it in sampled checks:
+
+            checks: number of uncached checks
+            sample_interval: one in this many checks was timed
+            patterns: list of dicts with pattern, hits, evaluations (sampled)
+                and seconds (sampled), costliest first
+
+        Must be called from the thread calling ignores().
+        '''
+
+        patterns = [dict(
+            pattern=pattern,
+            hits=self._hits.get(pattern, 0),
+            evaluations=self._evaluations.get(pattern, 0),
+            seconds=self._seconds.get(pattern, 0.0)
+        ) for pattern in self._state.patterns]
+
+        patterns.sort(key=lambda p: (p['seconds'], p['hits']), reverse=True)
+
+        return dict(
+            checks=self._checks,
+            sample_interval=self.stats_sample_interval,
+            patterns=patterns
+        )
+
+    def pattern_summary(self, top=5):
+        '''
+        Returns a bounded summary of pattern_stats():
+
+            checks, sample_interval: as in pattern_stats
+            patterns: number of current patterns
+            dead: number of patterns that never matched
+            costliest: up to top patterns with sampled time, costliest first,
+                as dicts with pattern, seconds (sampled) and hits
+            most_hits: up to top patterns that matched, most hits first, as
+                dicts with pattern and hits
+
+        Must be called from the thread calling ignores().
+        '''
+
+        stats = self.pattern_stats()
+        patterns = stats['patterns']
+
+        costliest = [dict(pattern=p['pattern'], seconds=p['seconds'],
+                          hits=p['hits'])
+                     for p in patterns[:top] if p['seconds'] > 0]
+
+        matched = sorted((p for p in patterns if p['hits']),
+                         key=lambda p: p['hits'], reverse=True)
+        most_hits = [dict(pattern=p['pattern'], hits=p['hits'])
+                     for p in matched[:top]]
+
+        return dict(
+            checks=stats['checks'],
+            sample_interval=stats['sample_interval'],
+            patterns=len(patterns),
+            dead=sum(1 for p in patterns if not p['hits']),
+            costliest=costliest,
+            most_hits=most_hits
+        )
 
     def ignores(self, url_record: wpull.pipeline.item.URLRecord):
         '''
@@ -90,33 +484,48 @@ class Ignoracle(object):
         Otherwise, returns False.
         '''
 
-        params = parameterize_record_info(url_record)
-
-        primaryUrl = params.get('primary_url') or ''
-        primaryNetloc = params.get('primary_netloc') or ''
-        if self._primary != (primaryUrl, primaryNetloc):
-            with self._lock:
-                self._compiled = []
-                escapedPrimaryUrl = re.escape(primaryUrl)
-                escapedPrimaryNetloc = re.escape(primaryNetloc)
-                for pattern in self.patterns:
-                    try:
-                        expanded = pattern.replace('{primary_url}', escapedPrimaryUrl)
-                        expanded = expanded.replace('{primary_netloc}', escapedPrimaryNetloc)
-                        compiledPattern = re.compile(expanded)
-                    except re.error as error:
-                        print('Pattern %s is invalid (error: %s).  Ignored.'
-                              % (pattern, str(error)), file=sys.stderr)
-                    self._compiled.append((pattern, compiledPattern))
-                self._primary = (primaryUrl, primaryNetloc)
-
-        for pattern, compiled in self._compiled:
-            match = compiled.search(url_record.url)
-
-            if match:
-                return pattern
-
-        return False
+        state = self._state
+
+        if self._verdict_generation != state.generation:
+            self._verdicts.clear()
+            self._verdict_bytes = 0
+            self._verdict_generation = state.generation
+
+        primaryUrl, primaryNetloc = parameterize_record_info(url_record)
+        primaryUrl = primaryUrl or ''
+        primaryNetloc = primaryNetloc or ''
+        url = url_record.url
+
+        key = (url, primaryUrl, primaryNetloc, state.generation)
+        verdict = self._verdicts.get(key)
+
+        if verdict is not None:
+            self._verdicts.move_to_end(key)
+            self.verdict_hits += 1
+            return verdict
+
+        self.verdict_misses += 1
+        self._checks += 1
+
+        parameterized = self._parameterized_set(state, primaryUrl, primaryNetloc)
+
+        if self.stats_sample_interval and \
+                self._checks % self.stats_sample_interval == 0:
+            match = self._timed_first_match(parameterized, url) if parameterized else None
+            match = self._timed_first_match(state.static, url, limit=match[0] if match else None) or match
+        else:
+            match = parameterized.first_match(url) if parameterized else None
+            match = state.static.first_match(url, limit=match[0] if match else None) or match
+
+        if match:
+            verdict = match[1]
+            self._hits[verdict] = self._hits.get(verdict, 0) + 1
+        else:
+            verdict = False
+
+        self._remember_verdict(key, verdict)
+
+        return verdict
 
 # vim: ts=4:sw=4:et:tw=78
 
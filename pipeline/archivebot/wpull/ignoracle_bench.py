@@ -0,0 +1,69 @@
+'''
+Microbenchmark for the Ignoracle hot path.
+
+Run from the pipeline directory:
+
+    python3 -m archivebot.wpull.ignoracle_bench
+
+For each stage of an ignore check, prints the time per call and the peak
+memory allocated during a single call.  A stage that allocates nothing on
+its cached path should show 0 bytes.
+'''
+
+import tracemalloc
+
+from .ignoracle import Ignoracle, parameterize_record_info
+from ..bench import Record, per_call
+
+PATTERNS = [
+    '[\\?&]replytocom=',
+    '/(.*)/(\\1/){3,}',
+    '^https?://www\\.example\\.com/[^/]+/photos/',
+    '{primary_netloc}/notes/[0-9]+/',
+    '[?&]oldid=\\d+(&|$)'
+]
+
+PARENTS = ['http://www.example.com/%d/' % i for i in range(16)]
+
+RECORDS = [Record('http://www.example.com/%d/page/%d' % (i % 16, i), 1,
+                  PARENTS[i % 16]) for i in range(4096)]
+
+NUMBER = 100000
+
+def peak_bytes(fn):
+    '''
+    Returns the peak memory allocated during one call of fn.  fn is called
+    once beforehand so that caches are warm.
+    '''
+
+    fn()
+    tracemalloc.start()
+
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        fn()
+        return tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+
+def report(name, fn):
+    print('%-40s %8.3f us %6d bytes' % (name, per_call(fn, NUMBER), peak_bytes(fn)))
+
+def main():
+    oracle = Ignoracle()
+    oracle.set_patterns(PATTERNS)
+
+    record = RECORDS[0]
+    records = iter(RECORDS * (NUMBER * 10 // len(RECORDS)))
+
+    report('parameterize_record_info (cached)',
+           lambda: parameterize_record_info(record))
+    report('ignores (cached verdict)', lambda: oracle.ignores(record))
+
+    oracle.verdict_cache_size = 0
+    report('ignores (uncached verdict)', lambda: oracle.ignores(next(records)))
+
+if __name__ == '__main__':
+    main()
+
+# vim: ts=4:sw=4:et:tw=78
@@ -1,8 +1,12 @@
 import unittest
 import re
 
+from collections import namedtuple
+
 from .ignoracle import Ignoracle, parameterize_record_info
 
+Record = namedtuple('Record', ['url', 'level', 'parent_url'])
+
 p1 = 'www\.example\.com/foo\.css\?'
 p2 = 'bar/.+/baz'
 
@@ -106,8 +110,8 @@ class TestRecordInfoParameterization(unittest.TestCase):
 
         result = parameterize_record_info(record_info)
 
-        self.assertEqual('http://www.example.com/', result['primary_url'])
-        self.assertEqual('www.example.com', result['primary_netloc'])
+        self.assertEqual('http://www.example.com/', result.primary_url)
+        self.assertEqual('www.example.com', result.primary_netloc)
 
     def test_uses_url_for_level_zero_url(self):
         record_info = dict(
@@ -117,14 +121,14 @@ class TestRecordInfoParameterization(unittest.TestCase):
 
         result = parameterize_record_info(record_info)
 
-        self.assertEqual('http://www.example.com/', result['primary_url'])
-        self.assertEqual('www.example.com', result['primary_netloc'])
+        self.assertEqual('http://www.example.com/', result.primary_url)
+        self.assertEqual('www.example.com', result.primary_netloc)
 
     def test_missing_primary_url_results_in_no_netloc(self):
         result = parameterize_record_info(dict())
 
-        self.assertIsNone(result['primary_url'])
-        self.assertIsNone(result['primary_netloc'])
+        self.assertIsNone(result.primary_url)
+        self.assertIsNone(result.primary_netloc)
 
     def test_includes_auth_and_port_in_primary_netloc(self):
         record_info = dict(
@@ -134,4 +138,251 @@ class TestRecordInfoParameterization(unittest.TestCase):
 
         result = parameterize_record_info(record_info)
 
-        self.assertEqual('foo:bar@www.example.com:8080', result['primary_netloc'])
+        self.assertEqual('foo:bar@www.example.com:8080', result.primary_netloc)
+
+class TestPrimaryInfo(unittest.TestCase):
+    def test_returns_the_same_tuple_for_the_same_parent(self):
+        a = parameterize_record_info(Record('http://www.example.com/a', 1, 'http://www.example.com/'))
+        b = parameterize_record_info(Record('http://www.example.com/b', 1, 'http://www.example.com/'))
+
+        self.assertIs(a, b)
+
+class TestIgnoracleFirstMatch(unittest.TestCase):
+    def test_reports_earliest_listed_matching_pattern(self):
+        url = 'http://www.example.com/foo/bar'
+
+        for patterns in (['foo', '/bar', 'example'], ['example', 'foo', '/bar'],
+                         ['/bar', 'example', 'foo']):
+            oracle = Ignoracle()
+            oracle.set_patterns(['unmatched'] + patterns)
+
+            self.assertEqual(patterns[0], oracle.ignores(Record(url, 0, None)))
+
+    def test_reports_earliest_listed_of_added_patterns(self):
+        oracle = Ignoracle()
+        oracle.set_patterns(['unmatched'])
+        oracle.set_patterns(['unmatched', 'foo', '/bar', 'example'])
+
+        self.assertEqual('foo', oracle.ignores(Record('http://www.example.com/foo/bar', 0, None)))
+
+class TestIgnoracleCompiledPatternCache(unittest.TestCase):
+    def setUp(self):
+        self.oracle = Ignoracle(cache_size=2)
+
+        self.oracle.set_patterns(['{primary_netloc}/foo\\.css\\?', p2])
+
+    def ignores(self, url, parent_url):
+        return self.oracle.ignores(Record(url, 1, parent_url))
+
+    def test_reuses_compiled_patterns_for_same_primary_url(self):
+        self.ignores('http://www.example.com/foo.css?body=1', 'http://www.example.com/')
+        result = self.ignores('http://www.example.com/foo.css?body=2', 'http://www.example.com/')
+
+        self.assertEqual(result, '{primary_netloc}/foo\\.css\\?')
+        self.assertEqual(1, self.oracle.cache_hits)
+        self.assertEqual(1, self.oracle.cache_misses)
+
+    def test_evicts_least_recently_used_primary_url(self):
+        self.ignores('http://a.example.com/1', 'http://a.example.com/')
+        self.ignores('http://b.example.com/1', 'http://b.example.com/')
+        self.ignores('http://a.example.com/2', 'http://a.example.com/')
+        self.ignores('http://c.example.com/1', 'http://c.example.com/')
+        self.ignores('http://b.example.com/2', 'http://b.example.com/')
+
+        self.assertEqual(1, self.oracle.cache_hits)
+        self.assertEqual(4, self.oracle.cache_misses)
+
+    def test_does_not_cache_when_no_patterns_are_parameterized(self):
+        self.oracle.set_patterns([p1, p2])
+
+        result = self.ignores('http://www.example.com/bar/abc/def/baz', 'http://www.example.com/')
+
+        self.assertEqual(result, p2)
+        self.assertEqual(0, self.oracle.cache_misses)
+
+    def test_set_patterns_discards_cached_patterns(self):
+        self.ignores('http://www.example.com/foo.css?body=1', 'http://www.example.com/')
+        self.oracle.set_patterns([p1])
+
+        result = self.ignores('http://www.example.com/foo.css?body=1', 'http://www.example.com/')
+
+        self.assertEqual(result, p1)
+
+class TestIgnoracleVerdictCache(unittest.TestCase):
+    def setUp(self):
+        self.oracle = Ignoracle(verdict_cache_size=2)
+
+        self.oracle.set_patterns([p1, p2])
+
+    def ignores(self, url):
+        return self.oracle.ignores(Record(url, 0, None))
+
+    def test_repeated_check_hits_cache(self):
+        self.ignores('http://www.example.com/bar/abc/def/baz')
+        result = self.ignores('http://www.example.com/bar/abc/def/baz')
+
+        self.assertEqual(result, p2)
+        self.assertEqual(1, self.oracle.verdict_hits)
+
+    def test_caches_negative_verdicts(self):
+        self.ignores('http://www.example.com/media/qux.jpg')
+
+        self.assertFalse(self.ignores('http://www.example.com/media/qux.jpg'))
+        self.assertEqual(1, self.oracle.verdict_hits)
+
+    def test_set_patterns_invalidates_verdicts(self):
+        self.ignores('http://www.example.com/media/qux.jpg')
+        self.oracle.set_patterns(['qux'])
+
+        self.assertEqual('qux', self.ignores('http://www.example.com/media/qux.jpg'))
+        self.assertEqual(0, self.oracle.verdict_hits)
+
+    def test_bounds_entries(self):
+        for i in range(5):
+            self.ignores('http://www.example.com/%d' % i)
+
+        self.assertEqual(2, len(self.oracle._verdicts))
+
+    def test_bounds_bytes(self):
+        self.oracle.verdict_cache_size = 100
+        self.oracle.verdict_cache_bytes = 1000
+
+        for i in range(10):
+            self.ignores('http://www.example.com/%d' % i)
+
+        self.assertLessEqual(self.oracle._verdict_bytes, 1000)
+        self.assertEqual(3, len(self.oracle._verdicts))
+
+class TestIgnoracleIncrementalUpdates(unittest.TestCase):
+    def setUp(self):
+        self.oracle = Ignoracle()
+
+        self.oracle.set_patterns([p1, p2])
+
+    def ignores(self, url):
+        return self.oracle.ignores(Record(url, 0, None))
+
+    def test_identical_set_keeps_generation_and_verdicts(self):
+        self.ignores('http://www.example.com/bar/abc/def/baz')
+        generation = self.oracle.generation
+
+        self.oracle.set_patterns([p2, p1])
+        self.ignores('http://www.example.com/bar/abc/def/baz')
+
+        self.assertEqual(generation, self.oracle.generation)
+        self.assertEqual(1, self.oracle.verdict_hits)
+
+    def test_keeps_compiled_forms_of_retained_patterns(self):
+        self.ignores('http://www.example.com/')
+        compiled = self.oracle._regexes[p2]
+
+        self.oracle.set_patterns([p2, 'qux'])
+        self.ignores('http://www.example.com/')
+
+        self.assertIs(compiled, self.oracle._regexes[p2])
+        self.assertNotIn(p1, self.oracle._regexes)
+
+    def test_retained_patterns_keep_their_order(self):
+        self.oracle.set_patterns(['bar', p2])
+
+        self.assertEqual((p2, 'bar'), self.oracle.patterns)
+        self.assertEqual(p2, self.ignores('http://www.example.com/bar/abc/def/baz'))
+
+class TestIgnoraclePatternStats(unittest.TestCase):
+    def setUp(self):
+        self.oracle = Ignoracle(stats_sample_interval=1)
+
+        self.oracle.set_patterns([p1, p2])
+
+    def ignores(self, url):
+        return self.oracle.ignores(Record(url, 0, None))
+
+    def stats_for(self, pattern):
+        stats = self.oracle.pattern_stats()
+
+        return [p for p in stats['patterns'] if p['pattern'] == pattern][0]
+
+    def test_counts_hits_per_pattern(self):
+        self.ignores('http://www.example.com/bar/abc/def/baz')
+        self.ignores('http://www.example.com/bar/ghi/baz')
+
+        self.assertEqual(2, self.stats_for(p2)['hits'])
+        self.assertEqual(0, self.stats_for(p1)['hits'])
+        self.assertEqual(2, self.oracle.pattern_stats()['checks'])
+
+    def test_does_not_count_cached_verdicts_as_checks(self):
+        self.ignores('http://www.example.com/bar/abc/def/baz')
+        self.ignores('http://www.example.com/bar/abc/def/baz')
+
+        self.assertEqual(1, self.stats_for(p2)['hits'])
+        self.assertEqual(1, self.oracle.pattern_stats()['checks'])
+
+    def test_times_sampled_evaluations(self):
+        self.ignores('http://www.example.com/bar/abc/def/baz')
+
+        self.assertEqual(1, self.stats_for(p2)['evaluations'])
+        self.assertGreater(self.stats_for(p2)['seconds'], 0)
+
+    def test_sampling_can_be_disabled(self):
+        self.oracle.stats_sample_interval = 0
+
+        self.ignores('http://www.example.com/bar/abc/def/baz')
+
+        self.assertEqual(0, self.stats_for(p2)['evaluations'])
+        self.assertEqual(1, self.stats_for(p2)['hits'])
+
+    def test_summary_is_bounded(self):
+        self.oracle.set_patterns(['/%d/' % i for i in range(20)])
+
+        for i in range(10):
+            self.ignores('http://www.example.com/%d/' % i)
+
+        summary = self.oracle.pattern_summary(top=3)
+
+        self.assertEqual(20, summary['patterns'])
+        self.assertEqual(10, summary['dead'])
+        self.assertEqual(3, len(summary['costliest']))
+        self.assertEqual(3, len(summary['most_hits']))
+
+    def test_summary_lists_most_matched_patterns_first(self):
+        self.ignores('http://www.example.com/bar/abc/def/baz')
+        self.ignores('http://www.example.com/bar/ghi/baz')
+
+        self.assertEqual([dict(pattern=p2, hits=2)],
+                         self.oracle.pattern_summary()['most_hits'])
+
+class TestIgnoracleQuarantine(unittest.TestCase):
+    slow = '(a+)+b'
+
+    def setUp(self):
+        self.quarantined = []
+        self.oracle = Ignoracle(time_budget=0.005)
+        self.oracle.on_quarantine = lambda pattern, assessment: \
+            self.quarantined.append(pattern)
+        self.oracle.set_patterns([self.slow, p2])
+
+    def ignores(self, url):
+        return self.oracle.ignores(Record(url, 0, None))
+
+    def test_quarantines_slow_patterns(self):
+        self.assertEqual((self.slow,), self.oracle.quarantined)
+        self.assertEqual([self.slow], self.quarantined)
+        self.assertEqual(False, self.ignores('http://www.example.com/aab'))
+        self.assertEqual(p2, self.ignores('http://www.example.com/bar/abc/def/baz'))
+
+    def test_quarantined_patterns_are_not_reassessed(self):
+        self.oracle.set_patterns([self.slow, p1, p2])
+
+        self.assertEqual([self.slow], self.quarantined)
+        self.assertEqual((self.slow,), self.oracle.quarantined)
+
+    def test_removing_a_pattern_lifts_its_quarantine(self):
+        self.oracle.set_patterns([p2])
+
+        self.assertEqual((), self.oracle.quarantined)
+
+    def test_quarantines_slow_parameterized_patterns(self):
+        pattern = '{primary_netloc}/(a+)+b'
+        self.oracle.set_patterns([pattern])
+
+        self.assertEqual((pattern,), self.oracle.quarantined)
@@ -0,0 +1,321 @@
+'''matcher: single-pass matching of a URL against many ignore patterns
+'''
+
+import operator
+import re
+
+try:
+    from re import _parser as sre_parse
+    from re import _constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
+# Literals shorter than this are too common in URLs to make a useful
+# prefilter; patterns whose best literal is shorter are always run.
+MIN_LITERAL_LENGTH = 2
+
+_index = operator.itemgetter(0)
+
+def _parse(compiled, unsupported_flags):
+    '''
+    Returns the top-level items of a compiled pattern as a list of (op, av)
+    tuples, or None if the pattern uses any of unsupported_flags.
+    '''
+
+    # compiled.flags includes flags set inline, as in (?i)...
+    if compiled.flags & unsupported_flags:
+        return None
+
+    try:
+        parsed = sre_parse.parse(compiled.pattern, compiled.flags)
+    except (re.error, TypeError):
+        return None
+
+    return list(parsed)
+
+def required_literal(compiled, items=None):
+    '''
+    Given a compiled pattern, returns the longest string that must appear
+    verbatim in any string the pattern matches, or None if no such string
+    can be determined.
+
+    Only literal runs in the pattern's top-level sequence are considered;
+    anything inside groups, alternations or repetitions ends a run.  This is
+    conservative: a pattern without a usable literal is simply always run.
+
+    items may be passed in if the pattern has already been parsed without
+    case-insensitivity.
+    '''
+
+    if items is None:
+        items = _parse(compiled, re.IGNORECASE)
+
+    if items is None:
+        return None
+
+    best = ''
+    run = []
+
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            run.append(chr(av))
+            continue
+
+        if len(run) > len(best):
+            best = ''.join(run)
+
+        run = []
+
+    if len(run) > len(best):
+        best = ''.join(run)
+
+    if len(best) < MIN_LITERAL_LENGTH:
+        return None
+
+    return best
+
+def _is_scheme_item(op, av):
+    '''
+    Whether a parsed item can appear in the scheme part of a host-anchored
+    pattern: a literal, or an optional literal (as in https?), other than ':'
+    or '/'.
+    '''
+
+    if op == sre_constants.LITERAL:
+        return chr(av) not in ':/'
+
+    if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+        low, high, body = av
+        body = list(body)
+
+        return (low == 0 and high == 1 and len(body) == 1
+                and body[0][0] == sre_constants.LITERAL
+                and chr(body[0][1]) not in ':/')
+
+    return False
+
+def anchored_host(compiled, items=None):
+    '''
+    Given a compiled pattern of the form ^scheme://host/..., where scheme is
+    made of (possibly optional) literals and host is a literal, returns host.
+    Otherwise, returns None.
+
+    Such a pattern can only match URLs for which url_host() returns host.
+
+    items may be passed in if the pattern has already been parsed without
+    case-insensitivity or multiline mode.
+    '''
+
+    if items is None:
+        items = _parse(compiled, re.IGNORECASE | re.MULTILINE)
+
+    if not items or items[0] not in ((sre_constants.AT, sre_constants.AT_BEGINNING),
+                                     (sre_constants.AT, sre_constants.AT_BEGINNING_STRING)):
+        return None
+
+    i = 1
+    while i < len(items) and _is_scheme_item(*items[i]):
+        i += 1
+
+    if i == 1:
+        return None
+
+    literals = []
+    for op, av in items[i:]:
+        if op != sre_constants.LITERAL:
+            break
+
+        literals.append(chr(av))
+
+    text = ''.join(literals)
+
+    if not text.startswith('://'):
+        return None
+
+    end = text.find('/', 3)
+
+    if end <= 3:
+        return None
+
+    return text[3:end]
+
+def url_host(url):
+    '''
+    Returns the text between the first :// in url and the following /, or
+    None if url doesn't have that shape.  This is the key anchored_host()
+    patterns are bucketed by.
+    '''
+
+    start = url.find('://')
+
+    if start < 0:
+        return None
+
+    start += 3
+    end = url.find('/', start)
+
+    if end < 0:
+        return None
+
+    return url[start:end]
+
+class AhoCorasick(object):
+    '''
+    An Aho-Corasick automaton over a set of literal strings.  Finds every
+    literal occurring in a string in a single left-to-right pass.
+    '''
+
+    def __init__(self, literals):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+
+        for literal in literals:
+            self._add(literal)
+
+        self._link()
+
+    def _add(self, literal):
+        state = 0
+
+        for ch in literal:
+            nxt = self._goto[state].get(ch)
+
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+
+            state = nxt
+
+        self._out[state] = self._out[state] + (literal,)
+
+    def _link(self):
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+
+        queue = list(goto[0].values())
+
+        for state in queue:
+            for ch, nxt in goto[state].items():
+                queue.append(nxt)
+
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+
+                fail[nxt] = goto[f].get(ch, 0)
+                out[nxt] = out[nxt] + out[fail[nxt]]
+
+    def search(self, text):
+        '''
+        Returns the set of literals that occur in text.
+        '''
+
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+
+        found = set()
+        state = 0
+
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+
+            state = goto[state].get(ch, 0)
+
+            if out[state]:
+                found.update(out[state])
+
+        return found
+
+class PatternSet(object):
+    '''
+    An ordered collection of compiled patterns that reports the first one
+    matching a string.
+
+    Patterns anchored to a literal host (^https?://www\\.example\\.com/...)
+    are bucketed by that host and only run against URLs on the same host.
+    Every other pattern's required literal is fed into an Aho-Corasick
+    prefilter; only patterns whose literal occurs in the string, plus the
+    patterns without a usable literal, have their regexes run.  The result is
+    the same as running every pattern in order.
+    '''
+
+    def __init__(self, entries):
+        '''
+        entries is an iterable of (index, pattern, compiled) tuples.  index
+        gives the pattern's position in the ignore list; first-match order
+        is by index.
+        '''
+
+        self.entries = sorted(entries, key=_index)
+        self._always = []
+        self._by_host = {}
+        self._by_literal = {}
+
+        for entry in self.entries:
+            items = _parse(entry[2], re.IGNORECASE | re.MULTILINE)
+            host = anchored_host(entry[2], items) if items else None
+
+            if host is not None:
+                self._by_host.setdefault(host, []).append(entry)
+                continue
+
+            literal = required_literal(entry[2], items)
+
+            if literal is None:
+                self._always.append(entry)
+            else:
+                self._by_literal.setdefault(literal, []).append(entry)
+
+        self._automaton = AhoCorasick(self._by_literal.keys())
+
+    def __len__(self):
+        return len(self.entries)
+
+    def candidates(self, url):
+        '''
+        Returns the entries that might match url, in index order.
+        '''
+
+        found = self._automaton.search(url)
+        same_host = self._by_host.get(url_host(url)) if self._by_host else None
+
+        if not found and not same_host:
+            return self._always
+
+        candidates = list(self._always)
+
+        if same_host:
+            candidates.extend(same_host)
+
+        for literal in found:
+            candidates.extend(self._by_literal[literal])
+
+        candidates.sort(key=_index)
+
+        return candidates
+
+    def first_match(self, url, limit=None):
+        '''
+        Returns the (index, pattern, compiled) entry of the first pattern
+        matching url, or None.  If limit is given, only patterns with an index
+        below limit are considered.
+        '''
+
+        for entry in self.candidates(url):
+            if limit is not None and entry[0] >= limit:
+                break
+
+            if entry[2].search(url):
+                return entry
+
+        return None
+
+# vim: ts=4:sw=4:et:tw=78
@@ -0,0 +1,79 @@
+import re
+import unittest
+
+from .matcher import AhoCorasick, PatternSet, anchored_host, required_literal, url_host
+
+def entries(*patterns):
+    return [(i, p, re.compile(p)) for i, p in enumerate(patterns)]
+
+class TestRequiredLiteral(unittest.TestCase):
+    def test_returns_longest_top_level_run(self):
+        self.assertEqual('/css/css/', required_literal(re.compile('/css/css/.+/css/')))
+
+    def test_unescapes_literals(self):
+        self.assertEqual('.facebook.com/login', required_literal(re.compile('^https?://.*\\.facebook\\.com/login')))
+
+    def test_returns_none_for_alternations(self):
+        self.assertIsNone(required_literal(re.compile('foo|bar')))
+
+    def test_returns_none_for_case_insensitive_patterns(self):
+        self.assertIsNone(required_literal(re.compile('(?i)/login/')))
+        self.assertIsNone(required_literal(re.compile('/login/', re.IGNORECASE)))
+
+class TestAnchoredHost(unittest.TestCase):
+    def test_returns_literal_host(self):
+        self.assertEqual('www.facebook.com', anchored_host(re.compile('^https?://www\\.facebook\\.com/[^/]+/photos/')))
+        self.assertEqual('example.org', anchored_host(re.compile('^ftp://example\\.org/')))
+
+    def test_returns_none_for_unanchored_patterns(self):
+        self.assertIsNone(anchored_host(re.compile('https?://www\\.facebook\\.com/')))
+
+    def test_returns_none_for_non_literal_hosts(self):
+        self.assertIsNone(anchored_host(re.compile('^https?://(www\\.)?twitter\\.com/')))
+        self.assertIsNone(anchored_host(re.compile('^https?://twitter.com/i/jot')))
+        self.assertIsNone(anchored_host(re.compile('^https?://localhost(:\\d+)?/')))
+
+    def test_returns_none_for_multiline_patterns(self):
+        self.assertIsNone(anchored_host(re.compile('(?m)^https?://example\\.org/')))
+
+class TestUrlHost(unittest.TestCase):
+    def test_returns_text_up_to_path(self):
+        self.assertEqual('user@www.example.com:8080', url_host('http://user@www.example.com:8080/a'))
+
+    def test_returns_none_without_path(self):
+        self.assertIsNone(url_host('http://www.example.com'))
+
+class TestAhoCorasick(unittest.TestCase):
+    def test_finds_overlapping_literals(self):
+        automaton = AhoCorasick(['he', 'she', 'hers', 'his'])
+
+        self.assertEqual(set(['he', 'she', 'hers']), automaton.search('ushers'))
+
+    def test_finds_nothing_in_unrelated_text(self):
+        automaton = AhoCorasick(['/js/js/'])
+
+        self.assertEqual(set(), automaton.search('http://www.example.com/js/'))
+
+class TestPatternSet(unittest.TestCase):
+    def test_returns_first_matching_pattern_in_index_order(self):
+        patterns = PatternSet(entries('/images/images/', '^https?://', 'images'))
+
+        self.assertEqual('/images/images/', patterns.first_match('http://example.com/images/images/a.png')[1])
+        self.assertEqual('^https?://', patterns.first_match('http://example.com/images/a.png')[1])
+
+    def test_runs_patterns_without_literals(self):
+        patterns = PatternSet(entries('/css/css/', '/(.*)/(\\1/){3,}'))
+
+        self.assertEqual('/(.*)/(\\1/){3,}', patterns.first_match('http://example.com/foo/foo/foo/foo/foo')[1])
+
+    def test_returns_none_for_unsuccessful_match(self):
+        patterns = PatternSet(entries('/css/css/', '%25252525'))
+
+        self.assertIsNone(patterns.first_match('http://example.com/css/a.css'))
+
+    def test_runs_host_anchored_patterns_only_on_their_host(self):
+        patterns = PatternSet(entries('^https?://www\\.facebook\\.com/login', 'login'))
+
+        self.assertEqual('^https?://www\\.facebook\\.com/login', patterns.first_match('https://www.facebook.com/login')[1])
+        self.assertEqual('login', patterns.first_match('https://www.example.com/login')[1])
+        self.assertEqual(['login'], [e[1] for e in patterns.candidates('https://www.example.com/login')])
@@ -1,47 +1,124 @@
+import json
 import redis
+import select
+import socket
 import threading
 import time
 
+from collections import namedtuple
+
 import wpull
 
 from .ignoracle import Ignoracle
 from .. import shared_config
+from ..control import Backoff, connection_pool
 from redis.exceptions import ConnectionError as RedisConnectionError
 
+SettingsSnapshot = namedtuple('SettingsSnapshot', [
+    'age',
+    'concurrency',
+    'abort_requested',
+    'delay_min',
+    'delay_max',
+    'suppress_ignore_reports',
+    'ignore_patterns_version'
+])
+
 class Settings(object):
     '''
     Synchronizes access to job settings.
+
+    Settings are published as an immutable SettingsSnapshot; accessors read
+    the current snapshot with a single attribute lookup and never block.
+    update_settings builds a new snapshot (and compiles ignore patterns) on
+    the listener thread, then swaps it in.  settings_lock only serializes
+    updates.
     '''
 
     settings_lock = threading.RLock()
     ignoracle = Ignoracle()
 
-    settings = dict(
+    settings = SettingsSnapshot(
         age=None,
         concurrency=None,
         abort_requested=None,
         delay_min=None,
         delay_max=None,
-        suppress_ignore_reports=False
+        suppress_ignore_reports=False,
+        ignore_patterns_version=None
     )
 
     def update_settings(self, new_settings):
         '''
-        Replaces existing settings with new data.
+        Replaces existing settings with new data.  If new_settings'
+        ignore_patterns is None, the ignore patterns are unchanged.
+        '''
+        with self.settings_lock:
+            if new_settings['ignore_patterns'] is not None:
+                self.ignoracle.set_patterns(new_settings['ignore_patterns'])
+
+            self.settings = SettingsSnapshot(
+                delay_min=int_or_none(new_settings['delay_min']),
+                delay_max=int_or_none(new_settings['delay_max']),
+                age=int_or_none(new_settings['age']),
+                concurrency=int_or_none(new_settings['concurrency']),
+                abort_requested=new_settings['abort_requested'],
+                suppress_ignore_reports=new_settings['suppress_ignore_reports'],
+                ignore_patterns_version=int_or_none(new_settings.get('ignore_patterns_version'))
+            )
+
+    def apply_change(self, change):
+        '''
+        Applies a detailed change message (see parse_message) to the current
+        settings without going back to Redis.
+
+        Returns False, changing nothing, if the message doesn't directly
+        follow the current settings or ignore pattern version; the caller
+        should then fetch the full settings.
         '''
         with self.settings_lock:
-            self.settings['delay_min'] = int_or_none(new_settings['delay_min'])
-            self.settings['delay_max'] = int_or_none(new_settings['delay_max'])
-            self.settings['age'] = int_or_none(new_settings['age'])
-            self.settings['concurrency'] = int_or_none(new_settings['concurrency'])
-            self.settings['abort_requested'] = new_settings['abort_requested']
-            self.settings['suppress_ignore_reports'] = new_settings['suppress_ignore_reports']
+            settings = self.settings
+            age = int(change['age'])
+
+            if settings.age is None or age != settings.age + 1:
+                return False
+
+            updates = dict(age=age)
+
+            for field, value in change.get('fields', {}).items():
+                if field in FIELD_CONVERTERS:
+                    updates[field] = FIELD_CONVERTERS[field](value)
+
+            delta = change.get('ignore_patterns')
+
+            if delta:
+                version = int(delta['version'])
+
+                if settings.ignore_patterns_version is None or \
+                        version != settings.ignore_patterns_version + 1:
+                    return False
+
+                removed = set(delta.get('removed', ()))
+                patterns = [p for p in self.ignoracle.patterns
+                        if p not in removed]
+                patterns.extend(delta.get('added', ()))
+
+                self.ignoracle.set_patterns(patterns)
+                updates['ignore_patterns_version'] = version
 
-            self.ignoracle.set_patterns(new_settings['ignore_patterns'])
+            self.settings = settings._replace(**updates)
+
+            return True
 
     def age(self):
-        with self.settings_lock:
-            return self.settings['age'] or 0
+        return self.settings.age or 0
+
+    def ignore_patterns_version(self):
+        '''
+        Version of the ignore pattern set last loaded, if known.
+        '''
+
+        return self.settings.ignore_patterns_version
 
     def ignore_url(self, record_info: wpull.pipeline.item.URLRecord):
         '''
@@ -54,51 +131,53 @@ class Settings(object):
         Returns True if job abort was requested, False otherwise.
         '''
 
-        with self.settings_lock:
-            return self.settings['abort_requested']
+        return self.settings.abort_requested
 
     def delay_time_range(self):
         '''
         Returns a range of valid sleep times.  Sleep times are in milliseconds.
         '''
 
-        with self.settings_lock:
-            return self.settings['delay_min'] or 0, self.settings['delay_max'] or 0
+        settings = self.settings
+
+        return settings.delay_min or 0, settings.delay_max or 0
 
     def concurrency(self):
         '''
         Number of wpull fetchers to run.
         '''
 
-        with self.settings_lock:
-            return self.settings['concurrency'] or 1
+        return self.settings.concurrency or 1
 
     def suppress_ignore_reports(self):
         '''
         Whether ignore reports should be suppressed.
         '''
 
-        with self.settings_lock:
-            return self.settings['suppress_ignore_reports']
+        return self.settings.suppress_ignore_reports
 
     def inspect(self):
         '''
         Returns a string describing the current settings.
         '''
-        with self.settings_lock:
-            iglen = len(self.ignoracle.patterns)
-            sl, sm = self.delay_time_range()
-        
-            report = str(self.concurrency()) + ' workers, '
-            report += str(iglen) + ' ignores, '
-            report += 'delay min/max: [' + str(sl) + ', ' + str(sm) + '] ms, '
+        settings = self.settings
+        iglen = len(self.ignoracle.patterns)
 
-            if self.settings['suppress_ignore_reports']:
-                report += 'suppressing ignore reports'
-            else:
-                report += 'showing ignore reports'
+        report = str(settings.concurrency or 1) + ' workers, '
+        report += str(iglen) + ' ignores, '
 
-            return report
+        quarantined = len(self.ignoracle.quarantined)
+        if quarantined:
+            report += str(quarantined) + ' quarantined, '
+        report += 'delay min/max: [' + str(settings.delay_min or 0) + ', ' + \
+            str(settings.delay_max or 0) + '] ms, '
+
+        if settings.suppress_ignore_reports:
+            report += 'suppressing ignore reports'
+        else:
+            report += 'showing ignore reports'
+
+        return report
 
 # ---------------------------------------------------------------------------
 
@@ -106,13 +185,17 @@ class Listener(object):
     '''
     Listens for changes to job settings.  When changes are detected, retrieves
     job settings and updates the pipeline's settings copy.
+
+    If on_update is given, it is called with no arguments whenever the
+    settings age changes.  It is called from the listener thread.
     '''
 
-    def __init__(self, redis_url, settings, control, ident):
+    def __init__(self, redis_url, settings, control, ident, on_update=None):
         self.redis_url = redis_url
         self.settings = settings
         self.control = control
         self.ident = ident
+        self.on_update = on_update
         self.thread = None
 
     def start(self):
@@ -124,7 +207,7 @@ class Listener(object):
         self.stop()
 
         self.thread = ListenerWorkerThread(self.redis_url, self.settings,
-                self.control, self.ident)
+                self.control, self.ident, self.on_update)
         self.thread.start()
 
     def check(self):
@@ -155,70 +238,140 @@ class ListenerWorkerThread(threading.Thread):
 
     The latter bit is done to ensure that we eventually receive the latest
     job settings, even if we miss a pubsub update.
+
+    Between the two, the thread sleeps on the pubsub socket until a message
+    arrives or the next unconditional update is due, so an idle job costs no
+    CPU.  stop() wakes it through a socket pair.
     '''
 
-    def __init__(self, redis_url, settings, control, ident):
+    # Seconds between unconditional settings updates.
+    update_interval = 30
+
+    def __init__(self, redis_url, settings, control, ident, on_update=None):
         super(ListenerWorkerThread, self).__init__()
 
         self.redis_url = redis_url
         self.settings = settings
         self.control = control
         self.job_ident = ident
+        self.on_update = on_update
         self.running = True
-        self.reconnect_timeout = 5.0
+        self.backoff = Backoff()
         self.last_run = 0.0
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
 
     def stop(self):
         self.running = False
 
+        try:
+            self.wakeup_w.send(b'\0')
+        except OSError:
+            pass
+
     def run(self):
+        try:
+            self.listen()
+        finally:
+            self.wakeup_r.close()
+            self.wakeup_w.close()
+
+    def listen(self):
         while self.running:
             try:
                 self.update_settings()
                 self.last_run = time.monotonic()
 
-                r = redis.StrictRedis.from_url(self.redis_url)
+                r = redis.StrictRedis(
+                    connection_pool=connection_pool(self.redis_url))
                 p = r.pubsub()
-                p.subscribe(shared_config.job_channel(self.job_ident))
 
-                print('Settings listener connected.')
+                try:
+                    p.subscribe(shared_config.job_channel(self.job_ident))
+                    self.backoff.succeeded()
 
-                while self.running:
-                    self.process_messages(p)
-                    self.run_update_check()
-                    time.sleep(0.1)
+                    print('Settings listener connected.')
 
-                p.close()
+                    while self.running:
+                        self.process_messages(p, self.seconds_until_update())
+                        self.run_update_check()
+                finally:
+                    # Hands the connection back to the pool.
+                    p.close()
 
             except RedisConnectionError as e:
-                print('Settings listener disconnected (cause: %s).'
-                      'Reconnecting in %s seconds.' % (str(e), self.reconnect_timeout))
-                r = None
-                p = None
-                time.sleep(self.reconnect_timeout)
+                delay = self.backoff.failed()
+                print('Settings listener disconnected (cause: %s). '
+                      'Reconnecting in %.1f seconds.' % (str(e), delay))
+                self.wait([], delay)
+
+    def wait(self, socks, timeout):
+        '''
+        Blocks until one of socks is readable, stop() is called or timeout
+        seconds pass.
+        '''
+
+        select.select(socks + [self.wakeup_r], [], [], timeout)
+
+    def wait_for_message(self, p, timeout):
+        '''
+        Returns the next message on p, waiting up to timeout seconds for one
+        to arrive.  Returns None if none arrived.
+
+        redis-py 2.10's get_message can't block, so this waits on the pubsub
+        connection's socket, unless a reply is already waiting.
+        '''
+
+        connection = p.connection
+
+        if connection is None:
+            raise RedisConnectionError('Pubsub connection is closed.')
+
+        # can_read reconnects, and so resubscribes, if the connection was
+        # dropped.
+        if not connection.can_read():
+            # redis-py has no public way to get at the socket.
+            sock = connection._sock
 
-    def process_messages(self, p):
-        msg = p.get_message(ignore_subscribe_messages=True)
+            if sock is None:
+                raise RedisConnectionError('Pubsub connection was lost.')
+
+            self.wait([sock], timeout)
+
+        return p.get_message(ignore_subscribe_messages=True)
+
+    def seconds_until_update(self):
+        return max(0, self.last_run + self.update_interval - time.monotonic())
+
+    def process_messages(self, p, timeout=0):
+        msg = self.wait_for_message(p, timeout)
 
         if msg:
-            old_age = self.settings.age()
-            new_age = int(msg['data'])
+            change = parse_message(msg['data'])
 
-            if old_age < new_age:
-                self.update_settings()
+            if self.settings.age() < int(change['age']):
+                if 'fields' in change and self.settings.apply_change(change):
+                    if self.on_update:
+                        self.on_update()
+                else:
+                    self.update_settings()
 
     def run_update_check(self):
         now = time.monotonic()
 
-        if now - self.last_run > 30:
+        if now - self.last_run >= self.update_interval:
             self.update_settings()
             self.last_run = now
 
     def update_settings(self):
-        new_settings = self.control.get_settings(self.job_ident)
+        new_settings = self.control.get_settings(self.job_ident,
+                self.settings.ignore_patterns_version())
+        old_age = self.settings.age()
 
         self.settings.update_settings(new_settings)
 
+        if self.on_update and self.settings.age() != old_age:
+            self.on_update()
+
 # ---------------------------------------------------------------------------
 
 def int_or_none(v):
@@ -227,4 +380,35 @@ def int_or_none(v):
     else:
         return None
 
+def identity(v):
+    return v
+
+# How fields in a detailed change message are converted, as in
+# Settings.update_settings.
+FIELD_CONVERTERS = dict(
+    delay_min=int_or_none,
+    delay_max=int_or_none,
+    concurrency=int_or_none,
+    abort_requested=identity,
+    suppress_ignore_reports=identity
+)
+
+def parse_message(data):
+    '''
+    Parses a job channel message into a dict with an age key.
+
+    The backend sends either the new settings age alone or, with
+    detailed_job_messages set in shared_config.yml, a JSON object that also
+    has fields (changed job hash fields) and/or ignore_patterns (the new
+    ignore set version and the added and removed patterns).
+    '''
+
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+
+    if data.startswith('{'):
+        return json.loads(data)
+
+    return dict(age=int(data))
+
 # vim:ts=4:sw=4:et:tw=78
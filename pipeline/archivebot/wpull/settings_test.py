@@ -0,0 +1,171 @@
+import json
+import threading
+import time
+import unittest
+
+import redis
+
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from .ignoracle import Ignoracle
+from .settings import ListenerWorkerThread, Settings, parse_message
+from .. import shared_config
+from ..control import Backoff
+
+TEST_REDIS_URL = 'redis://localhost:6379/1'
+
+def full_settings(**kwargs):
+    settings = dict(
+        delay_min=b'250',
+        delay_max=b'375',
+        concurrency=b'2',
+        age=b'5',
+        abort_requested=None,
+        suppress_ignore_reports=None,
+        ignore_patterns_version=b'3',
+        ignore_patterns=[b'foo', b'bar']
+    )
+    settings.update(kwargs)
+
+    return settings
+
+class SettingsSource(object):
+    '''
+    Stands in for Control: hands out full_settings(), or fails to if
+    reachable is false.
+    '''
+
+    def __init__(self, reachable=True):
+        self.reachable = reachable
+        self.fetches = 0
+
+    def get_settings(self, ident, ignore_patterns_version=None):
+        self.fetches += 1
+
+        if not self.reachable:
+            raise RedisConnectionError('unreachable')
+
+        return full_settings()
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    return condition()
+
+class TestParseMessage(unittest.TestCase):
+    def test_parses_bare_age(self):
+        self.assertEqual(dict(age=12), parse_message(b'12'))
+
+    def test_parses_detailed_message(self):
+        change = parse_message(b'{"age": 12, "fields": {"concurrency": 4}}')
+
+        self.assertEqual(12, change['age'])
+        self.assertEqual(dict(concurrency=4), change['fields'])
+
+class TestSettingsApplyChange(unittest.TestCase):
+    def setUp(self):
+        self.settings = Settings()
+        self.settings.ignoracle = Ignoracle()
+        self.settings.update_settings(full_settings())
+
+    def test_applies_changed_fields(self):
+        self.assertTrue(self.settings.apply_change(dict(age=6, fields=dict(concurrency=4, delay_min='0'))))
+
+        self.assertEqual(6, self.settings.age())
+        self.assertEqual(4, self.settings.concurrency())
+        self.assertEqual((0, 375), self.settings.delay_time_range())
+
+    def test_applies_ignore_pattern_delta(self):
+        change = dict(age=6, fields={}, ignore_patterns=dict(version=4, added=['baz'], removed=['foo']))
+
+        self.assertTrue(self.settings.apply_change(change))
+
+        self.assertEqual(set(['bar', 'baz']), set(self.settings.ignoracle.patterns))
+        self.assertEqual(4, self.settings.ignore_patterns_version())
+
+    def test_appends_added_ignore_patterns_in_message_order(self):
+        change = dict(age=6, fields={}, ignore_patterns=dict(version=4, added=['qux', 'baz', 'quux'], removed=['foo']))
+
+        self.assertTrue(self.settings.apply_change(change))
+
+        self.assertEqual(('bar', 'qux', 'baz', 'quux'), self.settings.ignoracle.patterns)
+
+    def test_rejects_change_after_a_missed_message(self):
+        self.assertFalse(self.settings.apply_change(dict(age=7, fields=dict(concurrency=4))))
+
+        self.assertEqual(5, self.settings.age())
+        self.assertEqual(2, self.settings.concurrency())
+
+    def test_rejects_delta_against_another_ignore_pattern_version(self):
+        change = dict(age=6, fields={}, ignore_patterns=dict(version=5, added=['baz']))
+
+        self.assertFalse(self.settings.apply_change(change))
+
+        self.assertEqual(set(['foo', 'bar']), set(self.settings.ignoracle.patterns))
+        self.assertEqual(5, self.settings.age())
+
+class TestListenerWorkerThread(unittest.TestCase):
+    def setUp(self):
+        self.settings = Settings()
+        self.settings.ignoracle = Ignoracle()
+        self.updated = threading.Event()
+        self.thread = None
+
+    def tearDown(self):
+        if self.thread:
+            self.thread.stop()
+            self.thread.join(5)
+
+    def start(self, source, backoff=None):
+        self.thread = ListenerWorkerThread(TEST_REDIS_URL, self.settings,
+                source, 'ident', self.updated.set)
+
+        if backoff:
+            self.thread.backoff = backoff
+
+        self.thread.start()
+
+    def test_stop_interrupts_reconnect_delay(self):
+        source = SettingsSource(reachable=False)
+        self.start(source, Backoff(base=60, cap=60, random=lambda: 1))
+
+        self.assertTrue(wait_until(lambda: source.fetches >= 1))
+
+        self.thread.stop()
+        self.thread.join(2)
+
+        self.assertFalse(self.thread.is_alive())
+
+    def test_applies_published_changes(self):
+        r = redis.StrictRedis.from_url(TEST_REDIS_URL)
+        channel = shared_config.job_channel('ident')
+
+        def subscribers():
+            return int(r.execute_command('PUBSUB', 'NUMSUB', channel)[1])
+
+        try:
+            r.ping()
+        except RedisConnectionError:
+            self.skipTest('no Redis to publish on')
+
+        source = SettingsSource()
+        self.start(source)
+
+        self.assertTrue(wait_until(lambda: subscribers() == 1))
+        self.assertTrue(self.updated.wait(5))
+        self.updated.clear()
+
+        r.publish(channel, json.dumps(dict(age=6, fields=dict(concurrency=4))))
+
+        self.assertTrue(self.updated.wait(5))
+        self.assertEqual(4, self.settings.concurrency())
+        self.assertEqual(1, source.fetches)
+
+        self.thread.stop()
+        self.thread.join(2)
+
+        self.assertFalse(self.thread.is_alive())
+        self.assertTrue(wait_until(lambda: subscribers() == 0))
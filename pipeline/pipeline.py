@@ -21,6 +21,7 @@ from seesaw.util import find_executable
 sys.path.append(os.getcwd())
 
 from archivebot import control
+from archivebot.control import QueueWatcher
 from archivebot import shared_config
 from archivebot.seesaw import extensions
 from archivebot.seesaw import monitoring
@@ -76,6 +77,7 @@ assert datetime.datetime.now(datetime.timezone.utc).astimezone().tzinfo.utcoffse
 assert dnspython_crash_fixed(), 'Broken crash-prone dnspython found'
 
 REDIS_URL = env['REDIS_URL']
+LOG_REDIS_URL = env.get('LOG_REDIS_URL')
 LOG_CHANNEL = shared_config.log_channel()
 PIPELINE_CHANNEL = shared_config.pipeline_channel()
 OPENSSL_CONF = env.get('OPENSSL_CONF')
@@ -85,7 +87,12 @@ TMPDIR = env.get('TMPDIR')
 # CONTROL CONNECTION
 # ------------------------------------------------------------------------------
 
-control = control.Control(REDIS_URL, LOG_CHANNEL, PIPELINE_CHANNEL)
+control = control.Control(REDIS_URL, LOG_CHANNEL, PIPELINE_CHANNEL,
+    packet_codes=shared_config.log_packet_codes(),
+    log_stream_maxlen=shared_config.log_stream_maxlen(),
+    log_redis_url=LOG_REDIS_URL)
+
+queue_watcher = QueueWatcher(REDIS_URL, shared_config.queue_channel())
 
 # ------------------------------------------------------------------------------
 # SEESAW EXTENSIONS
@@ -126,7 +133,8 @@ DEFAULT_USER_AGENT = \
     '(Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) ' \
     'Chrome/42.0.2311.90 Safari/537.36' % (VERSION, wpull_version())
 
-_, _, _, pipeline_id = monitoring.pipeline_id()
+reporter = monitoring.Reporter(control, VERSION, downloader)
+pipeline_id = reporter.pipeline_id
 
 wpull_args = WpullArgs(
     default_user_agent=DEFAULT_USER_AGENT,
@@ -143,8 +151,11 @@ check_wpull_args(wpull_args)
 wpull_env = dict(os.environ)
 wpull_env['ITEM_IDENT'] = ItemInterpolation('%(ident)s')
 wpull_env['LOG_KEY'] = ItemInterpolation('%(log_key)s')
+wpull_env['ITEM_DIR'] = ItemInterpolation('%(item_dir)s')
 wpull_env['REDIS_URL'] = REDIS_URL
 
+if LOG_REDIS_URL:
+    wpull_env['LOG_REDIS_URL'] = LOG_REDIS_URL
 if OPENSSL_CONF:
     wpull_env['OPENSSL_CONF'] = OPENSSL_CONF
 if TMPDIR:
@@ -155,8 +166,9 @@ pipeline = Pipeline(
     CheckLocalWebserver(),
     GetItemFromQueue(control, pipeline_id, downloader,
         ao_only=env.get('AO_ONLY'), large=env.get('LARGE'),
-        version_check = (VERSION, pipeline_version)),
-    StartHeartbeat(control),
+        version_check = (VERSION, pipeline_version),
+        queue_watcher=queue_watcher),
+    StartHeartbeat(reporter),
     SetFetchDepth(),
     PreparePaths(),
     WriteInfo(),
@@ -170,7 +182,7 @@ pipeline = Pipeline(
     CompressLogIfFailed(),
     WriteInfo(),
     MoveFiles(target_directory = os.environ["FINISHED_WARCS_DIR"]),
-    StopHeartbeat(),
+    StopHeartbeat(reporter),
     MarkItemAsDone(control, EXPIRE_TIME)
 )
 
@@ -193,7 +205,7 @@ def status_stopping():
 pipeline.on_stop_requested += status_stopping
 
 # Activate system monitoring.
-monitoring.start(pipeline, control, VERSION, downloader)
+reporter.start(pipeline)
 
 print('*' * 60)
 print('Pipeline ID: %s' % pipeline_id)
@@ -12,6 +12,13 @@ module ArchiveBot
 
       ::Redis.new(url: url, driver: :hiredis)
     end
+
+    ##
+    # Constructs a ::Redis object for the Redis that pipelines ship job logs
+    # to.  This is LOG_REDIS_URL if set, and REDIS_URL otherwise.
+    def make_log_redis
+      make_redis(ENV['LOG_REDIS_URL'] || ENV['REDIS_URL'])
+    end
     
     ##
     # Returns the Redis pubsub channel where job status notifications will be
@@ -0,0 +1,23 @@
+require 'spec_helper'
+
+require 'lib/job_log'
+
+describe JobLog do
+  describe '.entries_after' do
+    let(:redis) { double(:type => 'stream') }
+
+    it 'reads a stream from the start without a checkpoint' do
+      redis.should_receive(:xrange).with('ident_log', '-', '+').and_return(
+        [['1-0', ['0', 'a', '1', 'b']], ['2-0', ['0', 'c']]])
+
+      JobLog.entries_after(redis, 'ident_log', nil).should ==
+        [['a', '1-0'], ['b', '1-0'], ['c', '2-0']]
+    end
+
+    it 'reads a stream after a checkpoint' do
+      redis.should_receive(:xrange).with('ident_log', '1-1', '+').and_return([])
+
+      JobLog.entries_after(redis, 'ident_log', '1-0').should == []
+    end
+  end
+end
@@ -27,4 +27,21 @@ describe Job do
       j.finished_at.should == 1234567890
     end
   end
+
+  describe '#log_redis' do
+    it "is the job's Redis by default" do
+      redis = Object.new
+      j = Job.new(nil, redis)
+
+      j.log_redis.should equal(redis)
+    end
+
+    it 'is the separate log Redis if one is set' do
+      log_redis = Object.new
+      j = Job.new(nil, Object.new)
+      j.log_redis = log_redis
+
+      j.log_redis.should equal(log_redis)
+    end
+  end
 end
@@ -0,0 +1,26 @@
+require 'spec_helper'
+
+require 'lib/log_packet'
+
+describe LogPacket do
+  describe '.parse' do
+    it 'reads a plain packet' do
+      packet = LogPacket.parse('{"type": "download", "response_code": 200}')
+
+      packet.should == { 'type' => 'download', 'response_code' => 200 }
+    end
+
+    it 'expands a compact packet' do
+      packet = LogPacket.parse('{"y":"d","r":404,"e":false,"a":true}')
+
+      packet.should == { 'type' => 'download', 'response_code' => 404,
+                         'is_error' => false, 'is_warning' => true }
+    end
+
+    it 'keeps unknown keys and types of a compact packet' do
+      packet = LogPacket.parse('{"y":"ignore_stats","checks":10}')
+
+      packet.should == { 'type' => 'ignore_stats', 'checks' => 10 }
+    end
+  end
+end
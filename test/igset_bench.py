@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+'''
+Benchmarks and lints the ignore sets in db/ignore_patterns.
+
+Each igset is loaded into the pipeline's Ignoracle on its own and run
+against a synthetic URL corpus.  For each igset this reports URLs/second,
+the slowest patterns, patterns that can never match any URL and patterns
+that matched nothing in the corpus.
+
+Raw timings depend on the machine, so the cost that is compared against
+test/igset_baseline.json is relative: it is the time taken by the igset
+divided by the time taken, in the same process and right after it, by a
+small reference igset over the same corpus.  validate_db.py fails if an
+igset's cost exceeds its baseline by more than the tolerance stored in
+that file.
+
+Usage:
+
+    test/igset_bench.py [--urls N] [--update-baseline] [igset ...]
+'''
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+
+from collections import namedtuple
+from glob import glob
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+IGSET_DIR = os.path.join(ROOT, 'db', 'ignore_patterns')
+BASELINE_FILE = os.path.join(ROOT, 'test', 'igset_baseline.json')
+
+sys.path.insert(0, os.path.join(ROOT, 'pipeline'))
+
+from archivebot.wpull.ignoracle import Ignoracle
+
+try:
+    from re import _parser as sre_parse
+    from re import _constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
+CORPUS_SIZE = 5000
+SEED = 0
+REPEATS = 9
+
+# Stands in for wpull's URL records; see parameterize_record_info.
+Record = namedtuple('Record', ['url', 'level', 'parent_url'])
+
+Result = namedtuple('Result', [
+    'name',
+    'patterns',     # number of patterns in the igset
+    'urls',         # number of URLs checked per run
+    'seconds',      # best time to check the whole corpus
+    'cost',         # median time divided by the calibration time
+    'slowest',      # list of (pattern, total seconds), slowest first
+    'unmatchable',  # list of (pattern, reason)
+    'quarantined',  # list of patterns the pipeline would refuse to run
+    'unmatched'     # list of patterns that matched nothing in the corpus
+])
+
+# ---------------------------------------------------------------------------
+# Corpus
+
+HOSTS = [
+    'www.example.com', 'example.org', 'blog.example.net', 'forum.example.com',
+    'en.wikipedia.org', 'wiki.example.org', 'github.com', 'twitter.com',
+    'www.facebook.com', 'www.reddit.com', 'old.reddit.com', 'www.youtube.com',
+    'example.tumblr.com', '64.media.tumblr.com', 'www.instagram.com',
+    'www.pinterest.com', 'mastodon.social', 'example.blog.fc2.com',
+    'example.tistory.com', 'secure.gravatar.com', 'www.imdb.com'
+]
+
+WORDS = [
+    'index', 'page', 'wiki', 'forum', 'topic', 'thread', 'images', 'css', 'js',
+    'static', 'assets', 'user', 'status', 'comments', 'r', 'archive', 'tag',
+    'category', '2015', '06', 'blob', 'tree', 'master', 'p', 'photos', 'posts',
+    'Special:Log', 'Main_Page', 'w', 'feed', 'wp-content', 'uploads', 'media',
+    'App_Themes', 'notes', 'login', 'search', 'discover', 'showthread.php',
+    'viewtopic.php', 'index.php', 'displayimage.php', 'api', 'v1'
+]
+
+EXTENSIONS = ['', '', '', '.html', '.php', '.css', '.js', '.png', '.jpg', '/']
+
+PARAMETERS = [
+    'id', 'page', 'p', 'start', 'sort', 'action', 'title', 'oldid', 'diff',
+    'replytocom', 'share', 'lang', 'ref', 'sid', 'mode', 'hl', 'C', 'O',
+    'filtertype', 'utm_source', 'amp;amp;page', 'direction', 'cmd'
+]
+
+VALUES = [
+    '1', '42', '1000000', 'edit', 'history', 'reply', 'prev', 'next', 'en',
+    'N', 'D', 'twitter', '%2525252525', 'a' * 40, '0123456789abcdef' * 4
+]
+
+def _path(rng):
+    segments = [rng.choice(WORDS) for _ in range(rng.randint(0, 8))]
+
+    # Crawler traps: repeated path segments.
+    if segments and rng.random() < 0.1:
+        segments += segments * rng.randint(1, 4)
+
+    return '/' + '/'.join(segments) + rng.choice(EXTENSIONS)
+
+def _query(rng):
+    count = rng.choice([0, 0, 0, 1, 1, 2, 3, 8, 30])
+
+    if not count:
+        return ''
+
+    return '?' + '&'.join('%s=%s' % (rng.choice(PARAMETERS), rng.choice(VALUES))
+                          for _ in range(count))
+
+def corpus(size=CORPUS_SIZE, seed=SEED):
+    '''
+    Returns a deterministic list of size synthetic Records.  Most are
+    ordinary pages; some carry the query strings, repeated path segments and
+    long lengths that ignore patterns are written for.  Each record's parent
+    is the root of its host, so parameterized patterns get expanded.
+    '''
+
+    rng = random.Random(seed)
+    records = []
+
+    for _ in range(size):
+        host = rng.choice(HOSTS)
+        scheme = rng.choice(['http', 'https'])
+        url = '%s://%s%s%s' % (scheme, host, _path(rng), _query(rng))
+        records.append(Record(url, 1, '%s://%s/' % (scheme, host)))
+
+    return records
+
+# ---------------------------------------------------------------------------
+# Calibration
+
+CALIBRATION_PATTERNS = [
+    '/[^/]+/[^/]+/', '[?&]id=\\d+', '\\.php\\?', '^https?://www\\.',
+    '(images|css|js)/', '/(\\d+)/\\1/', '[?&](page|p)=\\d+(&|$)', '\\.png$'
+]
+
+def calibrate(records, reference):
+    '''
+    Returns the time taken to check every URL in records with reference, an
+    Ignoracle loaded with CALIBRATION_PATTERNS.  Igset timings are divided
+    by this to make them comparable across machines; since the reference
+    goes through the same Ignoracle code, the per-URL overhead of the
+    pipeline's own code cancels out too.
+    '''
+
+    start = time.perf_counter()
+
+    for record in records:
+        reference.ignores(record)
+
+    return time.perf_counter() - start
+
+# ---------------------------------------------------------------------------
+# Lint
+
+def _consumes(op):
+    return op not in (sre_constants.AT, sre_constants.ASSERT,
+                      sre_constants.ASSERT_NOT)
+
+def unmatchable_reason(pattern):
+    '''
+    Returns why pattern can never match a URL, or None if no reason is
+    known.  Only the top level of the pattern is inspected.
+    '''
+
+    expanded = pattern.replace('{primary_url}', '').replace('{primary_netloc}', '')
+
+    try:
+        compiled = re.compile(expanded)
+        parsed = sre_parse.parse(expanded, compiled.flags)
+    except re.error as error:
+        return 'invalid: %s' % error
+
+    if compiled.flags & re.MULTILINE:
+        return None
+
+    items = list(parsed)
+
+    for i, (op, av) in enumerate(items):
+        if op == sre_constants.AT and av in (sre_constants.AT_BEGINNING,
+                sre_constants.AT_BEGINNING_STRING):
+            if any(_consumes(o) for o, _ in items[:i]):
+                return '^ after the start of the pattern'
+
+        if op == sre_constants.AT and av in (sre_constants.AT_END,
+                sre_constants.AT_END_STRING):
+            if any(_consumes(o) for o, _ in items[i + 1:]):
+                return '$ before the end of the pattern'
+
+        if op == sre_constants.LITERAL and chr(av) in ' \t\r\n#':
+            return 'matches %r, which never appears in a fetched URL' % chr(av)
+
+    return None
+
+# ---------------------------------------------------------------------------
+# Benchmark
+
+def load_igsets(names=None):
+    '''
+    Returns a dict of igset name to list of patterns.
+    '''
+
+    igsets = {}
+
+    for filename in sorted(glob(os.path.join(IGSET_DIR, '*.json'))):
+        name = os.path.splitext(os.path.basename(filename))[0]
+
+        if names and name not in names:
+            continue
+
+        with open(filename) as f:
+            igsets[name] = json.load(f)['patterns']
+
+    return igsets
+
+def _oracle(patterns, stats_sample_interval):
+    # Every URL in the corpus is distinct; remembering verdicts would only
+    # add overhead.
+    oracle = Ignoracle(verdict_cache_size=0,
+                       stats_sample_interval=stats_sample_interval)
+    oracle.set_patterns(patterns)
+
+    return oracle
+
+def bench(name, patterns, records, repeats=REPEATS, top=5):
+    '''
+    Runs records through an Ignoracle loaded with patterns and returns a
+    Result.
+    '''
+
+    oracle = _oracle(patterns, 0)
+    reference = _oracle(CALIBRATION_PATTERNS, 0)
+    times = []
+    ratios = []
+
+    # Each of the igset's runs is followed by a calibration run, and its
+    # cost is taken from the pair, so that both see the same machine load.
+    # The median pair is used, so that a hiccup in one run doesn't count.
+    for _ in range(repeats):
+        start = time.perf_counter()
+
+        for record in records:
+            oracle.ignores(record)
+
+        elapsed = time.perf_counter() - start
+        times.append(elapsed)
+        ratios.append(elapsed / calibrate(records, reference))
+
+    # A separate, timed pass for per-pattern figures, so that timing
+    # overhead doesn't show up in the throughput.
+    oracle = _oracle(patterns, 1)
+
+    for record in records:
+        oracle.ignores(record)
+
+    stats = oracle.pattern_stats()['patterns']
+
+    unmatchable = [(pattern, unmatchable_reason(pattern))
+                   for pattern in patterns if unmatchable_reason(pattern)]
+
+    return Result(
+        name=name,
+        patterns=len(patterns),
+        urls=len(records),
+        seconds=min(times),
+        cost=sorted(ratios)[len(ratios) // 2],
+        slowest=[(p['pattern'], p['seconds']) for p in stats[:top]
+                 if p['seconds'] > 0],
+        unmatchable=unmatchable,
+        quarantined=list(oracle.quarantined),
+        unmatched=[p['pattern'] for p in stats if p['hits'] == 0]
+    )
+
+def bench_all(names=None, size=CORPUS_SIZE):
+    '''
+    Benchmarks every igset (or only those in names).  Returns a list of
+    Results.
+    '''
+
+    records = corpus(size)
+
+    return [bench(name, patterns, records)
+            for name, patterns in sorted(load_igsets(names).items())]
+
+def load_baseline():
+    with open(BASELINE_FILE) as f:
+        return json.load(f)
+
+def limit_for(baseline, name):
+    '''
+    Returns the highest acceptable cost for an igset.  Igsets without a
+    baseline are held to the most expensive baseline.
+    '''
+
+    costs = baseline['costs']
+    cost = costs.get(name, max(costs.values()))
+
+    return cost * (1 + baseline['tolerance'])
+
+def write_baseline(results, tolerance):
+    baseline = dict(
+        tolerance=tolerance,
+        costs=dict((r.name, round(r.cost, 4)) for r in results)
+    )
+
+    with open(BASELINE_FILE, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+def report(result, limit=None):
+    line = '%-24s %4d patterns %10.0f URLs/s  cost %.4f' % (
+        result.name, result.patterns, result.urls / result.seconds, result.cost)
+
+    if limit is not None:
+        line += ' (limit %.4f)' % limit
+        if result.cost > limit:
+            line += '  REGRESSED'
+
+    print(line)
+
+    for pattern, seconds in result.slowest:
+        print('    slow: %8.2f ms  %s' % (seconds * 1000, pattern))
+
+    for pattern, reason in result.unmatchable:
+        print('    unmatchable (%s): %s' % (reason, pattern))
+
+    for pattern in result.quarantined:
+        print('    quarantined as too slow: %s' % pattern)
+
+    if result.unmatched:
+        print('    %d pattern(s) matched nothing in the corpus' % len(result.unmatched))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('igsets', nargs='*', help='igsets to run (default: all)')
+    parser.add_argument('--urls', type=int, default=CORPUS_SIZE,
+                        help='corpus size (default: %(default)s)')
+    parser.add_argument('--unmatched', action='store_true',
+                        help='list patterns that matched nothing in the corpus')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='write the measured costs to %s' % BASELINE_FILE)
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='regression tolerance to store with --update-baseline')
+    args = parser.parse_args()
+
+    results = bench_all(args.igsets, args.urls)
+
+    try:
+        baseline = load_baseline()
+    except (IOError, ValueError):
+        baseline = None
+
+    for result in results:
+        report(result, limit_for(baseline, result.name) if baseline else None)
+
+        if args.unmatched:
+            for pattern in result.unmatched:
+                print('    unmatched: %s' % pattern)
+
+    if args.update_baseline:
+        write_baseline(results, args.tolerance)
+        print('Wrote %s' % BASELINE_FILE)
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 import json
+import os
 import re
 from glob import glob
 
@@ -28,3 +29,28 @@ def test_user_agent_file(filename):
         assert agent['name']
     
 
+
+@pytest.fixture(scope='module')
+def igset_results():
+    import igset_bench
+
+    return dict((r.name, r) for r in igset_bench.bench_all())
+
+def igset_name(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+@pytest.mark.parametrize('filename', ignore_pattern_files)
+def test_ignore_patterns_are_not_quarantined(filename, igset_results):
+    assert igset_results[igset_name(filename)].quarantined == []
+
+@pytest.mark.parametrize('filename', ignore_pattern_files)
+def test_ignore_pattern_throughput(filename, igset_results):
+    import igset_bench
+
+    name = igset_name(filename)
+    result = igset_results[name]
+    limit = igset_bench.limit_for(igset_bench.load_baseline(), name)
+
+    assert result.cost <= limit, \
+        '%s costs %.4f, over its limit of %.4f; run test/igset_bench.py %s ' \
+        'to find the slow patterns' % (name, result.cost, limit, name)